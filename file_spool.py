@@ -0,0 +1,70 @@
+from dotenv import load_dotenv
+import os
+import tempfile
+import threading
+
+load_dotenv()
+
+# Вложения из Telegram не держатся в памяти целиком: до порога - в памяти, крупнее - во временном файле,
+# который удаляется при закрытии. Копируются и отправляются в Jira кусками по CHUNK_SIZE
+SPOOL_THRESHOLD = int(os.environ.get("ATTACHMENT_SPOOL_THRESHOLD", 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+
+
+def spooled_file():
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+
+
+def copy_chunks(chunks, file):
+    for chunk in chunks:
+        if chunk:
+            file.write(chunk)
+    file.seek(0)
+    return file
+
+
+# Один файл могут одновременно читать несколько загрузок (повтор, запасной путь через REST API),
+# поэтому у каждой загрузки своё смещение, а перейти к нему и прочитать кусок - одно действие под блокировкой.
+# os.pread не подходит: у файла, который ещё в памяти, нет дескриптора, а fileno() перенёс бы его на диск
+_read_lock = threading.Lock()
+
+
+def read_at(file, offset, size=-1):
+    with _read_lock:
+        file.seek(offset)
+        return file.read(size)
+
+
+def file_size(file):
+    with _read_lock:
+        return file.seek(0, os.SEEK_END)
+
+
+class SpoolReader:
+    # Файл для MultipartEncoder (requests_toolbelt) без fileno(): по нему кодировщик узнаёт длину файла,
+    # а у SpooledTemporaryFile вызов fileno() переносит данные из памяти на диск. Длину кодировщик берёт
+    # из len - сколько байт осталось прочитать
+    def __init__(self, file):
+        self.file = file
+        self.size = file_size(file)
+        self.position = 0
+
+    @property
+    def len(self):
+        return self.size - self.position
+
+    def read(self, size=-1):
+        chunk = read_at(self.file, self.position, size)
+        self.position += len(chunk)
+        return chunk
+
+
+async def read_chunks(file):
+    # Асинхронный источник для aiohttp: тело запроса читается из файла по кускам, а не одним bytes
+    position = 0
+    while True:
+        chunk = read_at(file, position, CHUNK_SIZE)
+        if not chunk:
+            return
+        position += len(chunk)
+        yield chunk
@@ -0,0 +1,136 @@
+from dotenv import load_dotenv
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+
+
+def storage_key_id(key):
+    # Строковый ключ записи: бот, чат, пользователь, тема и назначение (destiny) из StorageKey
+    return ':'.join(str(part) for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                                           getattr(key, 'business_connection_id', None), key.destiny))
+
+
+class SQLiteStorage(BaseStorage):
+    # Хранилище состояний FSM в файле SQLite: переживает перезапуск бота.
+    # Записи копятся в памяти и сбрасываются в базу одной транзакцией раз в flush_interval секунд
+    # или при накоплении batch_size изменений; чтение сначала смотрит несброшенные изменения.
+    # При аварийном завершении теряются изменения не более чем за flush_interval.
+    # Записи, не менявшиеся дольше ttl секунд, считаются пустыми и удаляются из базы, как и завершённые
+    # (без состояния и данных) - как state_ttl/data_ttl у RedisStorage
+    def __init__(self, path, flush_interval=1.0, batch_size=100, ttl=86400):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.cleanup_interval = min(ttl, 3600)
+        self.last_cleanup = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT, updated_at REAL)")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(fsm)")]
+        if 'updated_at' not in columns:
+            # база прошлой версии без времени изменения: старые записи доживут ttl с момента обновления
+            self.connection.execute("ALTER TABLE fsm ADD COLUMN updated_at REAL")
+            self.connection.execute("UPDATE fsm SET updated_at = ?", (time.time(),))
+        self.connection.commit()
+        self.pending = {}   # ключ -> {'state': ..., 'data': ..., 'updated_at': ...} - ещё не записанные в базу значения
+        self.flush_task = None
+
+    def load(self, key_id):
+        if key_id in self.pending:
+            return self.pending[key_id]
+        row = self.connection.execute("SELECT state, data FROM fsm WHERE key = ? AND updated_at >= ?",
+                                      (key_id, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return {'state': None, 'data': {}}
+        return {'state': row[0], 'data': json.loads(row[1]) if row[1] else {}}
+
+    def put(self, key_id, record):
+        record['updated_at'] = time.time()
+        self.pending[key_id] = record
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.get_running_loop().create_task(self.delayed_flush())
+
+    async def delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        records, self.pending = self.pending, {}
+        finished = [(key_id,) for key_id, record in records.items() if record['state'] is None and not record['data']]
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                    [(key_id, record['state'], json.dumps(record['data'], ensure_ascii=False), record['updated_at'])
+                     for key_id, record in records.items() if record['state'] is not None or record['data']])
+                self.connection.executemany("DELETE FROM fsm WHERE key = ?", finished)
+                if time.time() - self.last_cleanup >= self.cleanup_interval:
+                    self.cleanup()
+        except Exception as e:
+            print(f"Ошибка записи состояний FSM в {self.path}: {e}")
+            # не теряем изменения: вернём их в очередь, если поверх не пришли более новые
+            for key_id, record in records.items():
+                self.pending.setdefault(key_id, record)
+
+    def cleanup(self):
+        # Удаление просроченных записей; вызывается при сбросе не чаще раза в cleanup_interval
+        self.connection.execute("DELETE FROM fsm WHERE updated_at < ?", (time.time() - self.ttl,))
+        self.last_cleanup = time.time()
+
+    async def set_state(self, key, state=None):
+        key_id = storage_key_id(key)
+        record = dict(self.load(key_id))
+        record['state'] = state.state if isinstance(state, State) else state
+        self.put(key_id, record)
+
+    async def get_state(self, key):
+        return self.load(storage_key_id(key))['state']
+
+    async def set_data(self, key, data):
+        key_id = storage_key_id(key)
+        record = dict(self.load(key_id))
+        record['data'] = dict(data)
+        self.put(key_id, record)
+
+    async def get_data(self, key):
+        return dict(self.load(storage_key_id(key))['data'])
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        self.flush()
+        self.connection.close()
+
+
+def create_fsm_storage():
+    # Хранилище состояний выбирается настройкой FSM_STORAGE:
+    #   memory (по умолчанию) - в памяти процесса, теряется при перезапуске;
+    #   redis - общее для нескольких экземпляров бота, адрес в FSM_REDIS_URL (без пакета redis бот не запустится);
+    #   sqlite - файл FSM_SQLITE_PATH на диске одного сервера
+    load_dotenv()
+    backend = os.environ.get("FSM_STORAGE", "memory").lower()
+    if backend == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            # молча перейти на память нельзя: реплики перестали бы видеть общие состояния
+            raise RuntimeError("Для FSM_STORAGE=redis нужен пакет redis") from e
+        return RedisStorage.from_url(os.environ.get("FSM_REDIS_URL", "redis://localhost:6379/0"),
+                                     state_ttl=int(os.environ.get("FSM_STATE_TTL", 86400)),
+                                     data_ttl=int(os.environ.get("FSM_STATE_TTL", 86400)))
+    if backend == "sqlite":
+        return SQLiteStorage(os.environ.get("FSM_SQLITE_PATH", "fsm_state.sqlite3"),
+                             flush_interval=float(os.environ.get("FSM_FLUSH_INTERVAL", 1.0)),
+                             batch_size=int(os.environ.get("FSM_FLUSH_BATCH", 100)),
+                             ttl=int(os.environ.get("FSM_STATE_TTL", 86400)))
+    return MemoryStorage()
@@ -0,0 +1,130 @@
+from dotenv import load_dotenv
+from collections import OrderedDict
+import os
+import threading
+import time
+
+load_dotenv()
+
+
+class SummaryCache:
+    # Темы заявок (summary) по ключу: общий для списка заявок, подписок и опроса LRU-кэш с временем жизни записи.
+    # Заполняется попутно из любых запросов, где тема уже пришла, поэтому списки подписок почти не ходят в Jira
+    def __init__(self, max_size=5000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.summaries = OrderedDict()   # ключ заявки -> (тема, время истечения)
+        self.lock = threading.Lock()
+
+    def get_many(self, issue_keys):
+        # Найденные в кэше темы: {ключ: тема}
+        now = time.monotonic()
+        found = {}
+        with self.lock:
+            for issue_key in issue_keys:
+                item = self.summaries.get(issue_key)
+                if item is None:
+                    continue
+                summary, expires_at = item
+                if expires_at < now:
+                    del self.summaries[issue_key]
+                    continue
+                self.summaries.move_to_end(issue_key)
+                found[issue_key] = summary
+        return found
+
+    def get(self, issue_key):
+        return self.get_many([issue_key]).get(issue_key)
+
+    def set_many(self, summaries):
+        expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            for issue_key, summary in summaries.items():
+                self.summaries[issue_key] = (summary, expires_at)
+                self.summaries.move_to_end(issue_key)
+            while len(self.summaries) > self.max_size:
+                self.summaries.popitem(last=False)
+
+    def set(self, issue_key, summary):
+        self.set_many({issue_key: summary})
+
+
+issue_summaries = SummaryCache(int(os.environ.get("ISSUE_SUMMARY_CACHE_SIZE", 5000)),
+                               int(os.environ.get("ISSUE_SUMMARY_CACHE_TTL", 3600)))
+
+
+class IssueSnapshot:
+    # Снимок заявки для просмотра статуса и подписки: только нужные поля, без объекта Issue и списка комментариев
+    __slots__ = ('key', 'status', 'summary', 'description', 'updated', 'reporter', 'last_comment', 'expires_at')
+
+    def __init__(self, key, status, summary, description, updated, reporter, last_comment):
+        self.key = key
+        self.status = status
+        self.summary = summary
+        self.description = description
+        self.updated = updated
+        self.reporter = reporter   # key автора в Jira
+        self.last_comment = last_comment
+        self.expires_at = None
+
+    def claim_info(self):
+        # В формате check_claim_status
+        return {
+            'status': self.status,
+            'last_update': self.updated,
+            'summary': self.summary,
+            'description': self.description,
+            'last_comment': self.last_comment
+        }
+
+
+class SnapshotCache:
+    # Снимки заявок по ключу, общие для всех пользователей процесса (права проверяются по reporter при чтении).
+    # Последний комментарий зависит от прав токена (внутренние комментарии видят только сотрудники поддержки),
+    # поэтому снимок хранится отдельно для каждого пользователя Jira (viewer), который его загрузил.
+    # Снимки сбрасываются, когда бот сам меняет заявку (комментарий, вложения), когда опрос видит новый updated,
+    # и в любом случае через ttl - изменения, сделанные в Jira, без подписки заметны только по ttl
+    def __init__(self, max_size=2000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.snapshots = OrderedDict()   # ключ заявки -> {viewer: снимок}
+        self.lock = threading.Lock()
+
+    def get(self, issue_key, viewer):
+        with self.lock:
+            by_viewer = self.snapshots.get(issue_key)
+            snapshot = by_viewer.get(viewer) if by_viewer else None
+            if snapshot is None:
+                return None
+            if snapshot.expires_at < time.monotonic():
+                del by_viewer[viewer]
+                if not by_viewer:
+                    del self.snapshots[issue_key]
+                return None
+            self.snapshots.move_to_end(issue_key)
+            return snapshot
+
+    def put(self, snapshot, viewer):
+        snapshot.expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            self.snapshots.setdefault(snapshot.key, {})[viewer] = snapshot
+            self.snapshots.move_to_end(snapshot.key)
+            while len(self.snapshots) > self.max_size:
+                self.snapshots.popitem(last=False)
+        issue_summaries.set(snapshot.key, snapshot.summary)
+        return snapshot
+
+    def invalidate(self, issue_key):
+        with self.lock:
+            self.snapshots.pop(issue_key, None)
+
+    def observe_updated(self, issue_key, updated):
+        # Опрос увидел заявку с другим updated - снимки устарели у всех пользователей
+        with self.lock:
+            by_viewer = self.snapshots.get(issue_key)
+            if by_viewer and any(snapshot.updated != updated for snapshot in by_viewer.values()):
+                del self.snapshots[issue_key]
+
+
+issue_snapshots = SnapshotCache(int(os.environ.get("ISSUE_SNAPSHOT_CACHE_SIZE", 2000)),
+                                int(os.environ.get("ISSUE_SNAPSHOT_TTL", 300)))
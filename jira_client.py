@@ -1,14 +1,151 @@
 from dotenv import load_dotenv
 from datetime import datetime
+from collections import OrderedDict
+import hashlib
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from jira import JIRA
 from jira.exceptions import JIRAError
 import requests
 import mimetypes
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from issue_cache import issue_summaries, issue_snapshots, IssueSnapshot
+from file_spool import SpoolReader
 from requests.auth import HTTPBasicAuth
 
+load_dotenv()
+
+# Общий пул keep-alive соединений к Jira для всех клиентов: и для библиотеки jira, и для прямых REST-запросов.
+# Один HTTPAdapter, смонтированный в разные сессии, держит один пул, заголовки авторизации у каждой сессии свои
+_http_adapter = HTTPAdapter(pool_connections=int(os.environ.get("JIRA_POOL_CONNECTIONS", 4)),
+                            pool_maxsize=int(os.environ.get("JIRA_POOL_SIZE", 20)))
+
+
+# Загрузка вложений параллельно с созданием заявки и друг с другом (create_claim_with_attachments)
+_upload_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("JIRA_UPLOAD_WORKERS", 4)),
+                                      thread_name_prefix="jira-upload")
+
+
+def make_attachment(file, filename, image=False):
+    mime_type, _ = mimetypes.guess_type(filename)
+    return {
+        'file': file,
+        'filename': filename,
+        'mime_type': "image/jpeg" if image else (mime_type or "application/octet-stream"),
+        'image': image
+    }
+
+
+def wait_temporary_ids(uploads):
+    # Ждёт все загрузки, в том числе после ошибки одной из них, - после выхода файлы никто не читает.
+    # Возвращает id временных вложений по файлам; None - файл не загружен
+    temporary_ids = []
+    for upload in uploads:
+        try:
+            temporary_ids.append(upload.result())
+        except Exception as e:
+            print(f"Ошибка загрузки временного вложения: {e}")
+            temporary_ids.append(None)
+    return temporary_ids
+
+
+def flatten_temporary_ids(temporary_ids):
+    return [temporary_id for file_ids in temporary_ids for temporary_id in file_ids]
+
+
+def attachments_comment(attachments):
+    # Комментарий к вложениям в вики-разметке Jira: картинки показываются в тексте, остальные - ссылкой
+    parts = []
+    for attachment in attachments:
+        if attachment['image']:
+            parts.append(f"Вложенная фотография:\n\n!{attachment['filename']}!")
+        else:
+            parts.append(f"Вложение [^{attachment['filename']}]")
+    return "\n\n".join(parts)
+
+
+def mount_http_adapter(session):
+    session.mount("https://", _http_adapter)
+    session.mount("http://", _http_adapter)
+    return session
+
+
+class JiraMetadataCache:
+    # serviceDeskId (он же номер портала для ссылок) и id типов запросов почти не меняются -
+    # храним их по (домен, проект), обновляем в фоне раз в ttl секунд.
+    # Клиент (и токен) в записи не хранится: фоновое обновление идёт через клиента из кэша get_jira_client,
+    # а после forget_jira_client токен сброшенной регистрации больше не используется
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.entries = {}   # (домен, проект) -> {'service_desk_id', 'request_types', 'loaded_at'}
+        self.lock = threading.Lock()
+        self.refresh_thread = None
+
+    def get(self, client):
+        entry = self.fresh_entry(client.domain, client.project_key)
+        if entry is None:
+            # записи нет или фоновое обновление давно не срабатывало - загружаем сразу
+            entry = self.load(client)
+        return entry
+
+    def fresh_entry(self, domain, project_key):
+        entry = self.entries.get((domain, project_key))
+        if entry is None or time.monotonic() - entry['loaded_at'] > self.ttl * 2:
+            return None
+        return entry
+
+    def load(self, client):
+        service_desk_id = client.fetch_servicedesk_number()
+        request_types = client.fetch_request_types(service_desk_id) if service_desk_id else {}
+        return self.store(client.domain, client.project_key, service_desk_id, request_types)
+
+    def store(self, domain, project_key, service_desk_id, request_types):
+        entry = {
+            'service_desk_id': service_desk_id,
+            'request_types': request_types,
+            'loaded_at': time.monotonic()
+        }
+        if service_desk_id:
+            with self.lock:
+                self.entries[(domain, project_key)] = entry
+            self.start_background_refresh()
+        return entry
+
+    def start_background_refresh(self):
+        with self.lock:
+            if self.refresh_thread is not None:
+                return
+            self.refresh_thread = threading.Thread(target=self.refresh_loop, daemon=True)
+        self.refresh_thread.start()
+
+    def refresh_loop(self):
+        while True:
+            time.sleep(self.ttl)
+            self.refresh()
+
+    def refresh(self):
+        with self.lock:
+            keys = list(self.entries)
+        for domain, project_key in keys:
+            client = current_jira_client(domain, project_key)
+            if client is None:
+                # действующих клиентов нет - запись устареет, и get() загрузит её токеном того, кто обратится
+                continue
+            try:
+                self.load(client)
+            except Exception as e:
+                # оставляем старые значения, попробуем в следующий раз
+                print(f"Не удалось обновить метаданные Jira: {e}")
+
+
+jira_metadata = JiraMetadataCache(int(os.environ.get("JIRA_METADATA_TTL", 3600)))
+
+
 class JiraClient():
-    def __init__(self, token):
+    def __init__(self, token, jira_user_id=None):
         load_dotenv()
         self.headers = {
             "X-Atlassian-Token": "no-check",
@@ -21,9 +158,21 @@ class JiraClient():
         self.typetask_field_1 = os.environ.get("GIRA_TYPETASK_FIELD_1")
         self.typetask_field_2 = os.environ.get("GIRA_TYPETASK_FIELD_2")
         self.jira_name_prefix = os.environ.get("GIRA_NAME_PREFIX")
+        self.search_batch_size = 50   # сколько номеров заявок передавать в одном key in (...)
+        self.updates_fields = "status,updated,summary,reporter"   # поля заявки для опроса подписок, без комментариев
+        self.comments_page_size = int(os.environ.get("JIRA_COMMENTS_PAGE_SIZE", 20))
+        # Текущий пользователь Jira запрашивается один раз на клиента; если его key уже сохранён
+        # в Supabase (FIELD_JIRA_ID), проверки владельца заявки обходятся вообще без запроса
+        self.jira_user_id = jira_user_id
+        self.myself = None
+        self.myself_lock = threading.Lock()
+        # таймаут HTTP-запросов: медленный или зависший Jira одного пользователя не держит опрос остальных
+        self.timeout = float(os.environ.get("JIRA_TIMEOUT", 30))
         jira_options = {'server': self.domain}
         # Авторизация с помощью Basic Auth (email и API токен, полученный в настройках Atlassian)
-        self.jira = JIRA(options=jira_options, token_auth=token)  # basic_auth=(self.email, token))
+        self.jira = JIRA(options=jira_options, token_auth=token, timeout=self.timeout)  # basic_auth=(self.email, token))
+        mount_http_adapter(self.jira._session)
+        self.session = mount_http_adapter(requests.Session())
 
     def create_claim(self, username, claim_data): # status):
         url = f"{self.domain}rest/servicedeskapi/request"
@@ -56,7 +205,7 @@ class JiraClient():
             }
 
         try:
-            response = requests.post(url, json=data, headers=self.headers)
+            response = self.session.post(url, json=data, headers=self.headers, timeout=self.timeout)
             response.raise_for_status()
             new_issue = response.json()
             print(new_issue)
@@ -70,153 +219,306 @@ class JiraClient():
             return None
 
     def get_request_type_id(self, request_type_name, serviceDeskId):
+        request_types = jira_metadata.get(self)['request_types']
+        if request_type_name not in request_types:
+            # новый тип запроса мог появиться после последнего обновления кэша
+            request_types = jira_metadata.load(self)['request_types']
+        print(request_types.get(request_type_name))
+        return request_types.get(request_type_name)
+
+    def fetch_request_types(self, serviceDeskId):
         url = f"{self.domain}rest/servicedeskapi/servicedesk/{serviceDeskId}/requesttype"
-        response = requests.get(url, headers=self.headers)
+        response = self.session.get(url, headers=self.headers, timeout=self.timeout)
         response.raise_for_status()
         request_types = response.json()
-        for rt in request_types.get("values", []):
-            if rt.get("name") == request_type_name:
-                print(rt.get("id"))
-                return rt.get("id")
-        return None
+        return {rt.get("name"): rt.get("id") for rt in request_types.get("values", [])}
 
     def add_attachment_to_claim(self, claim_number: int, downloaded_file, filename):
-        try:
-            issue_key = self.jira.issue(self.project_key + '-' + str(claim_number))
-
-            attach_url = f"{self.domain}rest/api/2/issue/{issue_key}/attachments"
-
-            mime_type, _ = mimetypes.guess_type(filename)
-            if not mime_type:
-                mime_type = "application/octet-stream"
-
-            files = {
-                "file": (filename, downloaded_file, mime_type)
-            }
-
-            attach_response = requests.post(attach_url, headers=self.headers, files=files)
-            attach_response.raise_for_status()
-            attachments = attach_response.json()
-            if not attachments:
-                print("Вложение не загружено")
-                return None
-            # Берём первое вложение
-            attachment = attachments[0]
-
-            comment_text = f"[Вложение {attachment['filename']}|{attachment['content']}]"
-
-            comment_url = f"{self.domain}rest/api/2/issue/{issue_key}/comment"
-            comment_data = {"body": comment_text}
-
-            comment_response = requests.post(comment_url, json=comment_data, headers=self.headers)
-            comment_response.raise_for_status()
-            return comment_response.json()
-        except Exception as e:
-            print(f"Ошибка при добавлении комментария с документом: {e}")
-            return None
+        return self.add_attachments_to_claim(claim_number, [make_attachment(downloaded_file, filename)])
 
     def add_photo_to_claim(self, claim_number: int, downloaded_file, filename):
+        return self.add_attachments_to_claim(claim_number, [make_attachment(downloaded_file, "photo.jpg", image=True)])
+
+    def create_claim_with_attachments(self, username, claim_data, attachments):
+        # Файлы загружаются во временное хранилище Service Desk параллельно с созданием заявки,
+        # затем прикрепляются к ней вместе с комментарием одним запросом.
+        # Возвращает (ответ создания заявки, результат прикрепления вложений)
+        service_desk_id = self.get_servicedesk_number()
+        uploads = self.submit_temporary_files(service_desk_id, attachments)
+        new_issue = self.create_claim(username, claim_data)
+        temporary_ids = wait_temporary_ids(uploads)
+        if not new_issue:
+            return None, None
+        claim_number = new_issue['issueKey'].split('-')[-1]
+        return new_issue, self.add_attachments_to_claim(claim_number, attachments, temporary_ids)
+
+    def add_attachments_to_claim(self, claim_number, attachments, temporary_ids=None):
+        # Номер заявки известен - issue() для получения ключа не нужен. Основной путь - Service Desk:
+        # все файлы одним multipart-запросом во временное хранилище, затем прикрепление с комментарием одним запросом.
+        # Если Service Desk API недоступно - все файлы одним запросом в REST API Jira и отдельный комментарий.
+        # temporary_ids - id уже загруженных во временное хранилище файлов (wait_temporary_ids)
+        issue_key = self.project_key + '-' + str(claim_number)
+        comment_text = attachments_comment(attachments)
         try:
-            files = {
-                "file": ("photo.jpg", downloaded_file, "image/jpeg")
-            }
-            issue_key = self.jira.issue(self.project_key + '-' + str(claim_number))
-            url = f"{self.domain}rest/api/2/issue/{issue_key}/attachments"
-            response = requests.post(url, headers=self.headers, files=files)
-            response.raise_for_status()
-        #     return response.json()
-        #     response = self.jira.add_attachment(issue=issue, attachment=downloaded_file, filename=filename)
-        #     return response
-            attachment = response.json()[0]
-            print('attachment = ', attachment)
-
-            comment_text = f"Вложенная фотография:\n\n!{attachment['filename']}!"
-            print('comment_text = ', comment_text)
-
-            comment_url = f"{self.domain}rest/api/2/issue/{issue_key}/comment"
-            comment_data = {
-                "body": comment_text
-            }
-            comment_response = requests.post(comment_url, json=comment_data, headers=self.headers)
-            print('comment_response = ', comment_response)
+            temporary_ids = self.upload_temporary_files(attachments, temporary_ids)
+            result = self.attach_to_request(issue_key, flatten_temporary_ids(temporary_ids), comment_text)
+            issue_snapshots.invalidate(issue_key)
+            return result
+        except Exception as e:
+            print(f"Не удалось прикрепить вложения через Service Desk, загружаем напрямую: {e}")
+        try:
+            url = self.domain.rstrip("/") + f"/rest/api/2/issue/{issue_key}/attachments"
+            if not self.upload_attachments(url, attachments):
+                print("Вложение не загружено")
+                return None
+            comment_url = self.domain.rstrip("/") + f"/rest/api/2/issue/{issue_key}/comment"
+            comment_response = self.session.post(comment_url, json={"body": comment_text}, headers=self.headers, timeout=self.timeout)
             comment_response.raise_for_status()
+            issue_snapshots.invalidate(issue_key)
             return comment_response.json()
         except Exception as e:
             print(f"Ошибка при загрузке файла в Jira: {e}")
+            issue_snapshots.invalidate(issue_key)
             return None
 
+    def upload_temporary_files(self, attachments, temporary_ids=None):
+        # Догружает файлы, для которых нет id (None), и ждёт все загрузки; уже загруженные повторно не отправляются.
+        # Если какой-то файл так и не загрузился - исключение
+        temporary_ids = list(temporary_ids or [None] * len(attachments))
+        missing = [index for index, file_ids in enumerate(temporary_ids) if file_ids is None]
+        if missing:
+            uploads = self.submit_temporary_files(self.get_servicedesk_number(), [attachments[index] for index in missing])
+            for index, file_ids in zip(missing, wait_temporary_ids(uploads)):
+                temporary_ids[index] = file_ids
+        if None in temporary_ids:
+            raise RuntimeError(f"Не загружено во временное хранилище файлов: {temporary_ids.count(None)}")
+        return temporary_ids
+
+    def submit_temporary_files(self, service_desk_id, attachments):
+        # Каждый файл - отдельным запросом в общем пуле загрузок: файлы альбома идут параллельно,
+        # а число одновременных загрузок ограничено размером пула
+        return [_upload_executor.submit(self.attach_temporary_files, service_desk_id, [attachment])
+                for attachment in attachments]
+
+    def attach_temporary_files(self, service_desk_id, attachments):
+        url = self.domain.rstrip("/") + f"/rest/servicedeskapi/servicedesk/{service_desk_id}/attachTemporaryFile"
+        response = self.upload_attachments(url, attachments, {"X-ExperimentalApi": "opt-in"})
+        return [item['temporaryAttachmentId'] for item in response['temporaryAttachments']]
+
+    def attach_to_request(self, issue_key, temporary_ids, comment_text):
+        url = self.domain.rstrip("/") + f"/rest/servicedeskapi/request/{issue_key}/attachment"
+        data = {
+            "temporaryAttachmentIds": temporary_ids,
+            "public": True,
+            "additionalComment": {"body": comment_text}
+        }
+        response = self.session.post(url, json=data, headers=dict(self.headers, **{"X-ExperimentalApi": "opt-in"}),
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def upload_attachments(self, url, attachments, extra_headers=None):
+        # MultipartEncoder читает файлы по кускам при отправке; files= в requests собрал бы всё тело запроса в памяти.
+        # SpoolReader не даёт кодировщику вызвать fileno() - небольшие вложения остаются в памяти
+        encoder = MultipartEncoder(fields=[("file", (attachment['filename'], SpoolReader(attachment['file']),
+                                                     attachment['mime_type']))
+                                           for attachment in attachments])
+        headers = dict(self.headers, **{"Content-Type": encoder.content_type}, **(extra_headers or {}))
+        response = self.session.post(url, headers=headers, data=encoder, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_snapshot(self, claim_number):
+        # Снимок заявки из общего кэша; при промахе - заявка без комментариев и отдельно последний комментарий
+        # Снимок - свой для каждого пользователя Jira: последний комментарий зависит от прав токена
+        viewer = self.get_myself_key()
+        snapshot = issue_snapshots.get(claim_number, viewer)
+        if snapshot is not None:
+            return snapshot
+        # Комментарии не запрашиваем вместе с заявкой - у давних заявок их сотни, нужен только последний
+        issue = self.jira.issue(claim_number, fields="status,updated,summary,description,reporter")
+        return issue_snapshots.put(IssueSnapshot(
+            issue.key,
+            issue.fields.status.name,
+            issue.fields.summary,
+            issue.fields.description,
+            issue.fields.updated, #.split('.')[0],
+            issue.fields.reporter.raw.get('key') if issue.fields.reporter else None,
+            self.get_last_comment(issue.key)
+        ), viewer)
+
     def check_claim_status(self, claim_number, username):
         try:
-            issue = self.jira.issue(claim_number)
-            if issue.fields.reporter.raw['key'] == self.jira.myself()['key']:     #self.jira.myself().get("accountId"):
-                comments = issue.fields.comment.comments
-                if comments:
-                    last_comment = comments[-1].body
-                    last_comment_author = comments[-1].author.displayName
-                    last_comment_created = comments[-1].created #.split('.')[0]
-                    last_comment_id = int(comments[-1].id)
-                else:
-                    last_comment = None
-                    last_comment_author = None
-                    last_comment_created = None
-                    last_comment_id = 0
+            snapshot = self.get_snapshot(claim_number)
+            if snapshot.reporter == self.get_myself_key():     #self.jira.myself().get("accountId"):
                 print('Проверили статус заявки')
-                return {
-                    'status': issue.fields.status.name,
-                    'last_update': issue.fields.updated, #.split('.')[0],
-                    'summary': issue.fields.summary,
-                    'description': issue.fields.description,
-                    'last_comment': {
-                        'text': last_comment,
-                        'author': last_comment_author,
-                        'created': last_comment_created,
-                        'id': last_comment_id
-                    } if last_comment else None
-                }
+                return snapshot.claim_info()
             else:
                 return {
                     'error': 'Не ваша заявка'
                 }
-        except JIRAError as e:
+        except (JIRAError, requests.RequestException) as e:
             return None
 
+    def get_claims_updates(self, claim_numbers, updated_minutes_ago=None, own_only=True, errors=None, stats=None):
+        # Пакетная проверка подписок: один search_issues на пачку номеров вместо issue()+myself() на каждую заявку.
+        # Чужие заявки отсекаются условием reporter = currentUser() прямо в JQL; с own_only=False возвращаются
+        # все доступные токену заявки, а автор передаётся в 'reporter' для проверки на стороне вызывающего.
+        # Если задан updated_minutes_ago, возвращаются только заявки, изменённые за это время.
+        # Комментарии сюда не входят: новые комментарии изменившейся заявки забираются get_new_comments.
+        # В множество errors (если передано) добавляются заявки, которые этим токеном проверить не удалось,
+        # в stats['searches'] - сколько поисковых запросов на самом деле ушло в Jira
+        updates = {}
+        for i in range(0, len(claim_numbers), self.search_batch_size):
+            batch = claim_numbers[i:i + self.search_batch_size]
+            try:
+                if stats is not None:
+                    stats['searches'] += 1
+                issues = self.jira.search_issues(self.updates_jql(batch, updated_minutes_ago, own_only),
+                                                 fields=self.updates_fields, maxResults=len(batch))
+            except JIRAError as e:
+                # Удалённая или недоступная заявка в key in (...) ломает весь запрос - проверяем пачку поштучно
+                print(f"Ошибка пакетной проверки заявок {batch}: {e}")
+                issues = []
+                if e.status_code in (401, 403):
+                    # токен отозван или без доступа - поштучная проверка даст ту же ошибку
+                    if errors is not None:
+                        errors.update(batch)
+                    continue
+                for claim_number in batch:
+                    try:
+                        if stats is not None:
+                            stats['searches'] += 1
+                        issues.extend(self.jira.search_issues(self.updates_jql([claim_number], updated_minutes_ago, own_only),
+                                                              fields=self.updates_fields, maxResults=1))
+                    except JIRAError as e:
+                        print(f"Ошибка проверки заявки {claim_number}: {e}")
+                        if errors is not None:
+                            errors.add(claim_number)
+            issue_summaries.set_many({issue.key: issue.fields.summary for issue in issues})
+            for issue in issues:
+                issue_snapshots.observe_updated(issue.key, issue.fields.updated)
+                updates[issue.key] = {
+                    'status': issue.fields.status.name,
+                    'last_update': issue.fields.updated,
+                    'summary': issue.fields.summary,
+                    'reporter': issue.fields.reporter.raw.get('key') if issue.fields.reporter else None
+                }
+        return updates
+
+    def updates_jql(self, claim_numbers, updated_minutes_ago=None, own_only=True):
+        jql_query = f"key in ({', '.join(claim_numbers)})"
+        if own_only:
+            jql_query += " AND reporter = currentUser()"
+        if updated_minutes_ago is not None:
+            # Относительное время не зависит от часового пояса пользователя Jira
+            jql_query += f" AND updated >= -{int(updated_minutes_ago)}m"
+        return jql_query
+
+    def comment_info(self, comment):
+        return {
+            'text': comment['body'],
+            'author': comment['author']['displayName'],
+            'created': comment['created'], #.split('.')[0]
+            'id': int(comment['id'])
+        }
+
+    def fetch_comments_page(self, issue_key, start_at=0, max_results=None):
+        # Страница комментариев от новых к старым
+        url = self.domain.rstrip("/") + f'/rest/api/2/issue/{issue_key}/comment'
+        params = {'orderBy': '-created', 'startAt': start_at, 'maxResults': max_results or self.comments_page_size}
+        response = self.session.get(url, params=params, headers=self.headers, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_last_comment(self, issue_key):
+        comments = self.fetch_comments_page(issue_key, max_results=1).get('comments', [])
+        return self.comment_info(comments[0]) if comments else None
+
+    def get_new_comments(self, issue_key, since_id=0):
+        # Комментарии с id больше since_id, от старых к новым. Страницы читаются от новых к старым
+        # и только до первого уже известного комментария
+        new_comments = []
+        start_at = 0
+        while True:
+            data = self.fetch_comments_page(issue_key, start_at)
+            page = data.get('comments', [])
+            for comment in page:
+                if int(comment['id']) <= since_id:
+                    return list(reversed(new_comments))
+                new_comments.append(self.comment_info(comment))
+            start_at += len(page)
+            if not page or start_at >= data.get('total', 0):
+                return list(reversed(new_comments))
+
     def add_comment_to_claim(self, claim_number, username, comment_text):
         try:
             print('claim_number=', claim_number)
-            issue = self.jira.issue(claim_number)
-
-            if issue.fields.reporter.raw['key'] == self.jira.myself()['key']:
-                return self.jira.add_comment(issue, comment_text)
+            # автор заявки обычно уже есть в снимке - отдельный запрос заявки не нужен
+            snapshot = self.get_snapshot(claim_number)
+            if snapshot.reporter == self.get_myself_key():
+                comment = self.jira.add_comment(snapshot.key, comment_text)
+                issue_snapshots.invalidate(snapshot.key)
+                return comment
             else:
                 return None
-        except JIRAError as e:
+        except (JIRAError, requests.RequestException) as e:
             print(e)
             return None
 
-    def get_claims_numbers_and_themes(self):
-        jql_query =  f"reporter = currentUser() AND project = {self.project_key}"
-        issues = self.jira.search_issues(jql_query, maxResults=1000)
+    def get_claims_page(self, start_at=0, max_results=50):
+        # Одна страница заявок пользователя, новые первыми; из полей - только ключ и тема.
+        # Возвращает (заявки страницы, всего заявок)
+        jql_query = f"reporter = currentUser() AND project = {self.project_key} ORDER BY created DESC"
+        issues = self.jira.search_issues(jql_query, startAt=start_at, maxResults=max_results, fields="key,summary")
         claims = []
         for issue in issues:
             number = issue.key #int(issue.key.split('-')[1])
             theme = issue.fields.summary
             claims.append({'number': number, 'theme': theme})
-        return list(reversed(claims))
+        issue_summaries.set_many({claim['number']: claim['theme'] for claim in claims})
+        return claims, issues.total
 
     def get_theme_by_number(self, claim_number):
+        theme = issue_summaries.get(claim_number)
+        if theme is not None:
+            return theme
         try:
-            issue = self.jira.issue(claim_number)
+            issue = self.jira.issue(claim_number, fields="summary")
             theme = issue.fields.summary
+            issue_summaries.set(claim_number, theme)
             return theme
         except JIRAError as e:
             print(e)
             return None
 
+    def get_themes_by_numbers(self, claim_numbers):
+        # Темы нескольких заявок: из общего кэша, недостающие - одним search_issues на пачку вместо issue() на каждую.
+        # Возвращает {номер: тема}; для недоступных заявок тема None
+        themes = issue_summaries.get_many(claim_numbers)
+        missing = [claim_number for claim_number in claim_numbers if claim_number not in themes]
+        for i in range(0, len(missing), self.search_batch_size):
+            batch = missing[i:i + self.search_batch_size]
+            try:
+                issues = self.jira.search_issues(f"key in ({', '.join(batch)})", fields="summary", maxResults=len(batch))
+            except JIRAError as e:
+                # удалённая заявка в key in (...) ломает весь запрос - добираем пачку поштучно
+                print(f"Ошибка получения тем заявок {batch}: {e}")
+                themes.update({claim_number: self.get_theme_by_number(claim_number) for claim_number in batch})
+                continue
+            found = {issue.key: issue.fields.summary for issue in issues}
+            issue_summaries.set_many(found)
+            themes.update(found)
+        return {claim_number: themes.get(claim_number) for claim_number in claim_numbers}
+
     # def get_claim_status_by_number(self, claim_number):
     #     return self.domain.rstrip("/") + '/browse/' + claim_number
 
     def get_servicedesk_number(self):
-        response = requests.get(self.domain.rstrip("/") + '/rest/servicedeskapi/servicedesk', headers=self.headers)
+        return jira_metadata.get(self)['service_desk_id']
+
+    def fetch_servicedesk_number(self):
+        response = self.session.get(self.domain.rstrip("/") + '/rest/servicedeskapi/servicedesk', headers=self.headers, timeout=self.timeout)
         if response:
             data = response.json()
             for item in data['values']:
@@ -236,26 +538,38 @@ class JiraClient():
 
     def get_user_id(self):
         try:
-            print('self.jira.myself().get("key") = ', self.jira.myself().get("key"))
-            return self.jira.myself().get("key")
+            user_id = self.get_myself().get("key")
+            print('self.jira.myself().get("key") = ', user_id)
+            return user_id
         except JIRAError as e:
             print(e)
             return None
 
     def get_user_email(self):
-        user = self.jira.myself()
+        user = self.get_myself()
         print("Email:", user.get('emailAddress'))
         return user.get('emailAddress')
 
+    def get_myself(self):
+        # key, accountId, emailAddress текущего пользователя - один запрос на всё время жизни клиента
+        with self.myself_lock:
+            if self.myself is None:
+                self.myself = self.jira.myself()
+            return self.myself
+
+    def get_myself_key(self):
+        if self.jira_user_id:
+            return str(self.jira_user_id)
+        return self.get_myself().get('key')
+
     def clear_token(self):
         if hasattr(self.jira, '_session'):
             self.jira._session.headers.pop('Authorization', None)
 
     def logout(self):
+        # Сессии не закрываем: их адаптер - общий пул соединений, закрытие оборвало бы соединения остальных клиентов
         del self.headers
         self.clear_token()
-        if hasattr(self.jira, '_session'):
-            self.jira._session.close()
 
     def readable_time(self, original_time):
         return datetime.strptime(original_time, "%Y-%m-%dT%H:%M:%S.%f%z")
@@ -276,6 +590,58 @@ class JiraClient():
     #     print(response)
 
 
+# Клиенты Jira кэшируются по токену (LRU): согласование с сервером при создании JIRA и TLS-рукопожатия -
+# один раз на токен, а не на каждое нажатие кнопки. В ключе - хэш, а не сам токен
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+_clients_max_size = int(os.environ.get("JIRA_CLIENT_CACHE_SIZE", 200))
+
+
+def _client_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def get_jira_client(token, jira_user_id=None):
+    # jira_user_id - key пользователя Jira из Supabase (FIELD_JIRA_ID), если он уже известен
+    key = _client_key(token)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            if jira_user_id and not client.jira_user_id:
+                client.jira_user_id = jira_user_id
+            return client
+    client = JiraClient(token, jira_user_id)
+    with _clients_lock:
+        # пока создавали клиента, его мог создать и положить другой поток
+        existing = _clients.get(key)
+        if existing is not None:
+            _clients.move_to_end(key)
+            return existing
+        _clients[key] = client
+        while len(_clients) > _clients_max_size:
+            # Вытесненный клиент может ещё работать в другом месте (опрос подписок, постраничный список заявок),
+            # поэтому из кэша убирается только ссылка; logout - только при сбросе токена в forget_*
+            _clients.popitem(last=False)
+    return client
+
+
+def current_jira_client(domain, project_key):
+    # Недавно использованный клиент из кэша - для фоновых запросов, не привязанных к пользователю
+    with _clients_lock:
+        for client in reversed(_clients.values()):
+            if client.domain == domain and client.project_key == project_key:
+                return client
+    return None
+
+
+def forget_jira_client(token):
+    with _clients_lock:
+        client = _clients.pop(_client_key(token), None)
+    if client is not None:
+        client.logout()
+
+
 if __name__ == "__main__":
     TOKEN = ''
     jira_client = JiraClient(TOKEN)
@@ -0,0 +1,396 @@
+from dotenv import load_dotenv
+from collections import OrderedDict
+import asyncio
+import hashlib
+import os
+import aiohttp
+from jira_client import jira_metadata, make_attachment, attachments_comment, flatten_temporary_ids
+from file_spool import read_chunks
+from issue_cache import issue_summaries, issue_snapshots, IssueSnapshot
+
+load_dotenv()
+
+# Общая для всех асинхронных клиентов сессия aiohttp с пулом соединений к Jira.
+# Создаётся лениво внутри работающего цикла событий, заголовки авторизации передаются в каждом запросе
+_session = None
+_upload_limit = None
+
+
+def get_http_session():
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=int(os.environ.get("JIRA_POOL_SIZE", 20)),
+                                         keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=float(os.environ.get("JIRA_TIMEOUT", 30)))
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+def get_upload_limit():
+    global _upload_limit
+    if _upload_limit is None:
+        _upload_limit = asyncio.Semaphore(int(os.environ.get("JIRA_UPLOAD_WORKERS", 4)))
+    return _upload_limit
+
+
+async def close_http_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+class AsyncJiraClient:
+    # Асинхронный аналог JiraClient для main_async.py: те же методы, но запросы через aiohttp,
+    # поэтому обращения к Jira не блокируют цикл событий бота
+    def __init__(self, token, jira_user_id=None):
+        load_dotenv()
+        self.headers = {
+            "X-Atlassian-Token": "no-check",
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/json"
+        }
+        self.domain = os.environ.get("GIRA_DOMAIN")
+        self.project_key = os.environ.get("GIRA_PROJECT_KEY")
+        self.typetask_field_1 = os.environ.get("GIRA_TYPETASK_FIELD_1")
+        self.typetask_field_2 = os.environ.get("GIRA_TYPETASK_FIELD_2")
+        self.jira_user_id = jira_user_id
+        self.myself = None
+
+    def url(self, path):
+        return self.domain.rstrip("/") + '/' + path.lstrip("/")
+
+    async def request(self, method, path, extra_headers=None, **kwargs):
+        headers = dict(self.headers, **extra_headers) if extra_headers else self.headers
+        async with get_http_session().request(method, self.url(path), headers=headers, **kwargs) as response:
+            response.raise_for_status()
+            if response.status == 204:
+                return None
+            return await response.json()
+
+    async def create_claim(self, username, claim_data):
+        serviceDeskId = await self.get_servicedesk_number()
+        request_type_id = await self.get_request_type_id(claim_data['type'], serviceDeskId)
+        if claim_data.get('text') and claim_data['type'] == self.typetask_field_1:
+            data = {
+                'serviceDeskId': serviceDeskId,
+                'requestTypeId': request_type_id,
+                'requestFieldValues': {
+                    'summary': claim_data['theme'],
+                    'description': claim_data['text'],
+                    'priority': {"name": claim_data['priority']}
+                }
+            }
+        elif not claim_data.get('text') and claim_data['type'] == self.typetask_field_2:
+            data = {
+                'serviceDeskId': serviceDeskId,
+                'requestTypeId': request_type_id,
+                'requestFieldValues': {
+                    'summary': claim_data['theme'],
+                    'priority': {"name": claim_data['priority']}
+                }
+            }
+        try:
+            new_issue = await self.request("POST", "rest/servicedeskapi/request", json=data)
+            print(new_issue)
+            return new_issue
+        except Exception as e:
+            print(f"Error creating claim for user '{username}': {str(e)}")
+            return None
+
+    async def get_metadata(self):
+        # Кэш метаданных общий с синхронным клиентом, при промахе загружаем асинхронно
+        entry = jira_metadata.fresh_entry(self.domain, self.project_key)
+        if entry is None:
+            service_desk_id = await self.fetch_servicedesk_number()
+            request_types = await self.fetch_request_types(service_desk_id) if service_desk_id else {}
+            entry = jira_metadata.store(self.domain, self.project_key, service_desk_id, request_types)
+        return entry
+
+    async def get_servicedesk_number(self):
+        return (await self.get_metadata())['service_desk_id']
+
+    async def get_request_type_id(self, request_type_name, serviceDeskId):
+        request_types = (await self.get_metadata())['request_types']
+        if request_type_name not in request_types:
+            request_types = await self.fetch_request_types(serviceDeskId)
+            jira_metadata.store(self.domain, self.project_key, serviceDeskId, request_types)
+        return request_types.get(request_type_name)
+
+    async def fetch_servicedesk_number(self):
+        data = await self.request("GET", "rest/servicedeskapi/servicedesk")
+        for item in data['values']:
+            if item.get('projectKey') == self.project_key:
+                return item.get('_links').get('portal').split('/')[-1]
+        return None
+
+    async def fetch_request_types(self, serviceDeskId):
+        data = await self.request("GET", f"rest/servicedeskapi/servicedesk/{serviceDeskId}/requesttype")
+        return {rt.get("name"): rt.get("id") for rt in data.get("values", [])}
+
+    async def add_attachment_to_claim(self, claim_number, downloaded_file, filename):
+        return await self.add_attachments_to_claim(claim_number, [make_attachment(downloaded_file, filename)])
+
+    async def add_photo_to_claim(self, claim_number, downloaded_file, filename):
+        return await self.add_attachments_to_claim(claim_number, [make_attachment(downloaded_file, "photo.jpg", image=True)])
+
+    async def create_claim_with_attachments(self, username, claim_data, attachments):
+        # То же, что JiraClient.create_claim_with_attachments: временная загрузка файлов идёт одновременно с созданием заявки
+        service_desk_id = await self.get_servicedesk_number()
+        new_issue, temporary_ids = await asyncio.gather(self.create_claim(username, claim_data),
+                                                        self.attach_temporary_files(service_desk_id, attachments),
+                                                        return_exceptions=True)
+        if isinstance(temporary_ids, Exception):
+            print(f"Ошибка загрузки временных вложений: {temporary_ids}")
+            temporary_ids = None
+        if not new_issue or isinstance(new_issue, Exception):
+            return None, None
+        claim_number = new_issue['issueKey'].split('-')[-1]
+        return new_issue, await self.add_attachments_to_claim(claim_number, attachments, temporary_ids)
+
+    async def add_attachments_to_claim(self, claim_number, attachments, temporary_ids=None):
+        issue_key = self.project_key + '-' + str(claim_number)
+        comment_text = attachments_comment(attachments)
+        try:
+            temporary_ids = await self.upload_temporary_files(attachments, temporary_ids)
+            result = await self.attach_to_request(issue_key, flatten_temporary_ids(temporary_ids), comment_text)
+            issue_snapshots.invalidate(issue_key)
+            return result
+        except Exception as e:
+            print(f"Не удалось прикрепить вложения через Service Desk, загружаем напрямую: {e}")
+        try:
+            if not await self.upload_attachments(f"rest/api/2/issue/{issue_key}/attachments", attachments):
+                print("Вложение не загружено")
+                return None
+            result = await self.add_comment(issue_key, comment_text)
+            issue_snapshots.invalidate(issue_key)
+            return result
+        except Exception as e:
+            print(f"Ошибка при загрузке файла в Jira: {e}")
+            issue_snapshots.invalidate(issue_key)
+            return None
+
+    async def upload_temporary_files(self, attachments, temporary_ids=None):
+        # Как JiraClient.upload_temporary_files: догружаются только файлы без id, исключение - если какой-то не загрузился
+        temporary_ids = list(temporary_ids or [None] * len(attachments))
+        missing = [index for index, file_ids in enumerate(temporary_ids) if file_ids is None]
+        if missing:
+            uploads = await self.attach_temporary_files(await self.get_servicedesk_number(),
+                                                        [attachments[index] for index in missing])
+            for index, file_ids in zip(missing, uploads):
+                temporary_ids[index] = file_ids
+        if None in temporary_ids:
+            raise RuntimeError(f"Не загружено во временное хранилище файлов: {temporary_ids.count(None)}")
+        return temporary_ids
+
+    async def attach_temporary_files(self, service_desk_id, attachments):
+        # Каждый файл - отдельным запросом, параллельно, не больше JIRA_UPLOAD_WORKERS одновременно.
+        # gather ждёт все загрузки и после ошибки одной из них; возвращает id по файлам, None - файл не загружен
+        uploads = await asyncio.gather(*(self.attach_temporary_file(service_desk_id, attachment)
+                                         for attachment in attachments), return_exceptions=True)
+        temporary_ids = []
+        for upload in uploads:
+            if isinstance(upload, Exception):
+                print(f"Ошибка загрузки временного вложения: {upload}")
+                upload = None
+            temporary_ids.append(upload)
+        return temporary_ids
+
+    async def attach_temporary_file(self, service_desk_id, attachment):
+        async with get_upload_limit():
+            response = await self.upload_attachments(f"rest/servicedeskapi/servicedesk/{service_desk_id}/attachTemporaryFile",
+                                                     [attachment], {"X-ExperimentalApi": "opt-in"})
+        return [item['temporaryAttachmentId'] for item in response['temporaryAttachments']]
+
+    async def attach_to_request(self, issue_key, temporary_ids, comment_text):
+        return await self.request("POST", f"rest/servicedeskapi/request/{issue_key}/attachment", json={
+            "temporaryAttachmentIds": temporary_ids,
+            "public": True,
+            "additionalComment": {"body": comment_text}
+        }, extra_headers={"X-ExperimentalApi": "opt-in"})
+
+    async def upload_attachments(self, path, attachments, extra_headers=None):
+        form = aiohttp.FormData()
+        for attachment in attachments:
+            # файл передаётся кусками из временного файла, а не одним bytes в памяти
+            form.add_field("file", read_chunks(attachment['file']), filename=attachment['filename'],
+                           content_type=attachment['mime_type'])
+        return await self.request("POST", path, data=form, extra_headers=extra_headers)
+
+    async def add_comment(self, issue_key, comment_text):
+        return await self.request("POST", f"rest/api/2/issue/{issue_key}/comment", json={"body": comment_text})
+
+    async def get_issue(self, claim_number, fields):
+        return await self.request("GET", f"rest/api/2/issue/{claim_number}", params={"fields": fields})
+
+    async def get_snapshot(self, claim_number):
+        # Снимок заявки из общего с синхронным клиентом кэша; при промахе - заявка без комментариев и последний комментарий
+        # Снимок - свой для каждого пользователя Jira: последний комментарий зависит от прав токена
+        viewer = await self.get_myself_key()
+        snapshot = issue_snapshots.get(claim_number, viewer)
+        if snapshot is not None:
+            return snapshot
+        # Комментарии не запрашиваем вместе с заявкой - нужен только последний
+        issue = await self.get_issue(claim_number, "status,updated,summary,description,reporter")
+        fields = issue['fields']
+        return issue_snapshots.put(IssueSnapshot(
+            issue['key'],
+            fields['status']['name'],
+            fields['summary'],
+            fields.get('description'),
+            fields['updated'],
+            (fields.get('reporter') or {}).get('key'),
+            await self.get_last_comment(issue['key'])
+        ), viewer)
+
+    async def check_claim_status(self, claim_number, username):
+        try:
+            snapshot = await self.get_snapshot(claim_number)
+            if snapshot.reporter != await self.get_myself_key():
+                return {
+                    'error': 'Не ваша заявка'
+                }
+            return snapshot.claim_info()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(e)
+            return None
+
+    def comment_info(self, comment):
+        return {
+            'text': comment['body'],
+            'author': comment['author']['displayName'],
+            'created': comment['created'],
+            'id': int(comment['id'])
+        }
+
+    async def get_last_comment(self, issue_key):
+        data = await self.request("GET", f"rest/api/2/issue/{issue_key}/comment",
+                                  params={"orderBy": "-created", "startAt": 0, "maxResults": 1})
+        comments = data.get('comments', [])
+        return self.comment_info(comments[0]) if comments else None
+
+    async def add_comment_to_claim(self, claim_number, username, comment_text):
+        try:
+            snapshot = await self.get_snapshot(claim_number)
+            if snapshot.reporter == await self.get_myself_key():
+                comment = await self.add_comment(snapshot.key, comment_text)
+                issue_snapshots.invalidate(snapshot.key)
+                return comment
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(e)
+            return None
+
+    async def search_issues(self, jql_query, fields="summary", max_results=50, start_at=0):
+        issues, _ = await self.search_page(jql_query, fields, max_results, start_at)
+        return issues
+
+    async def search_page(self, jql_query, fields="summary", max_results=50, start_at=0):
+        data = await self.request("POST", "rest/api/2/search", json={
+            "jql": jql_query,
+            "fields": fields.split(","),
+            "maxResults": max_results,
+            "startAt": start_at
+        })
+        return data.get("issues", []), data.get("total", 0)
+
+    async def get_claims_page(self, start_at=0, max_results=50):
+        # Одна страница заявок пользователя, новые первыми; из полей - только ключ и тема
+        jql_query = f"reporter = currentUser() AND project = {self.project_key} ORDER BY created DESC"
+        issues, total = await self.search_page(jql_query, fields="key,summary", max_results=max_results, start_at=start_at)
+        claims = [{'number': issue['key'], 'theme': issue['fields']['summary']} for issue in issues]
+        issue_summaries.set_many({claim['number']: claim['theme'] for claim in claims})
+        return claims, total
+
+    async def get_theme_by_number(self, claim_number):
+        theme = issue_summaries.get(claim_number)
+        if theme is not None:
+            return theme
+        try:
+            issue = await self.get_issue(claim_number, "summary")
+            issue_summaries.set(claim_number, issue['fields']['summary'])
+            return issue['fields']['summary']
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(e)
+            return None
+
+    async def get_themes_by_numbers(self, claim_numbers):
+        # Как JiraClient.get_themes_by_numbers: кэш, затем один поиск key in (...) на недостающие
+        themes = issue_summaries.get_many(claim_numbers)
+        missing = [claim_number for claim_number in claim_numbers if claim_number not in themes]
+        for i in range(0, len(missing), 50):
+            batch = missing[i:i + 50]
+            try:
+                issues = await self.search_issues(f"key in ({', '.join(batch)})", fields="summary", max_results=len(batch))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Ошибка получения тем заявок {batch}: {e}")
+                for claim_number in batch:
+                    themes[claim_number] = await self.get_theme_by_number(claim_number)
+                continue
+            found = {issue['key']: issue['fields']['summary'] for issue in issues}
+            issue_summaries.set_many(found)
+            themes.update(found)
+        return {claim_number: themes.get(claim_number) for claim_number in claim_numbers}
+
+    async def get_claim_link_by_number(self, claim_number):
+        servivedesk_number = await self.get_servicedesk_number()
+        if servivedesk_number:
+            return self.domain.rstrip("/") + '/servicedesk/customer/portal/' + servivedesk_number + '/' + self.project_key + '-' + str(claim_number)
+        return None
+
+    async def get_myself(self):
+        if self.myself is None:
+            self.myself = await self.request("GET", "rest/api/2/myself")
+        return self.myself
+
+    async def get_myself_key(self):
+        if self.jira_user_id:
+            return str(self.jira_user_id)
+        return (await self.get_myself()).get('key')
+
+    async def get_user_id(self):
+        try:
+            return (await self.get_myself()).get("key")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(e)
+            return None
+
+    async def get_user_email(self):
+        return (await self.get_myself()).get('emailAddress')
+
+    def logout(self):
+        # Сессия общая для всех клиентов - убираем только токен
+        self.headers.pop('Authorization', None)
+
+
+# Клиенты кэшируются по хэшу токена так же, как синхронные (jira_client.get_jira_client)
+_clients = OrderedDict()
+_clients_max_size = int(os.environ.get("JIRA_CLIENT_CACHE_SIZE", 200))
+
+
+def _client_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def get_async_jira_client(token, jira_user_id=None):
+    # Вызывается только из цикла событий, поэтому блокировка не нужна
+    key = _client_key(token)
+    client = _clients.get(key)
+    if client is not None:
+        _clients.move_to_end(key)
+        if jira_user_id and not client.jira_user_id:
+            client.jira_user_id = jira_user_id
+        return client
+    client = AsyncJiraClient(token, jira_user_id)
+    _clients[key] = client
+    while len(_clients) > _clients_max_size:
+        # Вытесненный клиент может ещё работать в другом месте (опрос подписок, постраничный список заявок),
+        # поэтому из кэша убирается только ссылка; logout - только при сбросе токена в forget_*
+        _clients.popitem(last=False)
+    return client
+
+
+def forget_async_jira_client(token):
+    client = _clients.pop(_client_key(token), None)
+    if client is not None:
+        client.logout()
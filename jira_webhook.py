@@ -0,0 +1,103 @@
+from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hmac
+import os
+import threading
+from aiohttp import web
+
+load_dotenv()
+
+# Вебхук Jira включается отдельно от вебхука Telegram; пока он включён, обход подписок нужен только для сверки
+# (пропущенные или не дошедшие события) и выполняется раз в JIRA_WEBHOOK_RECONCILE_MINUTES
+JIRA_WEBHOOK_ENABLED = os.environ.get("JIRA_WEBHOOK_ENABLED", "false").lower() in ("1", "true", "yes")
+RECONCILE_MINUTES = float(os.environ.get("JIRA_WEBHOOK_RECONCILE_MINUTES", 30))
+
+JIRA_EVENTS = ('jira:issue_updated', 'comment_created')
+
+
+class JiraWebhookServer:
+    # Приём событий Jira (изменение заявки, новый комментарий). Запрос сразу получает ответ, событие обрабатывается
+    # в пуле потоков блокирующим handle_event. Несколько событий одной заявки, пришедших до начала её обработки,
+    # склеиваются в одно - Jira присылает и issue_updated, и comment_created на каждый комментарий.
+    # Jira Server не умеет добавлять свои заголовки, поэтому секрет передаётся параметром ?secret= в адресе вебхука
+    def __init__(self, handle_event):
+        self.handle_event = handle_event   # handle_event(event: dict), вызывается в потоке пула
+        self.host = os.environ.get("JIRA_WEBHOOK_HOST", "0.0.0.0")
+        self.port = int(os.environ.get("JIRA_WEBHOOK_PORT", 8081))
+        self.path = os.environ.get("JIRA_WEBHOOK_PATH", "/jira/webhook")
+        self.secret = os.environ.get("JIRA_WEBHOOK_SECRET")
+        self.workers = int(os.environ.get("JIRA_WEBHOOK_WORKERS", 4))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="jira-webhook")
+        self.pending = set()   # заявки, события которых приняты, но ещё не начали обрабатываться
+        self.pending_lock = threading.Lock()
+        self.runner = None
+        self.stats = {'accepted': 0, 'coalesced': 0, 'ignored': 0, 'processed': 0, 'failed': 0}
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_request)
+        app.router.add_get(self.path + '/health', self.handle_health)
+        return app
+
+    async def start(self):
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        print(f"Вебхук Jira слушает {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        self.executor.shutdown(wait=False)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    def start_in_thread(self):
+        # Для синхронного бота: сервер работает в собственном цикле событий в фоновом потоке
+        thread = threading.Thread(target=lambda: asyncio.run(self.serve_forever()), name="jira-webhook", daemon=True)
+        thread.start()
+        return thread
+
+    async def handle_request(self, request):
+        if self.secret and not hmac.compare_digest(request.query.get('secret', ''), self.secret):
+            return web.Response(status=401)
+        try:
+            event = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        self.accept(event)
+        return web.Response(status=200)
+
+    async def handle_health(self, request):
+        return web.json_response({'pending': len(self.pending), **self.stats})
+
+    def accept(self, event):
+        claim_number = (event.get('issue') or {}).get('key')
+        if event.get('webhookEvent') not in JIRA_EVENTS or not claim_number:
+            self.stats['ignored'] += 1
+            return
+        with self.pending_lock:
+            if claim_number in self.pending:
+                self.stats['coalesced'] += 1
+                return
+            self.pending.add(claim_number)
+        self.stats['accepted'] += 1
+        self.executor.submit(self.process, claim_number, event)
+
+    def process(self, claim_number, event):
+        # заявка убирается из ожидающих до обработки: событие, пришедшее во время неё, обработается ещё раз
+        with self.pending_lock:
+            self.pending.discard(claim_number)
+        try:
+            self.handle_event(event)
+            self.stats['processed'] += 1
+        except Exception as e:
+            self.stats['failed'] += 1
+            print(f"Ошибка обработки события Jira {event.get('webhookEvent')} по заявке {claim_number}: {e}")
@@ -1,8 +1,8 @@
 import jira
 import telebot
-import schedule
 import threading
-from telebot import types
+from concurrent.futures import ThreadPoolExecutor, Future
+from telebot import types, apihelper
 import os
 import re
 import time
@@ -10,10 +10,15 @@ from datetime import datetime
 import pytz
 import requests
 import asyncio
-from io import BytesIO
 from dotenv import load_dotenv
-from supabase_client import SupabaseClient
-from jira_client import JiraClient
+from supabase_client import get_supabase_client
+from jira_client import JiraClient, get_jira_client, forget_jira_client, make_attachment
+from subscription_poller import SubscriptionPoller
+from session_store import SessionStore
+from webhook_server import WebhookServer
+from jira_webhook import JiraWebhookServer, JIRA_WEBHOOK_ENABLED, RECONCILE_MINUTES
+from notification_dispatcher import NotificationDispatcher
+from file_spool import spooled_file, copy_chunks, CHUNK_SIZE
 
 # Регистрация пользователей в БД с нашей стороны, ФИО, имейл, телефон, компания.
 # Пользователь из БД бота совпадает с пользователем джиры, под соответствующих акком джиры создается заявка в том или ином проекте
@@ -34,7 +39,7 @@ class TelegramBot:
     def __init__(self):
         load_dotenv(override=True)
         self.TG_TOKEN = os.getenv("TG_TOKEN")
-        self.bot = telebot.TeleBot(self.TG_TOKEN)
+        self.bot = telebot.TeleBot(self.TG_TOKEN, threaded=True, num_threads=int(os.environ.get("BOT_WORKERS", 8)))
         self.low_priority = os.environ.get("LOW_PRIORITY")
         self.middle_priority = os.environ.get("MIDDLE_PRIORITY")
         self.high_priority = os.environ.get("HIGH_PRIORITY")
@@ -57,14 +62,23 @@ class TelegramBot:
         self.gira_project_key = os.environ.get("GIRA_PROJECT_KEY")
 
         self.buttons_per_page = 50
-        self.list_of_claims = []
+        # Данные диалогов хранятся по (чат, пользователь), а не в полях бота, поэтому обновления
+        # разных пользователей можно обрабатывать параллельно в пуле потоков pyTelegramBotAPI
+        self.sessions = SessionStore()
+        # сколько ждать следующую часть альбома и сколько частей скачивать одновременно
+        self.album_debounce = float(os.environ.get("ALBUM_DEBOUNCE", 1.0))
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="claims-prefetch")
+        self.download_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("ATTACHMENT_DOWNLOAD_WORKERS", 4)),
+                                                    thread_name_prefix="tg-download")
 
-        self.username = None
         self.register_handlers()
+        # Уведомления подписчикам отправляются через очередь с ограничением скорости, а не прямо из потока опроса
+        self.notifications = NotificationDispatcher(self.send_notification)
+        self.notifications.start()
+        # С вебхуком Jira изменения приходят сразу, обход подписок остаётся редкой сверкой
+        self.subscription_poller = SubscriptionPoller(self.notifications.enqueue,
+                                                      RECONCILE_MINUTES * 60 if JIRA_WEBHOOK_ENABLED else None)
         self.start_polling_scheduler()
-        self.reg_data = {}
-        self.attachment = None
-        self.photo = None
 
     def register_handlers(self):
         # Обработчики команд
@@ -76,6 +90,7 @@ class TelegramBot:
         self.bot.callback_query_handler(func=lambda call: True)(self.handle_query)
 
     def start(self, message):
+        session = self.get_session(message)
         # Удаляем все зарегистрированные обработчики, чтобы прервать текущую регистрацию или другой процесс.
         self.bot.clear_step_handler_by_chat_id(message.chat.id)
         if not message.chat.username:
@@ -84,8 +99,7 @@ class TelegramBot:
             self.bot.send_message(message.chat.id, f"Привет, {message.chat.first_name}!")
         else:
             self.bot.send_message(message.chat.id, f"Привет, {message.chat.username}!")
-        self.username = message.from_user.id
-        self.create_keyboard(message.chat.id, self.username)
+        self.create_keyboard(message.chat.id, session.user_id)
 
     def send_help(self, message):
         self.bot.send_message(message.chat.id,
@@ -114,8 +128,6 @@ class TelegramBot:
         else:
             button_reg = types.InlineKeyboardButton('Регистрация пользователя', callback_data='button_reg')
             markup.add(button_reg)
-        supabase_client.logout()
-        self.supabase_client = None
         self.bot.send_message(chat_id, "Выберите одну из кнопок:", reply_markup=markup)
 
     def priority_keyboard(self, chat_id):
@@ -146,8 +158,7 @@ class TelegramBot:
         self.bot.send_message(chat_id, "Хотите загрузить документ или фотографию для заявки?", reply_markup=markup)
 
     def handle_query(self, call):
-        user = call.from_user
-        self.username = user.id
+        session = self.get_call_session(call)
 
         if call.data == 'button_reset_reg':
             self.bot.answer_callback_query(call.id, "Вы нажали Сбросить регистрацию")
@@ -159,41 +170,38 @@ class TelegramBot:
 
         elif call.data == 'button_create_claim':
             self.bot.answer_callback_query(call.id, "Вы нажали Оставить заявку")
-            self.claim_data = {}
+            session.claim_data = {}
             supabase_client = self.initialize_supabase_client()
-            if supabase_client.check_user(self.username):
+            if supabase_client.check_user(session.user_id):
                 self.bot.send_message(call.message.chat.id,
                                       "Вы выбрали оставить заявку. Выберите приоритет заявки:")
                 self.priority_keyboard(call.message.chat.id)
                 # self.bot.register_next_step_handler(call.message, self.process_claim_priority)
             else:
                 self.bot.send_message(call.message.chat.id, "Нет регистрации или токен недействителен")
-            supabase_client.logout()
-            self.supabase_client = None
 
         elif call.data == 'button_all_claims':
-            self.list_of_claims = []
+            session.reset_claims_list()
             self.bot.answer_callback_query(call.id, "Вы нажали Проверить статус заявки")
             supabase_client = self.initialize_supabase_client()
-            if supabase_client.check_user(self.username):
+            if supabase_client.check_user(session.user_id):
                 self.bot.send_message(call.message.chat.id, "Вы выбрали посмотреть все открытые заявки")
-                jira_token = supabase_client.get_token_from_supabase(self.username)
+                jira_token = supabase_client.get_token_from_supabase(session.user_id)
                 if jira_token:
-                    jira_client = JiraClient(jira_token)
+                    jira_client = get_jira_client(jira_token)
                     del jira_token
-                    self.list_of_claims = jira_client.get_claims_numbers_and_themes()
-                    jira_client.logout()
-                    if self.list_of_claims:
+                    # заявки загружаются постранично по мере листания, а не вся история сразу
+                    session.reset_claims_list(jira_client)
+                    _, total = self.claims_page(session, 0)
+                    if total:
                         self.keyboard_list_of_claims(call, 0)
                     else:
                         self.bot.send_message(call.message.chat.id, "У вас нет созданных заявок")
-                        self.create_keyboard(call.message.chat.id, self.username)
+                        self.create_keyboard(call.message.chat.id, session.user_id)
                 else:
                     self.bot.send_message(call.message.chat.id, "Нет регистрации или токен недействителен")
             else:
                 self.bot.send_message(call.message.chat.id, "Нет регистрации или токен недействителен")
-            supabase_client.logout()
-            self.supabase_client = None
 
         elif call.data == 'button_check_claim':
             # посмотреть статус конкретной заявки
@@ -221,7 +229,7 @@ class TelegramBot:
         #     self.process_claim_type(call, self.typetask_field_3)
 
         elif call.data == 'main_menu_button':
-            self.create_keyboard(call.message.chat.id, self.username)
+            self.create_keyboard(call.message.chat.id, session.user_id)
 
         elif call.data.startswith('claim_'):
             number = call.data.split('_')[1]
@@ -261,7 +269,7 @@ class TelegramBot:
 
         elif call.data.startswith("reset_no"):
             self.bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
-            self.create_keyboard(call.message.chat.id, self.username)
+            self.create_keyboard(call.message.chat.id, session.user_id)
 
     def reset_keyboard(self, chat_id):
         markup = types.InlineKeyboardMarkup()
@@ -271,32 +279,38 @@ class TelegramBot:
         self.bot.send_message(chat_id, "Вы уверены, что хотите сбросить регистрацию?", reply_markup=markup)
 
     def reset_registration(self, message):
+        session = self.get_session(message)
         if not self.if_start(message) and not self.if_help(message):
             supabase_client = self.initialize_supabase_client()
-            if supabase_client.check_user_token(self.username):
-                response = supabase_client.delete_user_token(self.username)
-                supabase_client.logout()
-                self.supabase_client = None
+            if supabase_client.check_user_token(session.user_id):
+                # убираем из кэша клиента Jira со старым токеном
+                jira_token = supabase_client.get_token_from_supabase(session.user_id)
+                if jira_token:
+                    forget_jira_client(jira_token)
+                    del jira_token
+                response = supabase_client.delete_user_token(session.user_id)
                 if response:
                     self.bot.send_message(message.chat.id, f"Токен пользователя был успешно удалён, пройдите регистрацию заново для дальнейшей работы")
-                    self.create_keyboard(message.chat.id, self.username)
+                    self.create_keyboard(message.chat.id, session.user_id)
                 else:
                     self.bot.send_message(message.chat.id, f"Не удалось удалить токен пользователя")
             else:
                 self.bot.send_message(message.chat.id, f"Пользователь не зарегистрирован")
-                self.create_keyboard(message.chat.id, self.username)
+                self.create_keyboard(message.chat.id, session.user_id)
 
     def handle_priority_selection(self, call, priority_level, priority_name):
+            session = self.get_call_session(call)
             self.bot.send_message(call.message.chat.id, f"Выбран уровень статуса заявки: <b>{priority_name}</b>", parse_mode='HTML')
             print('priority_level=', priority_level)
-            self.claim_data = {'priority': priority_level}
+            session.claim_data = {'priority': priority_level}
             # self.bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
             #                                    reply_markup=None)
             self.bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
             self.type_keyboard(call.message.chat.id)
 
     def process_claim_type(self, call, type: str):
-        self.claim_data['type'] = type
+        session = self.get_call_session(call)
+        session.claim_data['type'] = type
         self.bot.send_message(call.message.chat.id, f"Выбран тип заявки: <b>{type}</b>", parse_mode='HTML')
         # self.bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
         #                                    reply_markup=None)
@@ -306,52 +320,84 @@ class TelegramBot:
 
     def handle_document(self, message):
         if message.document:
-            file_id = message.document.file_id
-            file_info = self.bot.get_file(file_id)
-            downloaded_file = self.bot.download_file(file_info.file_path)
-            filename = message.document.file_name
-
-            # Оборачиваем скачанные байты в BytesIO и задаем имя файла
-            file_data = BytesIO(downloaded_file)
-            file_data.name = filename  # задаем имя файла, чтобы Jira могла его распознать
-            file_data.seek(0)
-
-            self.attachment=file_data
-            self.filename=filename
-            self.bot.send_message(message.chat.id, f"Файл {filename} успешно прикреплён к заявке.")
-            self.bot.send_message(message.chat.id, f"Формирую заявку...")
-            self.upload_claim(message)
+            self.collect_attachment(message)
         else:
             self.bot.send_message(message.chat.id, "Документ не найден.")
             self.attachenent_keyboard(message.chat.id)
 
     def handle_photo(self, message):
         if message.photo:
-            file_id = message.photo[-1].file_id  # берём фото с наивысшим разрешением
-            file_info = self.bot.get_file(file_id)
-            downloaded_file = self.bot.download_file(file_info.file_path)
-
-            from io import BytesIO
-            file_data = BytesIO(downloaded_file)
-            file_data.name = "photo.jpg"  # Задаем имя файла вручную
-            file_data.seek(0)
-
-            self.photo=file_data
-            self.filename=file_data.name
-            self.bot.send_message(message.chat.id, f"Фотография успешно прикреплена к заявке.")
-            self.upload_claim(message)
+            self.collect_attachment(message)
         else:
             self.bot.send_message(message.chat.id, "Фотография не найдена.")
             self.attachenent_keyboard(message.chat.id)
 
+    def collect_attachment(self, message):
+        # Одиночный файл сразу идёт в заявку. Альбом Telegram приходит отдельными сообщениями с общим media_group_id -
+        # части копятся, пока album_debounce секунд не придёт новых, и прикрепляются к одной заявке
+        session = self.get_session(message)
+        if not message.media_group_id:
+            self.attach_files(session, [message])
+            return
+        with session.lock:
+            session.album.append(message)
+            if session.album_timer:
+                session.album_timer.cancel()
+            session.album_timer = threading.Timer(self.album_debounce, self.finish_album, args=(session,))
+            session.album_timer.daemon = True
+            session.album_timer.start()
+
+    def finish_album(self, session):
+        with session.lock:
+            messages, session.album, session.album_timer = session.album, [], None
+        if messages:
+            self.attach_files(session, messages)
+
+    def attachment_source(self, message, index, total):
+        # (file_id, имя файла, картинка ли); фото из альбома нумеруются, чтобы имена в Jira не совпадали
+        if message.document:
+            return message.document.file_id, message.document.file_name, False
+        filename = "photo.jpg" if total == 1 else f"photo_{index + 1}.jpg"
+        return message.photo[-1].file_id, filename, True  # берём фото с наивысшим разрешением
+
+    def attach_files(self, session, messages):
+        sources = [self.attachment_source(message, index, len(messages)) for index, message in enumerate(messages)]
+        try:
+            # части альбома скачиваются параллельно
+            files = list(self.download_executor.map(
+                lambda source: self.download_to_spool(self.bot.get_file(source[0]).file_path), sources))
+        except Exception as e:
+            print(f"Ошибка скачивания вложений: {e}")
+            self.bot.send_message(messages[-1].chat.id, "Не удалось получить вложение, попробуйте ещё раз.")
+            self.attachenent_keyboard(messages[-1].chat.id)
+            return
+        session.attachments = [make_attachment(file, filename, image)
+                               for file, (_, filename, image) in zip(files, sources)]
+        if len(sources) > 1:
+            self.bot.send_message(messages[-1].chat.id, f"К заявке прикреплено файлов: {len(sources)}.")
+        elif sources[0][2]:
+            self.bot.send_message(messages[-1].chat.id, f"Фотография успешно прикреплена к заявке.")
+        else:
+            self.bot.send_message(messages[-1].chat.id, f"Файл {sources[0][1]} успешно прикреплён к заявке.")
+        self.bot.send_message(messages[-1].chat.id, f"Формирую заявку...")
+        self.upload_claim(messages[-1])
+
+    def download_to_spool(self, file_path):
+        # В отличие от bot.download_file файл читается потоком и не собирается целиком в bytes
+        file_url = (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(self.TG_TOKEN, file_path)
+        with requests.get(file_url, stream=True, timeout=60, proxies=apihelper.proxy) as response:
+            response.raise_for_status()
+            return copy_chunks(response.iter_content(CHUNK_SIZE), spooled_file())
+
     def registration(self, call):
+        session = self.get_call_session(call)
         supabase_client = self.initialize_supabase_client()
-        if not supabase_client.check_user_token(self.username):
+        if not supabase_client.check_user_token(session.user_id):
             self.bot.send_message(call.message.chat.id, "Вы выбрали регистрацию пользователя")
             # функции для регистрации
             user_email = None
             try:
-                user_email = supabase_client.get_user_email(self.username)
+                user_email = supabase_client.get_user_email(session.user_id)
             except:
                 print('Ошибка')
             if not self.is_email(user_email):
@@ -376,10 +422,9 @@ class TelegramBot:
                 self.bot.register_next_step_handler(call.message, self.process_registration_token)
         else:
             self.bot.send_message(call.message.chat.id, "Вы уже зарегистрированы")
-        supabase_client.logout()
-        self.supabase_client = None
 
     def process_registration_token(self, message, email=None):
+        session = self.get_session(message)
         supabase_client = self.initialize_supabase_client()
         if not self.if_start(message) and not self.if_help(message):
             jira_client = JiraClient(message.text)
@@ -388,9 +433,9 @@ class TelegramBot:
             if jira_client.get_user_id(): #len(message.text) > 18:
                 # пробуем подключиться к Jira
                 if email:
-                    response = supabase_client.add_user(self.username, "".join(message.text.split()), email, jira_user_id)
+                    response = supabase_client.add_user(session.user_id, "".join(message.text.split()), email, jira_user_id)
                 else:
-                    response = supabase_client.add_user_without_email(self.username, "".join(message.text.split()))
+                    response = supabase_client.add_user_without_email(session.user_id, "".join(message.text.split()))
                 print(response)
                 if response is None:
                     self.bot.send_message(message.chat.id, "Ошибка регистрации, попробуйте еще раз.")
@@ -402,14 +447,12 @@ class TelegramBot:
                 else:
                     self.bot.send_message(message.chat.id, "Ошибка регистрации, попробуйте еще раз.")
                 # Отображаем клавиатуру (метод create_keyboard реализуется отдельно)
-                self.create_keyboard(message.chat.id, self.username)
+                self.create_keyboard(message.chat.id, session.user_id)
                 # del message.text
                 jira_client.logout()
             else:
                 self.bot.send_message(message.chat.id, "Токен введён неверно. Повторите ввод")
                 self.bot.register_next_step_handler(message, self.process_registration_token)
-        supabase_client.logout()
-        self.supabase_client = None
 
     # def process_registration_name(self, message):
     #     if not self.if_start(message) and not self.if_help(message):
@@ -490,89 +533,82 @@ class TelegramBot:
         return re.match(pattern, text) is not None
 
     def process_claim_theme(self, message):
+        session = self.get_session(message)
         if not self.if_start(message) and not self.if_help(message):
             if len(message.text) > 0:
-                self.claim_data['theme'] = message.text
-                if self.claim_data['type'] == self.typetask_field_1:
+                session.claim_data['theme'] = message.text
+                if session.claim_data['type'] == self.typetask_field_1:
                     self.bot.send_message(message.chat.id, "Введите описание заявки:")
                     self.bot.register_next_step_handler(message, self.process_claim_text)
-                elif self.claim_data['type'] == self.typetask_field_2:
+                elif session.claim_data['type'] == self.typetask_field_2:
                     self.attachenent_keyboard(message.chat.id)
             else:
                 self.bot.send_message(message.chat.id, "Тема введена неправильно, введите заново:")
                 self.bot.register_next_step_handler(message, self.process_claim_theme)
 
     def process_claim_text(self, message):
+        session = self.get_session(message)
         if not self.if_start(message) and not self.if_help(message):
             if len(message.text) > 1:
-                self.claim_data['text'] = message.text
-                claim_data = self.claim_data
+                session.claim_data['text'] = message.text
+                claim_data = session.claim_data
                 self.attachenent_keyboard(message.chat.id)
             else:
                 self.bot.send_message(message.chat.id, "Описание заявки введено неверно, повторите:")
                 self.bot.register_next_step_handler(message, self.process_claim_text)
 
     def upload_claim(self, message):
+        session = self.get_session(message)
         #получение токена для Jira из Supabase
         supabase_client = self.initialize_supabase_client()
-        jira_token = supabase_client.get_token_from_supabase(self.username)
-        self.supabase_client = None
+        jira_token = supabase_client.get_token_from_supabase(session.user_id)
         if jira_token:
-            jira_client = JiraClient(jira_token)
-            # добавление заявки в Jira
-            response_claim_jira = jira_client.create_claim(self.username, self.claim_data)
-            jira_claim_number = response_claim_jira['issueKey'].split('-')[-1]
-            email = supabase_client.get_user_email(self.username)
-            claim_link = jira_client.get_claim_link_by_number(jira_claim_number)
+            jira_client = get_jira_client(jira_token)
+            # добавление заявки в Jira; вложение загружается параллельно с созданием заявки
+            attachments = session.attachments
+            result_add_attachment = None
+            if attachments:
+                response_claim_jira, result_add_attachment = jira_client.create_claim_with_attachments(
+                    session.user_id, session.claim_data, attachments)
+            else:
+                response_claim_jira = jira_client.create_claim(session.user_id, session.claim_data)
             del jira_token
             if response_claim_jira:
+                jira_claim_number = response_claim_jira['issueKey'].split('-')[-1]
+                claim_link = jira_client.get_claim_link_by_number(jira_claim_number)
                 markup = types.InlineKeyboardMarkup()
                 subscribe_button = types.InlineKeyboardButton(
                     text="Подписаться на обновления по заявке", callback_data=f"subscribe_{jira_claim_number}")
                 markup.add(subscribe_button)
-                del self.claim_data
-                if self.photo:
-                    # загрузить фото или документ
-                    result_add_attachment = jira_client.add_photo_to_claim(jira_claim_number, self.photo, self.filename)
-                    if result_add_attachment:
-                        self.bot.send_message(message.chat.id,
-                                              f"Заявка успешно создана, вложение успешно добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка: \n{claim_link}",
-                                              parse_mode='HTML', reply_markup=markup)
-                    else:
-                        self.bot.send_message(message.chat.id,
-                                              f"Заявка успешно создана, но вложение не добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка: \n{claim_link}",
-                                              parse_mode='HTML', reply_markup=markup)
-                elif self.attachment:
-                    result_add_attachment = jira_client.add_attachment_to_claim(jira_claim_number, self.attachment, self.filename)
-                    if result_add_attachment:
-                        self.bot.send_message(message.chat.id,
-                                              f"Заявка успешно создана, вложение успешно добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка: \n{claim_link}",
-                                              parse_mode='HTML', reply_markup=markup)
-                    else:
-                        self.bot.send_message(message.chat.id,
-                                              f"Заявка успешно создана, но вложение не добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка: \n{claim_link}",
-                                              parse_mode='HTML', reply_markup=markup)
+                if attachments and result_add_attachment:
+                    self.bot.send_message(message.chat.id,
+                                          f"Заявка успешно создана, вложение успешно добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка: \n{claim_link}",
+                                          parse_mode='HTML', reply_markup=markup)
+                elif attachments:
+                    self.bot.send_message(message.chat.id,
+                                          f"Заявка успешно создана, но вложение не добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка: \n{claim_link}",
+                                          parse_mode='HTML', reply_markup=markup)
                 else:
                     self.bot.send_message(message.chat.id,
                                           f"Заявка успешно создана, номер в Jira: <b>{jira_claim_number}</b>, Ссылка: \n{claim_link}",
                                           parse_mode='HTML', reply_markup=markup)
+                session.clear_claim()
                 # if claim_link:
                 #     self.bot.send_message(message.chat.id, f"Ссылка на заявку: \n{claim_link}")
                 # else:
                 #     self.bot.send_message(message.chat.id, f"Ссылку невозможно прислать, поскольку email не совпадает с тем, что указан в Jira.")
-                jira_client.logout()
             else:
                 self.bot.send_message(message.chat.id, "Не удалось создать заявку")
-                del self.claim_data
+                session.clear_claim()
         else:
-            self.bot.send_message(message.chat.id, f"Пользователь {self.username} не зарегистрирован в Supabase")
-        supabase_client.logout()
+            self.bot.send_message(message.chat.id, f"Пользователь {session.user_id} не зарегистрирован в Supabase")
 
     def get_claim_input_number(self, call):
         self.bot.send_message(call.message.chat.id, "Введите номер заявки:")
         self.bot.register_next_step_handler(call.message, self.get_claim_status)
 
     def get_claim_status(self, message, number=None):
+        session = self.get_session(message)
         # Если number не передан, то берем его из message.text с проверкой
         if number is None:
             if self.if_start(message) or self.if_help(message):
@@ -587,13 +623,12 @@ class TelegramBot:
                 self.send_invalid_claim_message(message)
                 return
         supabase_client = self.initialize_supabase_client()
-        subscribe_status = supabase_client.is_subscription(self.username, number)
-        jira_token = supabase_client.get_token_from_supabase(self.username)
+        subscribe_status = supabase_client.is_subscription(supabase_client.get_user_id_by_username(session.user_id), number)
+        jira_token = supabase_client.get_token_from_supabase(session.user_id)
         if jira_token:
-            jira_client = JiraClient(jira_token)
+            jira_client = get_jira_client(jira_token)
             del jira_token
-            claim_info = jira_client.check_claim_status(number, self.username)
-            jira_client.logout()
+            claim_info = jira_client.check_claim_status(number, session.user_id)
             if 'error' in claim_info:
                 self.bot.send_message(message.chat.id, f"Вы пытаетесь посмотреть чужую заявку")
             elif claim_info:
@@ -638,9 +673,7 @@ class TelegramBot:
                 self.send_invalid_claim_message(message)
         else:
             self.bot.send_message(message.chat.id, "Пользователь не зарегистрирован в Supabase")
-            self.create_keyboard(message.chat.id, self.username)
-        supabase_client.logout()
-        self.supabase_client = None
+            self.create_keyboard(message.chat.id, session.user_id)
 
     def send_invalid_claim_message(self, message):
         self.bot.send_message(message.chat.id, "Номер введён неправильно, повторите:")
@@ -653,52 +686,59 @@ class TelegramBot:
         self.bot.register_next_step_handler(call.message, self.add_comment, number)
 
     def add_comment(self, message, number):
+        session = self.get_session(message)
         supabase_client = self.initialize_supabase_client()
-        jira_token = supabase_client.get_token_from_supabase(self.username)
-        self.supabase_client = None
+        jira_token = supabase_client.get_token_from_supabase(session.user_id)
         if jira_token:
-            jira_client = JiraClient(jira_token)
+            jira_client = get_jira_client(jira_token)
             del jira_token
-            response = jira_client.add_comment_to_claim(number, self.username, message.text)
+            response = jira_client.add_comment_to_claim(number, session.user_id, message.text)
             #  Ответ при добавлении комментария
             if response:
                 # del response
                 self.bot.send_message(message.chat.id, f"Комментарий к заявке <b>{number}</b> добавлен", parse_mode='HTML')
-                self.create_keyboard(message.chat.id, self.username)
-                if supabase_client.is_subscription(self.username, number):
+                self.create_keyboard(message.chat.id, session.user_id)
+                user_id = supabase_client.get_user_id_by_username(session.user_id)
+                if supabase_client.is_subscription(user_id, number):
                     print('идём менять в подписках id комментария')
-                    supabase_client.update_subscription_id(self.username, number, int(response.id))
+                    supabase_client.update_subscription_id(user_id, number, int(response.id))
             else:
                 self.bot.send_message(message.chat.id, "Не удалось добавить комментарий")
-                self.create_keyboard(message.chat.id, self.username)
+                self.create_keyboard(message.chat.id, session.user_id)
         else:
             self.bot.send_message(message.chat.id, "Пользователь не зарегистрирован в Supabase")
-            self.create_keyboard(message.chat.id, self.username)
-        jira_client.logout()
-        supabase_client.logout()
+            self.create_keyboard(message.chat.id, session.user_id)
 
     def add_subscribe(self, call, number):
+        session = self.get_call_session(call)
         # проверка, а нет ли уже такой записи? Если нет - добавить запись в базу.
         supabase_client = self.initialize_supabase_client()
-        if not supabase_client.is_subscription(self.username, number):
+        user = supabase_client.get_user(session.user_id)
+        if not user:
+            self.bot.send_message(call.message.chat.id, "Нет регистрации или токен недействителен")
+            return
+        # один запрос отвечает и на «уже подписан?», и на «не превышен ли лимит?»
+        subscribed_claims, subscribe_count = supabase_client.get_subscribed_claims(user['id'])
+        if subscribed_claims is None:
+            self.bot.send_message(call.message.chat.id, f"Не удалось сделать подписку на заявку {number}")
+        elif number.split('-')[1] not in subscribed_claims:
             print("Добавляем в базу subscription запись")
             # здесь надо идти в Jira и получать статус
-            jira_token = supabase_client.get_token_from_supabase(self.username)
+            jira_token = supabase_client.get_token_from_supabase(session.user_id)
             if jira_token:
-                jira_client = JiraClient(jira_token)
+                jira_client = get_jira_client(jira_token, user['jira_user_id'])
                 del jira_token
-                response_from_jira = jira_client.check_claim_status(number, self.username)
+                response_from_jira = jira_client.check_claim_status(number, session.user_id)
                 print('response_from_jira = ', response_from_jira)
-                jira_client.logout()
                 if 'error' in response_from_jira:
                     self.bot.send_message(call.message.chat.id, f"Вы пытаетесь посмотреть чужую заявку")
                 elif response_from_jira:
                     last_comment = response_from_jira.get('last_comment')
                     if last_comment is not None and last_comment.get('id'):
-                        response = supabase_client.can_subscription(self.username, number, response_from_jira['status'], response_from_jira['last_comment']['id'])
+                        response = supabase_client.can_subscription(user['id'], subscribe_count, number, response_from_jira['status'], response_from_jira['last_comment']['id'])
                         print(1111)
                     else:
-                        response = supabase_client.can_subscription(self.username, number, response_from_jira['status'])
+                        response = supabase_client.can_subscription(user['id'], subscribe_count, number, response_from_jira['status'])
                         print(2222)
                     print('response = ', response)
                     if 'data' in response:
@@ -712,54 +752,51 @@ class TelegramBot:
                     self.bot.send_message(call.message.chat.id, f"Не удалось проверить статус заявки {number}")
         else:
             self.bot.send_message(call.message.chat.id, f"Вы уже подписаны на обновления по заявке {number}")
-        supabase_client.logout()
 
     def unsubscribe_claim(self, call, number):
+        session = self.get_call_session(call)
         supabase_client = self.initialize_supabase_client()
-        if supabase_client.is_subscription(self.username, number):
-            response = supabase_client.delete_subscription(call.message.chat.id, number.split('-')[1])
+        user_id = supabase_client.get_user_id_by_username(session.user_id)
+        if supabase_client.is_subscription(user_id, number):
+            response = supabase_client.delete_subscription(user_id, number.split('-')[1])
             if response:
                 self.bot.send_message(call.message.chat.id, f"Подписка на заявку {number} удалена")
             else:
                 self.bot.send_message(call.message.chat.id, f"Подписку на заявку {number} не удалось удалить")
         else:
             self.bot.send_message(call.message.chat.id, f"Вы отписались от заявки {number}")
-        supabase_client.logout()
 
     def check_subscribe(self, call):
+        session = self.get_call_session(call)
         supabase_client = self.initialize_supabase_client()
         self.bot.answer_callback_query(call.id, "Вы нажали Посмотреть все подписки на обновления")
-        if supabase_client.check_user(self.username):
+        user = supabase_client.get_user(session.user_id)
+        if user:
             self.bot.send_message(call.message.chat.id, "Вы выбрали посмотреть все подписки на обновления")
-            subscriptions = supabase_client.get_subscriptions(call.message.chat.id, fields=self.field_claim_number)
+            subscriptions = supabase_client.get_subscriptions(user['id'], fields=self.field_claim_number)
             subscription_numbers = sorted(s[self.field_claim_number] for s in subscriptions)
             if subscription_numbers:
                 buttons = []
-                jira_token = supabase_client.get_token_from_supabase(self.username)
+                jira_token = supabase_client.get_token_from_supabase(session.user_id)
                 if jira_token:
                     current_page = 1
-                    jira_client = JiraClient(jira_token)
+                    jira_client = get_jira_client(jira_token)
                     del jira_token
-                    self.list_of_claims = []
-                    for sub in subscription_numbers:
-                        # собираем словарь номера - темы заявок, все какие есть у пользователя
-                        number = self.gira_project_key + '-' + str(sub)
-                        theme = jira_client.get_theme_by_number(number)
-                        claim = {'number': number, 'theme': theme}
-                        self.list_of_claims.append(claim)
-                    jira_client.logout()
+                    # темы всех подписок - из общего кэша и одним поиском по недостающим
+                    numbers = [self.gira_project_key + '-' + str(sub) for sub in subscription_numbers]
+                    themes = jira_client.get_themes_by_numbers(numbers)
+                    session.reset_claims_list(list_of_claims=[{'number': number, 'theme': themes[number]} for number in numbers])
                     self.keyboard_list_of_claims(call, 0)
                 else:
                     self.bot.send_message(call.message.chat.id, "Проблема с подключением к Jira, сбросьте регистрацию и обновите токен.")
             else:
                 self.bot.send_message(call.message.chat.id, "Вы пока не подписаны ни на одно обновление.\nВыберите пункт «Все открытые заявки», затем — конкретную заявку и подпишитесь на её обновление.")
-                self.create_keyboard(call.message.chat.id, self.username)
+                self.create_keyboard(call.message.chat.id, session.user_id)
         else:
             self.bot.send_message(call.message.chat.id, "Нет регистрации или токен недействителен")
-        supabase_client.logout()
-        self.supabase_client = None
 
     def keyboard_list_of_claims(self, call, number):
+        session = self.get_call_session(call)
         try:
             self.bot.edit_message_reply_markup(
                 chat_id=call.message.chat.id,
@@ -775,21 +812,25 @@ class TelegramBot:
         print('self.buttons_per_page = ', self.buttons_per_page)
         buttons = []
         print('Мы внутри keyboard_list_of_claims')
+        if session.claims_client is not None:
+            claims, total = self.claims_page(session, number)
+            # следующая страница загружается заранее, пока пользователь смотрит текущую
+            if number + self.buttons_per_page < total and number + self.buttons_per_page not in session.claims_pages:
+                session.claims_pages[number + self.buttons_per_page] = self.prefetch_executor.submit(
+                    session.claims_client.get_claims_page, number + self.buttons_per_page, self.buttons_per_page)
+        else:
+            claims, total = session.list_of_claims[number:number + self.buttons_per_page], len(session.list_of_claims)
         # вывод клавиатуры - куска списка заявок
-        i = number
-        k = 0
-        while (i < len(self.list_of_claims)) and (k < self.buttons_per_page):
-            button = types.InlineKeyboardButton(f"{self.list_of_claims[i]['number']} — {self.list_of_claims[i]['theme']}",  callback_data=f"claim_{self.list_of_claims[i]['number']}")
+        for claim in claims:
+            button = types.InlineKeyboardButton(f"{claim['number']} — {claim['theme']}",  callback_data=f"claim_{claim['number']}")
             buttons.append(button)
-            i += 1
-            k += 1
         markup = types.InlineKeyboardMarkup(row_width=1)
         # вывод кнопки назад, если не начало
         if (number - self.buttons_per_page >= 0):
             buttons.append(types.InlineKeyboardButton("<< Предыдущие заявки",
                                                       callback_data=f"list_of_claims_{str(number - self.buttons_per_page)}"))
         # вывод кнопки вперёд, если не конец
-        if (number + self.buttons_per_page < len(self.list_of_claims)):
+        if (number + self.buttons_per_page < total):
             buttons.append(types.InlineKeyboardButton("Следующие заявки >>",
                                                       callback_data=f"list_of_claims_{str(number + self.buttons_per_page)}"))
         markup.add(*buttons)
@@ -799,69 +840,40 @@ class TelegramBot:
             print("Не удалось удалить предыдущее сообщение:", e)
         self.bot.send_message(call.message.chat.id, "Выберите заявку для проверки её статуса:", reply_markup=markup)
 
+    def claims_page(self, session, offset):
+        # Страница заявок из Jira: из загруженных ранее, из предзагрузки или запросом; (заявки, всего)
+        page = session.claims_pages.get(offset)
+        if page is None:
+            page = session.claims_client.get_claims_page(offset, self.buttons_per_page)
+        elif isinstance(page, Future):
+            try:
+                page = page.result()
+            except Exception as e:
+                print(f"Ошибка предзагрузки страницы заявок: {e}")
+                page = session.claims_client.get_claims_page(offset, self.buttons_per_page)
+        session.claims_pages[offset] = page
+        return page
+
     def poll_issue_status(self):
-        try:
-            supabase_client = self.initialize_supabase_client()
-            user_list = supabase_client.get_user_list()
-            for user in user_list:
-                subscriptions = supabase_client.get_subscriptions(user)
-                print(subscriptions)
-                jira_token = supabase_client.get_token_from_supabase(user)
-                if jira_token:
-                    jira_client = JiraClient(jira_token)
-                    del jira_token
-                    if subscriptions:
-                        for sub in subscriptions:
-                            claim_number = self.gira_project_key + '-' + str(sub[self.field_claim_number])
-                            last_status = sub.get(self.field_claim_status, "")
-                            last_comment_id = sub.get(self.field_last_comment_id, 0)
-                            print('last_comment_id = ', last_comment_id)
-                            print('Проверка статуса ', user, ' ', claim_number)
-                            try:
-                                claim_status = jira_client.check_claim_status(claim_number, user)
-                                if 'error' in claim_status:
-                                    self.bot.send_message(user, f"Вы пытаетесь посмотреть чужую заявку")
-                                else:
-                                    current_status = claim_status['status']
-                                    current_comment = claim_status.get('last_comment')
-                                    if current_comment is not None and current_comment.get('created'):
-                                        current_date_of_comment = current_comment.get('id')
-                                        print('current_date_of_comment = ', current_date_of_comment)
-                                    else:
-                                        current_date_of_comment = None
-                                    print('current_status = ', current_status, ' last = ', last_status)
-                                    claim_link = jira_client.get_claim_link_by_number(sub[self.field_claim_number])
-                                    if current_status != last_status:
-                                        # Обновляем статус в Supabase
-                                        print('Статусы отличаются')
-                                        supabase_client.update_subscription_status(user, claim_number, current_status)
-                                        # Уведомляем подписчика
-                                        print("self.field_chat_id = ", self.field_chat_id)
-                                        self.bot.send_message(user, f"Статус заявки {claim_number} изменился с {last_status} на: {current_status}.\n{claim_link}")
-                                        if claim_link == self.done_status or claim_link == self.closed_status:
-                                            jira_client.delete_subscription(self.username, sub[self.field_claim_number])
-                                            self.bot.send_message(user, f"Подписка на обновление статуса заявки удалена")
-                                    if current_date_of_comment and current_date_of_comment > last_comment_id:
-                                        print('Даты комментариев отличаются, cur = ', current_date_of_comment, 'last = ', last_comment_id)
-                                        supabase_client.update_subscription_id(user, claim_number, current_date_of_comment) # функция, которая устанавливает новый id комментария
-                                        self.bot.send_message(user, f"У заявки {claim_number} появился новый комментарий от <b>{current_comment['author']}</b>:\n{current_comment['text']}.\n{claim_link}", parse_mode='HTML')
-                                        print('Вместо сообщения пользователю ')
-                            except Exception as e:
-                                print(f"Ошибка опроса заявки {claim_number}: {e}")
-                    jira_client.logout()
-                # else:
-                #     self.bot.send_message(user, f"У вас нет подписок")
-            supabase_client.logout()
-        except Exception as e:
-            print(f"Ошибка подключения к Supabase: {e}")
+        self.subscription_poller.poll()
+
+    def send_notification(self, chat_id, text, parse_mode=None):
+        self.bot.send_message(chat_id, text, parse_mode=parse_mode)
 
     def start_polling_scheduler(self):
-        schedule.every(1.1).minutes.do(self.poll_issue_status)
+        threading.Thread(target=self.subscription_poller.warm_up, daemon=True).start()
+        if JIRA_WEBHOOK_ENABLED:
+            self.jira_webhook = JiraWebhookServer(self.subscription_poller.handle_jira_event)
+            self.jira_webhook.start_in_thread()
 
+        # Заявки проверяются по адаптивному расписанию поллера, поток просыпается к ближайшему сроку
         def run_schedule():
             while True:
-                schedule.run_pending()
-                time.sleep(1)
+                try:
+                    self.poll_issue_status()
+                except Exception as e:
+                    print(f"Ошибка опроса подписок: {e}")
+                time.sleep(self.subscription_poller.next_delay())
 
         t = threading.Thread(target=run_schedule)
         t.daemon = True
@@ -870,10 +882,18 @@ class TelegramBot:
     def run(self):
         self.bot.polling(none_stop=True)
 
+    def get_session(self, message):
+        # У сообщения бота (call.message) from_user - сам бот; в личном чате пользователь совпадает с chat.id
+        if message.from_user is None or message.from_user.is_bot:
+            return self.sessions.get(message.chat.id, message.chat.id)
+        return self.sessions.get(message.chat.id, message.from_user.id)
+
+    def get_call_session(self, call):
+        return self.sessions.get(call.message.chat.id, call.from_user.id)
+
     def initialize_supabase_client(self):
-        self.supabase_client = SupabaseClient()
-        self.supabase_client.sign_in()
-        return self.supabase_client
+        # Общий для всего процесса клиент Supabase, без входа/выхода на каждое нажатие кнопки
+        return get_supabase_client()
 
     def if_start(self, message):
         if message.text.startswith('/start'):
@@ -898,13 +918,31 @@ class TelegramBot:
         return dt.strftime("%Y-%m-%d %H:%M:%S")
 
     def handle_text(self, message):
+        session = self.get_session(message)
         self.bot.send_message(message.chat.id, "Используйте кнопки для навигации по боту.")
-        if not self.username:
-            self.username = message.chat.id
-        self.create_keyboard(message.chat.id, self.username)
+        self.create_keyboard(message.chat.id, session.user_id)
 
     def run(self):
-        self.bot.polling() # non_stop=True, timeout=30, long_polling_timeout=30)
+        if os.environ.get("BOT_MODE", "polling") == "webhook":
+            self.run_webhook()
+        else:
+            self.bot.polling() # non_stop=True, timeout=30, long_polling_timeout=30)
+
+    def run_webhook(self):
+        # Обработчики выполняются в потоках воркеров вебхука, а не в пуле pyTelegramBotAPI -
+        # иначе сообщения одного чата снова обрабатывались бы в произвольном порядке
+        self.bot.threaded = False
+        self.webhook_server = WebhookServer(self.process_webhook_update)
+        self.webhook_executor = ThreadPoolExecutor(max_workers=self.webhook_server.workers,
+                                                   thread_name_prefix="webhook")
+        # Без WEBHOOK_URL вебхук считается зарегистрированным снаружи (одна реплика или балансировщик)
+        if self.webhook_server.public_url():
+            self.bot.set_webhook(url=self.webhook_server.public_url(), secret_token=self.webhook_server.secret)
+        asyncio.run(self.webhook_server.serve_forever())
+
+    async def process_webhook_update(self, update):
+        await asyncio.get_running_loop().run_in_executor(self.webhook_executor, self.bot.process_new_updates,
+                                                         [types.Update.de_json(update)])
 
 
 if __name__ == '__main__':
@@ -1,22 +1,27 @@
 import os
 import re
 import asyncio
-import schedule
-import time
-import threading
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
-from aiogram.filters import Command, F
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from supabase_client import SupabaseClient
-from jira_client import JiraClient
+from supabase_client import get_supabase_client
+from jira_client import forget_jira_client, make_attachment
+from jira_client_async import get_async_jira_client, forget_async_jira_client, close_http_session
+from subscription_poller import SubscriptionPoller
+from session_store import SessionStore
+from webhook_server import WebhookServer
+from jira_webhook import JiraWebhookServer, JIRA_WEBHOOK_ENABLED, RECONCILE_MINUTES
+from fsm_storage import create_fsm_storage
+from notification_dispatcher import NotificationDispatcher
+from file_spool import spooled_file
 
 # Загружаем переменные окружения
 load_dotenv(override=True)
@@ -37,12 +42,16 @@ class TelegramBot:
     def __init__(self):
         # Инициализируем объекты бота, диспетчера и FSM‑хранилища
         self.token = os.getenv("TG_TOKEN")
-        self.storage = MemoryStorage()
+        # Состояния регистрации и ввода заявки: в памяти, Redis или SQLite - по настройке FSM_STORAGE
+        self.storage = create_fsm_storage()
         self.bot = Bot(token=self.token, default=DefaultBotProperties(parse_mode="HTML"))
         self.dp = Dispatcher(storage=self.storage)  # создаём диспетчер без передачи бота
 
-        # Временное хранилище данных (для некоторых значений, например, заявок)
-        self.ctx_data = {}
+        # Данные диалогов по (чат, пользователь) - обновления разных пользователей не перетирают друг друга
+        self.sessions = SessionStore()
+        # сколько ждать следующую часть альбома и сколько файлов скачивать одновременно
+        self.album_debounce = float(os.environ.get("ALBUM_DEBOUNCE", 1.0))
+        self.download_limit = asyncio.Semaphore(int(os.environ.get("ATTACHMENT_DOWNLOAD_WORKERS", 4)))
         self.low_priority = os.environ.get("LOW_PRIORITY")
         self.middle_priority = os.environ.get("MIDDLE_PRIORITY")
         self.high_priority = os.environ.get("HIGH_PRIORITY")
@@ -50,8 +59,20 @@ class TelegramBot:
         self.typetask_field_2 = os.environ.get("GIRA_TYPETASK_FIELD_2")
         self.gira_project_key = os.environ.get("GIRA_PROJECT_KEY")
         self.buttons_per_page = 50
+        # Опрос подписок - задача asyncio в цикле диспетчера; блокирующие клиенты Supabase и Jira
+        # выполняются в ограниченном пуле потоков
+        self.jira_webhook = None
+        self.executor = ThreadPoolExecutor(max_workers=int(os.environ.get("POLL_EXECUTOR_WORKERS", 4)),
+                                           thread_name_prefix="poller")
+        self.loop = None
+        self.polling_task = None
 
         self.register_handlers()
+        # Уведомления подписчикам отправляются через очередь с ограничением скорости, а не прямо из потока опроса
+        self.notifications = NotificationDispatcher(self.send_notification)
+        # С вебхуком Jira изменения приходят сразу, обход подписок остаётся редкой сверкой
+        self.subscription_poller = SubscriptionPoller(self.notifications.enqueue,
+                                                      RECONCILE_MINUTES * 60 if JIRA_WEBHOOK_ENABLED else None)
         self.start_polling_scheduler()
 
     def register_handlers(self):
@@ -80,7 +101,6 @@ class TelegramBot:
         await message.answer(
             f"Привет, {message.from_user.first_name or message.from_user.username}!"
         )
-        self.ctx_data['username'] = message.from_user.id
         await self.create_keyboard(message.chat.id, message.from_user.id)
 
     async def help_handler(self, message: types.Message):
@@ -113,14 +133,41 @@ class TelegramBot:
             builder.row(
                 types.InlineKeyboardButton(text='Регистрация пользователя', callback_data='button_reg')
             )
-        supabase_client.logout()
         markup = builder.as_markup()
         await self.bot.send_message(chat_id, "Выберите одну из кнопок:", reply_markup=markup)
 
+    def get_session(self, message: types.Message):
+        # У сообщения бота (call.message) from_user - сам бот; в личном чате пользователь совпадает с chat.id
+        if message.from_user is None or message.from_user.is_bot:
+            return self.sessions.get(message.chat.id, message.chat.id)
+        return self.sessions.get(message.chat.id, message.from_user.id)
+
+    def get_call_session(self, call: types.CallbackQuery):
+        return self.sessions.get(call.message.chat.id, call.from_user.id)
+
+    def claim_state(self, session):
+        # Черновик заявки (приоритет, тип, тема, описание) хранится в данных FSM, а не в сессии процесса:
+        # так он переживает перезапуск и доступен реплике, которая получит следующее сообщение.
+        # Ключ совпадает с тем, что aiogram передаёт обработчикам сообщений (чат + пользователь)
+        return FSMContext(storage=self.storage,
+                          key=StorageKey(bot_id=self.bot.id, chat_id=session.chat_id, user_id=session.user_id))
+
+    async def update_claim_draft(self, session, **fields):
+        state = self.claim_state(session)
+        draft = await self.claim_draft(session)
+        draft.update(fields)
+        await state.update_data(claim_data=draft)
+
+    async def claim_draft(self, session):
+        return dict((await self.claim_state(session).get_data()).get('claim_data') or {})
+
+    async def clear_claim_draft(self, session):
+        await self.claim_state(session).update_data(claim_data={})
+        session.clear_claim()
+
     def initialize_supabase_client(self):
-        client = SupabaseClient()
-        client.sign_in()
-        return client
+        # Общий для всего процесса клиент Supabase, без входа/выхода на каждое нажатие кнопки
+        return get_supabase_client()
 
     async def priority_keyboard(self, chat_id: int):
         # Inline‑клавиатура для выбора приоритета заявки
@@ -167,6 +214,7 @@ class TelegramBot:
         # Универсальный обработчик inline‑кнопок
         user_id = call.from_user.id
         data = call.data
+        session = self.get_call_session(call)
 
         if data == 'button_reset_reg':
             await call.answer("Вы нажали Сбросить регистрацию")
@@ -178,7 +226,7 @@ class TelegramBot:
 
         elif data == 'button_create_claim':
             await call.answer("Вы нажали Оставить заявку")
-            self.ctx_data['claim_data'] = {}
+            await self.clear_claim_draft(session)
             supabase_client = self.initialize_supabase_client()
             if supabase_client.check_user(user_id):
                 await self.bot.send_message(call.message.chat.id,
@@ -186,29 +234,28 @@ class TelegramBot:
                 await self.priority_keyboard(call.message.chat.id)
             else:
                 await self.bot.send_message(call.message.chat.id, "Нет регистрации или токен недействителен")
-            supabase_client.logout()
 
         elif data == 'button_all_claims':
-            self.ctx_data['list_of_claims'] = []
+            session.reset_claims_list()
             await call.answer("Вы нажали Проверить статус заявки")
             supabase_client = self.initialize_supabase_client()
             if supabase_client.check_user(user_id):
                 await self.bot.send_message(call.message.chat.id, "Вы выбрали посмотреть все открытые заявки")
                 jira_token = supabase_client.get_token_from_supabase(user_id)
                 if jira_token:
-                    jira_client = JiraClient(jira_token)
-                    self.ctx_data['list_of_claims'] = jira_client.get_claims_numbers_and_themes()
-                    if self.ctx_data['list_of_claims']:
+                    jira_client = get_async_jira_client(jira_token)
+                    # заявки загружаются постранично по мере листания, а не вся история сразу
+                    session.reset_claims_list(jira_client)
+                    _, total = await self.claims_page(session, 0)
+                    if total:
                         await self.keyboard_list_of_claims(call, 0)
                     else:
                         await self.bot.send_message(call.message.chat.id, "У вас нет созданных заявок")
                         await self.create_keyboard(call.message.chat.id, user_id)
-                    jira_client.logout()
                 else:
                     await self.bot.send_message(call.message.chat.id, "Нет регистрации или токен недействителен")
             else:
                 await self.bot.send_message(call.message.chat.id, "Нет регистрации или токен недействителен")
-            supabase_client.logout()
 
         elif data == 'button_check_claim':
             await self.get_claim_input_number(call)
@@ -218,7 +265,7 @@ class TelegramBot:
             await self.bot.send_message(call.message.chat.id,
                                         "Выбран уровень статуса заявки: <b>средний</b>",
                                         parse_mode="HTML")
-            self.ctx_data.setdefault('claim_data', {})['priority'] = os.environ.get("LOW_PRIORITY")
+            await self.update_claim_draft(session, priority=os.environ.get("LOW_PRIORITY"))
             await self.bot.delete_message(call.message.chat.id, call.message.message_id)
             await self.type_keyboard(call.message.chat.id)
 
@@ -226,7 +273,7 @@ class TelegramBot:
             await self.bot.send_message(call.message.chat.id,
                                         "Выбран уровень статуса заявки: <b>высокий</b>",
                                         parse_mode="HTML")
-            self.ctx_data.setdefault('claim_data', {})['priority'] = os.environ.get("MIDDLE_PRIORITY")
+            await self.update_claim_draft(session, priority=os.environ.get("MIDDLE_PRIORITY"))
             await self.bot.delete_message(call.message.chat.id, call.message.message_id)
             await self.type_keyboard(call.message.chat.id)
 
@@ -234,23 +281,22 @@ class TelegramBot:
             await self.bot.send_message(call.message.chat.id,
                                         "Выбран уровень статуса заявки: <b>критический</b>",
                                         parse_mode="HTML")
-            self.ctx_data.setdefault('claim_data', {})['priority'] = os.environ.get("HIGH_PRIORITY")
+            await self.update_claim_draft(session, priority=os.environ.get("HIGH_PRIORITY"))
             await self.bot.delete_message(call.message.chat.id, call.message.message_id)
             await self.type_keyboard(call.message.chat.id)
 
         # Обработка выбора типа заявки с переходом в FSM для ввода темы и описания
         elif data == 'button_type1':
-            self.ctx_data.setdefault('claim_data', {})['type'] = self.typetask_field_1
+            await self.update_claim_draft(session, type=self.typetask_field_1)
             await self.bot.send_message(call.message.chat.id,
                                         f"Выбран тип заявки: <b>{self.typetask_field_1}</b>",
                                         parse_mode="HTML")
             await self.bot.delete_message(call.message.chat.id, call.message.message_id)
             await self.bot.send_message(call.message.chat.id, "Введите тему заявки:")
-            state = self.dp.current_state(user=call.from_user.id, chat=call.message.chat.id)
-            await state.set_state(ClaimState.waiting_for_topic)
+            await self.claim_state(session).set_state(ClaimState.waiting_for_topic)
 
         elif data == 'button_type2':
-            self.ctx_data.setdefault('claim_data', {})['type'] = self.typetask_field_2
+            await self.update_claim_draft(session, type=self.typetask_field_2)
             await self.bot.send_message(call.message.chat.id,
                                         f"Выбран тип заявки: <b>{self.typetask_field_2}</b>",
                                         parse_mode="HTML")
@@ -260,12 +306,15 @@ class TelegramBot:
         elif data == 'main_menu_button':
             await self.create_keyboard(call.message.chat.id, user_id)
 
+        elif data.startswith("list_of_claims_"):
+            await self.keyboard_list_of_claims(call, data.split('_')[-1])
+
         elif data == "upload_yes":
             await self.bot.send_message(call.message.chat.id,
                                         "Пожалуйста, прикрепите файл или фотографию для заявки.")
 
         elif data == "upload_no":
-            await self.upload_claim(call.message)
+            await self.upload_claim(call.message, session)
 
         elif data == "reset_yes":
             try:
@@ -288,43 +337,77 @@ class TelegramBot:
     async def text_handler(self, message: types.Message):
         # Обработка стандартных текстовых сообщений (если не задействован FSM)
         await self.bot.send_message(message.chat.id, "Используйте кнопки для навигации по боту.")
-        if 'username' in self.ctx_data:
-            await self.create_keyboard(message.chat.id, self.ctx_data['username'])
+        await self.create_keyboard(message.chat.id, message.from_user.id)
 
     async def document_handler(self, message: types.Message):
         if message.document:
-            file = await self.bot.get_file(message.document.file_id)
-            downloaded = await self.bot.download_file(file.file_path)
-            filename = message.document.file_name
-            file_data = BytesIO(downloaded.getvalue())
-            file_data.name = filename
-            file_data.seek(0)
-            self.ctx_data['attachment'] = file_data
-            self.ctx_data['filename'] = filename
-            await self.bot.send_message(message.chat.id,
-                                        f"Файл {filename} успешно прикреплён к заявке.")
-            await self.bot.send_message(message.chat.id, "Формирую заявку...")
-            await self.upload_claim(message)
+            await self.collect_attachment(message)
         else:
             await self.bot.send_message(message.chat.id, "Документ не найден.")
             await self.attachenent_keyboard(message.chat.id)
 
     async def photo_handler(self, message: types.Message):
         if message.photo:
-            file = await self.bot.get_file(message.photo[-1].file_id)
-            downloaded = await self.bot.download_file(file.file_path)
-            file_data = BytesIO(downloaded.getvalue())
-            file_data.name = "photo.jpg"
-            file_data.seek(0)
-            self.ctx_data['photo'] = file_data
-            self.ctx_data['filename'] = file_data.name
-            await self.bot.send_message(message.chat.id,
-                                        "Фотография успешно прикреплена к заявке.")
-            await self.upload_claim(message)
+            await self.collect_attachment(message)
         else:
             await self.bot.send_message(message.chat.id, "Фотография не найдена.")
             await self.attachenent_keyboard(message.chat.id)
 
+    async def collect_attachment(self, message: types.Message):
+        # Одиночный файл сразу идёт в заявку. Альбом Telegram приходит отдельными сообщениями с общим media_group_id -
+        # части копятся, пока album_debounce секунд не придёт новых, и прикрепляются к одной заявке
+        session = self.get_session(message)
+        if not message.media_group_id:
+            await self.attach_files(session, [message])
+            return
+        session.album.append(message)
+        if session.album_timer:
+            session.album_timer.cancel()
+        session.album_timer = asyncio.create_task(self.finish_album(session))
+
+    async def finish_album(self, session):
+        await asyncio.sleep(self.album_debounce)
+        messages, session.album, session.album_timer = session.album, [], None
+        await self.attach_files(session, messages)
+
+    def attachment_source(self, message: types.Message, index, total):
+        # (file_id, имя файла, картинка ли); фото из альбома нумеруются, чтобы имена в Jira не совпадали
+        if message.document:
+            return message.document.file_id, message.document.file_name, False
+        filename = "photo.jpg" if total == 1 else f"photo_{index + 1}.jpg"
+        return message.photo[-1].file_id, filename, True
+
+    async def download_to_spool(self, file_id):
+        # aiogram пишет файл в destination по кускам - без промежуточного BytesIO и его копии
+        async with self.download_limit:
+            file = await self.bot.get_file(file_id)
+            file_data = spooled_file()
+            await self.bot.download_file(file.file_path, destination=file_data)
+            file_data.seek(0)
+            return file_data
+
+    async def attach_files(self, session, messages):
+        chat_id = messages[-1].chat.id
+        sources = [self.attachment_source(message, index, len(messages)) for index, message in enumerate(messages)]
+        try:
+            # части альбома скачиваются параллельно
+            files = await asyncio.gather(*(self.download_to_spool(file_id) for file_id, _, _ in sources))
+        except Exception as e:
+            print(f"Ошибка скачивания вложений: {e}")
+            await self.bot.send_message(chat_id, "Не удалось получить вложение, попробуйте ещё раз.")
+            await self.attachenent_keyboard(chat_id)
+            return
+        session.attachments = [make_attachment(file, filename, image)
+                               for file, (_, filename, image) in zip(files, sources)]
+        if len(sources) > 1:
+            await self.bot.send_message(chat_id, f"К заявке прикреплено файлов: {len(sources)}.")
+        elif sources[0][2]:
+            await self.bot.send_message(chat_id, "Фотография успешно прикреплена к заявке.")
+        else:
+            await self.bot.send_message(chat_id, f"Файл {sources[0][1]} успешно прикреплён к заявке.")
+        await self.bot.send_message(chat_id, "Формирую заявку...")
+        await self.upload_claim(messages[-1], session)
+
     async def registration(self, call: types.CallbackQuery):
         # Инициализируем FSM для регистрации
         supabase_client = self.initialize_supabase_client()
@@ -335,7 +418,6 @@ class TelegramBot:
             await state.set_state(RegistrationState.waiting_for_email)
         else:
             await self.bot.send_message(call.message.chat.id, "Вы уже зарегистрированы")
-        supabase_client.logout()
 
     async def process_registration_email(self, message: types.Message, state: FSMContext):
         # Обработка ввода email при регистрации
@@ -361,7 +443,6 @@ class TelegramBot:
             user_id = message.from_user.id
             supabase_client = self.initialize_supabase_client()
             response = supabase_client.add_user(user_id, token_text, email)
-            supabase_client.logout()
             if response:
                 await message.answer("Регистрация прошла успешно!")
             else:
@@ -380,7 +461,7 @@ class TelegramBot:
     async def process_claim_topic(self, message: types.Message, state: FSMContext):
         # Обработка ввода темы заявки
         if message.text:
-            self.ctx_data.setdefault('claim_data', {})['theme'] = message.text
+            await self.update_claim_draft(self.get_session(message), theme=message.text)
             await message.answer("Введите описание заявки:")
             await state.set_state(ClaimState.waiting_for_description)
         else:
@@ -389,22 +470,42 @@ class TelegramBot:
     async def process_claim_description(self, message: types.Message, state: FSMContext):
         # Обработка ввода описания заявки
         if len(message.text) > 1:
-            self.ctx_data.setdefault('claim_data', {})['text'] = message.text
+            session = self.get_session(message)
+            await self.update_claim_draft(session, text=message.text)
             await message.answer("Данные получены, формирую заявку...")
-            await state.finish()
-            await self.upload_claim(message)
+            # только сброс состояния: черновик в данных FSM ещё нужен upload_claim
+            await state.set_state(None)
+            await self.upload_claim(message, session)
         else:
             await message.answer("Описание заявки введено неверно, повторите:")
 
-    async def upload_claim(self, message: types.Message):
+    async def upload_claim(self, message: types.Message, session):
         # Получаем токен Jira через Supabase и создаем заявку
+        claim_data = await self.claim_draft(session)
+        if not claim_data.get('type'):
+            # черновик истёк по FSM_STATE_TTL или заявка уже отправлена
+            await self.bot.send_message(message.chat.id, "Данные заявки не найдены, начните создание заявки заново")
+            await self.clear_claim_draft(session)
+            await self.create_keyboard(message.chat.id, session.user_id)
+            return
         supabase_client = self.initialize_supabase_client()
-        jira_token = supabase_client.get_token_from_supabase(message.from_user.id)
+        jira_token = supabase_client.get_token_from_supabase(session.user_id)
         if jira_token:
-            jira_client = JiraClient(jira_token)
-            response_claim_jira = jira_client.create_claim(message.from_user.id, self.ctx_data.get('claim_data', {}))
+            jira_client = get_async_jira_client(jira_token)
+            # вложение загружается параллельно с созданием заявки
+            attachments = session.attachments
+            result = None
+            if attachments:
+                response_claim_jira, result = await jira_client.create_claim_with_attachments(
+                    session.user_id, claim_data, attachments)
+            else:
+                response_claim_jira = await jira_client.create_claim(session.user_id, claim_data)
+            if not response_claim_jira:
+                await self.bot.send_message(message.chat.id, "Не удалось создать заявку")
+                await self.clear_claim_draft(session)
+                return
             jira_claim_number = response_claim_jira['issueKey'].split('-')[-1]
-            claim_link = jira_client.get_claim_link_by_number(jira_claim_number)
+            claim_link = await jira_client.get_claim_link_by_number(jira_claim_number)
             builder = InlineKeyboardBuilder()
             builder.row(
                 types.InlineKeyboardButton(
@@ -413,37 +514,23 @@ class TelegramBot:
                 )
             )
             markup = builder.as_markup()
-            if 'photo' in self.ctx_data:
-                result = jira_client.add_photo_to_claim(jira_claim_number, self.ctx_data['photo'],
-                                                        self.ctx_data.get('filename'))
-                if result:
-                    await self.bot.send_message(message.chat.id,
-                                                f"Заявка успешно создана, вложение успешно добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка:\n{claim_link}",
-                                                reply_markup=markup)
-                else:
-                    await self.bot.send_message(message.chat.id,
-                                                f"Заявка успешно создана, но вложение не добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка:\n{claim_link}",
-                                                reply_markup=markup)
-            elif 'attachment' in self.ctx_data:
-                result = jira_client.add_attachment_to_claim(jira_claim_number, self.ctx_data['attachment'],
-                                                             self.ctx_data.get('filename'))
-                if result:
-                    await self.bot.send_message(message.chat.id,
-                                                f"Заявка успешно создана, вложение успешно добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка:\n{claim_link}",
-                                                reply_markup=markup)
-                else:
-                    await self.bot.send_message(message.chat.id,
-                                                f"Заявка успешно создана, но вложение не добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка:\n{claim_link}",
-                                                reply_markup=markup)
+            if attachments and result:
+                await self.bot.send_message(message.chat.id,
+                                            f"Заявка успешно создана, вложение успешно добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка:\n{claim_link}",
+                                            reply_markup=markup)
+            elif attachments:
+                await self.bot.send_message(message.chat.id,
+                                            f"Заявка успешно создана, но вложение не добавлено, номер в Jira: <b>{jira_claim_number}</b>, ссылка:\n{claim_link}",
+                                            reply_markup=markup)
             else:
                 await self.bot.send_message(message.chat.id,
                                             f"Заявка успешно создана, номер в Jira: <b>{jira_claim_number}</b>, ссылка:\n{claim_link}",
                                             reply_markup=markup)
-            jira_client.logout()
         else:
             await self.bot.send_message(message.chat.id,
                                         f"Пользователь {message.from_user.id} не зарегистрирован в Supabase")
-        supabase_client.logout()
+        # Черновик заявки и вложения больше не нужны, следующая заявка начинается с чистой сессии
+        await self.clear_claim_draft(session)
 
     async def get_claim_input_number(self, call: types.CallbackQuery):
         await self.bot.send_message(call.message.chat.id, "Введите номер заявки:")
@@ -458,17 +545,23 @@ class TelegramBot:
             print("Не удалось удалить предыдущую клавиатуру:", e)
         start_index = int(start_index)
         buttons = []
-        list_of_claims = self.ctx_data.get('list_of_claims', [])
-        i, k = start_index, 0
-        while i < len(list_of_claims) and k < self.buttons_per_page:
+        session = self.get_call_session(call)
+        next_index = start_index + self.buttons_per_page
+        if session.claims_client is not None:
+            claims, total = await self.claims_page(session, start_index)
+            # следующая страница загружается заранее, пока пользователь смотрит текущую
+            if next_index < total and next_index not in session.claims_pages:
+                session.claims_pages[next_index] = asyncio.create_task(
+                    session.claims_client.get_claims_page(next_index, self.buttons_per_page))
+        else:
+            claims, total = session.list_of_claims[start_index:next_index], len(session.list_of_claims)
+        for claim in claims:
             buttons.append(
                 [types.InlineKeyboardButton(
-                    text=f"{list_of_claims[i]['number']} — {list_of_claims[i]['theme']}",
-                    callback_data=f"claim_{list_of_claims[i]['number']}"
+                    text=f"{claim['number']} — {claim['theme']}",
+                    callback_data=f"claim_{claim['number']}"
                 )]
             )
-            i += 1
-            k += 1
 
         builder = InlineKeyboardBuilder()
         # Кнопки навигации (предыдущие/следующие заявки)
@@ -477,7 +570,7 @@ class TelegramBot:
                 types.InlineKeyboardButton(text="<< Предыдущие заявки",
                                            callback_data=f"list_of_claims_{start_index - self.buttons_per_page}")
             )
-        if start_index + self.buttons_per_page < len(list_of_claims):
+        if next_index < total:
             builder.row(
                 types.InlineKeyboardButton(text="Следующие заявки >>",
                                            callback_data=f"list_of_claims_{start_index + self.buttons_per_page}")
@@ -494,64 +587,74 @@ class TelegramBot:
                                     "Выберите заявку для проверки её статуса:",
                                     reply_markup=markup)
 
-    def start_polling_scheduler(self):
-        # Планировщик опроса статусов заявок каждые 5 минут
-        schedule.every(5).minutes.do(self.poll_issue_status)
+    async def claims_page(self, session, offset):
+        # Страница заявок из Jira: из загруженных ранее, из предзагрузки или запросом; (заявки, всего)
+        page = session.claims_pages.get(offset)
+        if page is None:
+            page = await session.claims_client.get_claims_page(offset, self.buttons_per_page)
+        elif isinstance(page, asyncio.Task):
+            try:
+                page = await page
+            except Exception as e:
+                print(f"Ошибка предзагрузки страницы заявок: {e}")
+                page = await session.claims_client.get_claims_page(offset, self.buttons_per_page)
+        session.claims_pages[offset] = page
+        return page
 
-        def run_schedule():
-            while True:
-                schedule.run_pending()
-                time.sleep(1)
+    def start_polling_scheduler(self):
+        # Задача опроса запускается вместе с диспетчером и останавливается вместе с ним
+        self.dp.startup.register(self.on_startup)
+        self.dp.shutdown.register(self.on_shutdown)
+
+    async def on_startup(self):
+        self.loop = asyncio.get_running_loop()
+        self.notifications.start()
+        self.loop.run_in_executor(self.executor, self.subscription_poller.warm_up)
+        self.polling_task = asyncio.create_task(self.poll_loop())
+        if JIRA_WEBHOOK_ENABLED:
+            self.jira_webhook = JiraWebhookServer(self.subscription_poller.handle_jira_event)
+            await self.jira_webhook.start()
+
+    async def on_shutdown(self):
+        if self.polling_task:
+            self.polling_task.cancel()
+        if self.jira_webhook:
+            await self.jira_webhook.stop()
+        # поток уведомлений может ждать отправки в этом цикле - останавливаем его не блокируя цикл
+        await self.loop.run_in_executor(None, self.notifications.stop)
+        self.executor.shutdown(wait=False)
+        await close_http_session()
+        await self.storage.close()
+
+    async def poll_loop(self):
+        # Заявки проверяются по адаптивному расписанию поллера, задача просыпается к ближайшему сроку
+        while True:
+            try:
+                await self.poll_issue_status()
+            except Exception as e:
+                print(f"Ошибка опроса подписок: {e}")
+            await asyncio.sleep(self.subscription_poller.next_delay())
 
-        t = threading.Thread(target=run_schedule, daemon=True)
-        t.start()
+    async def poll_issue_status(self):
+        await self.loop.run_in_executor(self.executor, self.subscription_poller.poll)
 
-    def poll_issue_status(self):
-        try:
-            supabase_client = self.initialize_supabase_client()
-            user_list = supabase_client.get_user_list()
-            for user in user_list:
-                subscriptions = supabase_client.get_subscriptions(user)
-                jira_token = supabase_client.get_token_from_supabase(user)
-                if jira_token:
-                    jira_client = JiraClient(jira_token)
-                    if subscriptions:
-                        for sub in subscriptions:
-                            claim_number = os.environ.get("GIRA_PROJECT_KEY") + '-' + str(
-                                sub[os.environ.get("FIELD_SUBSCRIBE_CLAIM_NUMBER")]
-                            )
-                            last_status = sub.get(os.environ.get("FIELD_SUBSCRIBE_CLAIM_STATUS"), "")
-                            try:
-                                current_status = jira_client.check_claim_status(claim_number, user)['status']
-                                claim_link = jira_client.get_claim_link_by_number(
-                                    sub[os.environ.get("FIELD_SUBSCRIBE_CLAIM_NUMBER")]
-                                )
-                                if current_status != last_status:
-                                    supabase_client.update_subscription_status(user, claim_number, current_status)
-                                    asyncio.run(
-                                        self.bot.send_message(
-                                            user,
-                                            f"Статус заявки {claim_number} изменился с {last_status} на: {current_status}.\n{claim_link}"
-                                        )
-                                    )
-                                    if current_status in [os.environ.get("GIRA_TODO_DONE"), os.environ.get("GIRA_CLOSED")]:
-                                        jira_client.delete_subscription(user, sub[os.environ.get("FIELD_SUBSCRIBE_CLAIM_NUMBER")])
-                                        asyncio.run(
-                                            self.bot.send_message(user, f"Подписка на обновление статуса заявки удалена")
-                                        )
-                            except Exception as e:
-                                print(f"Ошибка опроса заявки {claim_number}: {e}")
-                    jira_client.logout()
-                # Можно добавить обработку случая отсутствия подписок
-            supabase_client.logout()
-        except Exception as e:
-            print(f"Ошибка подключения к Supabase: {e}")
+    def send_notification(self, chat_id, text, parse_mode=None):
+        # Вызывается из потока очереди уведомлений: сообщение отправляется в основном цикле через сессию бота,
+        # поток ждёт результата, чтобы ошибки (в том числе 429) вернулись в очередь
+        # parse_mode передаётся явно: по умолчанию бот размечает HTML, а обычный текст уведомлений не экранирован
+        future = asyncio.run_coroutine_threadsafe(self.bot.send_message(chat_id, text, parse_mode=parse_mode), self.loop)
+        future.result()
 
     async def reset_registration(self, message: types.Message):
         supabase_client = self.initialize_supabase_client()
         if supabase_client.check_user_token(message.from_user.id):
+            # убираем из кэша клиента Jira со старым токеном
+            jira_token = supabase_client.get_token_from_supabase(message.from_user.id)
+            if jira_token:
+                forget_jira_client(jira_token)
+                forget_async_jira_client(jira_token)
+                del jira_token
             response = supabase_client.delete_user_token(message.from_user.id)
-            supabase_client.logout()
             if response:
                 await self.bot.send_message(message.chat.id,
                                             "Токен пользователя был успешно удалён, пройдите регистрацию заново для дальнейшей работы")
@@ -563,8 +666,27 @@ class TelegramBot:
             await self.create_keyboard(message.chat.id, message.from_user.id)
 
     async def run(self):
-        # Бот передаётся в start_polling при запуске
-        await self.dp.start_polling(self.bot)
+        if os.environ.get("BOT_MODE", "polling") == "webhook":
+            await self.run_webhook()
+        else:
+            # Бот передаётся в start_polling при запуске
+            await self.dp.start_polling(self.bot)
+
+    async def run_webhook(self):
+        # start_polling сам вызывает startup/shutdown диспетчера, в режиме вебхука - вручную
+        server = WebhookServer(self.process_webhook_update)
+        await self.dp.emit_startup(bot=self.bot)
+        try:
+            # Без WEBHOOK_URL вебхук считается зарегистрированным снаружи (одна реплика или балансировщик)
+            if server.public_url():
+                await self.bot.set_webhook(server.public_url(), secret_token=server.secret)
+            await server.serve_forever()
+        finally:
+            await self.dp.emit_shutdown(bot=self.bot)
+            await self.bot.session.close()
+
+    async def process_webhook_update(self, update):
+        await self.dp.feed_update(self.bot, types.Update.model_validate(update, context={"bot": self.bot}))
 
 
 if __name__ == '__main__':
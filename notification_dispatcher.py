@@ -0,0 +1,254 @@
+from dotenv import load_dotenv
+from collections import OrderedDict, deque
+import html
+import json
+import os
+import threading
+import time
+
+
+class TokenBucket:
+    # rate токенов в секунду, не больше capacity подряд
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        # через сколько секунд будет доступен токен (0 - уже доступен)
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+def retry_after(error):
+    # Пауза, которую просит Telegram при превышении лимитов (ответ 429)
+    value = getattr(error, 'retry_after', None)   # aiogram: TelegramRetryAfter
+    if value is None:
+        result = getattr(error, 'result_json', None) or {}   # pyTelegramBotAPI: ApiTelegramException
+        value = (result.get('parameters') or {}).get('retry_after')
+    return value
+
+
+def is_permanent(error):
+    # Чат не найден, бот заблокирован, неверная разметка - повтор не поможет
+    if getattr(error, 'error_code', None) in (400, 403):
+        return True
+    return type(error).__name__ in ('TelegramForbiddenError', 'TelegramBadRequest')
+
+
+class NotificationDispatcher:
+    # Очередь исходящих уведомлений подписчикам. Отправляет отдельный поток с ограничением скорости:
+    # общий лимит бота и лимит на каждый чат (token bucket). Несколько уведомлений одному чату,
+    # накопившиеся в очереди, склеиваются в одно сообщение. На 429 вся отправка встаёт на retry_after,
+    # прочие ошибки повторяются с паузой. Очередь сохраняется в файл и переживает перезапуск бота
+    def __init__(self, send):
+        load_dotenv()
+        self.send = send   # send(chat_id, text, parse_mode=None) - фактическая отправка, бросает исключение при ошибке
+        self.global_rate = float(os.environ.get("NOTIFY_GLOBAL_RATE", 25))
+        self.chat_rate = float(os.environ.get("NOTIFY_CHAT_RATE", 1))
+        self.chat_burst = int(os.environ.get("NOTIFY_CHAT_BURST", 3))
+        self.max_attempts = int(os.environ.get("NOTIFY_MAX_ATTEMPTS", 5))
+        self.max_length = 4096   # предел длины сообщения Telegram
+        self.spool_path = os.environ.get("NOTIFY_SPOOL_PATH", "notifications_spool.json")
+        self.spool_interval = float(os.environ.get("NOTIFY_SPOOL_INTERVAL", 1))
+        self.stats_interval = float(os.environ.get("NOTIFY_STATS_INTERVAL", 300))
+
+        self.global_bucket = TokenBucket(self.global_rate, max(1, int(self.global_rate)))
+        self.chat_buckets = {}
+        self.chat_blocked_until = {}   # чат -> когда можно повторить после ошибки отправки
+        self.pending = OrderedDict()   # чат -> deque уведомлений; порядок - очередь обхода чатов
+        self.paused_until = 0
+        self.condition = threading.Condition()
+        self.spool_dirty = False
+        self.running = False
+        self.thread = None
+        self.started_at = time.monotonic()
+        self.last_stats = self.started_at
+        self.stats = {'enqueued': 0, 'sent': 0, 'delivered': 0, 'coalesced': 0, 'throttled': 0,
+                      'retried': 0, 'dropped': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+        self.load_spool()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="notifications", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout)
+        with self.condition:
+            self.save_spool()
+
+    def enqueue(self, chat_id, text, parse_mode=None):
+        # Сигнатура как у notify в SubscriptionPoller; вызывается из любого потока и не ждёт отправки
+        message = {'chat_id': chat_id, 'text': text, 'parse_mode': parse_mode,
+                   'queued_at': time.time(), 'attempts': 0, 'parts': 1}
+        with self.condition:
+            self.pending.setdefault(chat_id, deque()).append(message)
+            self.stats['enqueued'] += 1
+            self.spool_dirty = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                now = time.monotonic()
+                if now - self.last_stats >= self.stats_interval:
+                    self.last_stats = now
+                    print(f"Уведомления: {self.metrics()}")
+                message, delay = self.next_message(now)
+                if message is None:
+                    if self.spool_dirty:
+                        self.save_spool()
+                    self.condition.wait(timeout=min(delay, self.spool_interval) if delay else self.spool_interval)
+                    continue
+            self.deliver(message)
+
+    def next_message(self, now):
+        # Выбирает следующее сообщение с учётом лимитов; вызывается под self.condition.
+        # Возвращает (сообщение, None) или (None, сколько ждать)
+        if now < self.paused_until:
+            return None, self.paused_until - now
+        delay = None
+        for chat_id in list(self.pending):
+            wait = max(self.chat_bucket(chat_id).wait_time(now), self.chat_blocked_until.get(chat_id, 0) - now)
+            if wait > 0:
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            global_wait = self.global_bucket.wait_time(now)
+            if global_wait > 0:
+                return None, global_wait
+            self.chat_bucket(chat_id).consume(now)
+            self.global_bucket.consume(now)
+            message = self.coalesce(self.pending.pop(chat_id))
+            return message, None
+        return None, delay
+
+    def chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chat_buckets[chat_id]
+
+    def coalesce(self, queue):
+        # Склеивает уведомления чата в одно сообщение в пределах max_length; остаток возвращается в конец очереди обхода
+        message = dict(queue.popleft())
+        while queue:
+            following = queue[0]
+            text = self.joined_text(message, following)
+            if len(text) > self.max_length:
+                break
+            queue.popleft()
+            message['text'] = text
+            message['parse_mode'] = message['parse_mode'] or following['parse_mode']
+            message['queued_at'] = min(message['queued_at'], following['queued_at'])
+            message['parts'] += following['parts']
+            self.stats['coalesced'] += following['parts']
+        if queue:
+            self.pending[message['chat_id']] = queue
+        return message
+
+    def joined_text(self, message, following):
+        # Обычный текст, попадающий в сообщение с HTML-разметкой, экранируется
+        if message['parse_mode'] == following['parse_mode']:
+            return message['text'] + "\n\n" + following['text']
+        first = message['text'] if message['parse_mode'] else html.escape(message['text'])
+        second = following['text'] if following['parse_mode'] else html.escape(following['text'])
+        return first + "\n\n" + second
+
+    def deliver(self, message):
+        try:
+            self.send(message['chat_id'], message['text'], message['parse_mode'])
+        except Exception as e:
+            self.delivery_failed(message, e)
+            return
+        latency = time.time() - message['queued_at']
+        with self.condition:
+            self.chat_blocked_until.pop(message['chat_id'], None)
+            self.stats['sent'] += 1
+            self.stats['delivered'] += message['parts']
+            self.stats['latency_total'] += latency * message['parts']
+            self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+            self.spool_dirty = True
+
+    def delivery_failed(self, message, error):
+        now = time.monotonic()
+        pause = retry_after(error)
+        with self.condition:
+            if pause:
+                # 429 - лимит общий для бота, останавливаем всю отправку; попытка не засчитывается
+                self.stats['throttled'] += 1
+                self.paused_until = max(self.paused_until, now + float(pause))
+                print(f"Telegram ограничил отправку, пауза {pause} c")
+            elif is_permanent(error) or message['attempts'] + 1 >= self.max_attempts:
+                self.stats['dropped'] += message['parts']
+                self.spool_dirty = True
+                print(f"Уведомление в чат {message['chat_id']} не отправлено: {error}")
+                return
+            else:
+                message['attempts'] += 1
+                self.stats['retried'] += 1
+                self.chat_blocked_until[message['chat_id']] = now + min(60, 2 ** message['attempts'])
+                print(f"Ошибка отправки уведомления в чат {message['chat_id']}, попытка {message['attempts']}: {error}")
+            queue = self.pending.setdefault(message['chat_id'], deque())
+            queue.appendleft(message)
+            self.pending.move_to_end(message['chat_id'], last=False)
+
+    def metrics(self):
+        queued = sum(len(queue) for queue in self.pending.values())
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        delivered = self.stats['delivered']
+        return {
+            'queued': queued,
+            'sent': self.stats['sent'],
+            'delivered': delivered,
+            'coalesced': self.stats['coalesced'],
+            'throttled': self.stats['throttled'],
+            'retried': self.stats['retried'],
+            'dropped': self.stats['dropped'],
+            'messages_per_second': round(self.stats['sent'] / elapsed, 3),
+            'avg_latency': round(self.stats['latency_total'] / delivered, 3) if delivered else None,
+            'max_latency': round(self.stats['latency_max'], 3)
+        }
+
+    def load_spool(self):
+        if not self.spool_path or not os.path.exists(self.spool_path):
+            return
+        try:
+            with open(self.spool_path, encoding="utf-8") as spool:
+                messages = json.load(spool)
+        except (OSError, ValueError) as e:
+            print(f"Не удалось прочитать очередь уведомлений {self.spool_path}: {e}")
+            return
+        for message in messages:
+            self.pending.setdefault(message['chat_id'], deque()).append(message)
+        if messages:
+            print(f"Из очереди уведомлений восстановлено {len(messages)}")
+
+    def save_spool(self):
+        # Вызывается под self.condition; файл заменяется целиком, чтобы не остаться полузаписанным
+        if not self.spool_path:
+            self.spool_dirty = False
+            return
+        messages = [message for queue in self.pending.values() for message in queue]
+        tmp_path = self.spool_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as spool:
+                json.dump(messages, spool, ensure_ascii=False)
+            os.replace(tmp_path, self.spool_path)
+            self.spool_dirty = False
+        except OSError as e:
+            print(f"Не удалось сохранить очередь уведомлений {self.spool_path}: {e}")
@@ -0,0 +1,88 @@
+import heapq
+import random
+import threading
+import time
+
+
+class AdaptiveSchedule:
+    # Очередь заявок по сроку следующей проверки (heapq). После изменения заявки интервал сбрасывается
+    # до минимального, пока заявка не меняется - растёт в backoff раз до максимального. К сроку добавляется
+    # случайный разброс jitter, чтобы заявки, подписанные одновременно, не проверялись одной пачкой
+    def __init__(self, min_interval, max_interval, backoff=2.0, jitter=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.jitter = jitter
+        self.heap = []   # (срок, заявка)
+        self.due_at = {}   # заявка -> актуальный срок; записи кучи с другим сроком устарели и пропускаются
+        self.intervals = {}   # заявка -> текущий интервал, секунды
+        self.lock = threading.Lock()
+
+    def sync(self, claim_numbers):
+        # Новые заявки проверяются сразу, заявки без подписчиков забываются
+        now = time.monotonic()
+        with self.lock:
+            for claim_number in claim_numbers:
+                if claim_number not in self.intervals:
+                    self.intervals[claim_number] = self.min_interval
+                    self.push(claim_number, now)
+            for claim_number in [key for key in self.intervals if key not in claim_numbers]:
+                del self.intervals[claim_number]
+                self.due_at.pop(claim_number, None)
+            if len(self.heap) > 2 * len(self.due_at) + 100:
+                self.heap = [(at, key) for key, at in self.due_at.items()]
+                heapq.heapify(self.heap)
+
+    def pop_due(self):
+        # Заявки, срок которых наступил; до done или restore они не стоят в очереди
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                at, claim_number = heapq.heappop(self.heap)
+                if self.due_at.get(claim_number) != at:
+                    continue
+                del self.due_at[claim_number]
+                due.append(claim_number)
+        return due
+
+    def done(self, claim_number, active):
+        with self.lock:
+            interval = self.intervals.get(claim_number)
+            if interval is None:
+                return
+            interval = self.min_interval if active else min(self.max_interval, interval * self.backoff)
+            self.intervals[claim_number] = interval
+            self.push(claim_number, time.monotonic() + interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def restore(self, claim_numbers, delay=None):
+        # Заявки, проверка которых не состоялась (ошибка, группа пропущена), возвращаются в очередь с прежним
+        # интервалом или через delay
+        now = time.monotonic()
+        with self.lock:
+            for claim_number in claim_numbers:
+                if claim_number in self.intervals and claim_number not in self.due_at:
+                    self.push(claim_number, now + (self.intervals[claim_number] if delay is None else delay))
+
+    def next_delay(self):
+        # Сколько секунд до ближайшего срока; None - очередь пуста
+        with self.lock:
+            while self.heap and self.due_at.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return None
+            return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def push(self, claim_number, at):
+        # вызывается под self.lock
+        self.due_at[claim_number] = at
+        heapq.heappush(self.heap, (at, claim_number))
+
+    def stats(self):
+        with self.lock:
+            intervals = list(self.intervals.values())
+        return {
+            'tracked': len(intervals),
+            'min_interval_claims': sum(1 for interval in intervals if interval <= self.min_interval),
+            'avg_interval': round(sum(intervals) / len(intervals), 1) if intervals else None
+        }
@@ -0,0 +1,94 @@
+from dotenv import load_dotenv
+import os
+import threading
+import time
+
+
+class UserSession:
+    # Данные одного диалога (чат + пользователь): черновик заявки, вложения, список заявок для кнопок.
+    # __slots__ - сессий может быть много, лишний __dict__ на каждую не нужен
+    __slots__ = ('chat_id', 'user_id', 'claim_data', 'attachments', 'album', 'album_timer', 'lock',
+                 'list_of_claims', 'claims_client', 'claims_pages', 'touched_at')
+
+    def __init__(self, chat_id, user_id):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.claim_data = {}
+        self.attachments = []   # вложения заявки (jira_client.make_attachment)
+        self.album = []   # части альбома (media_group_id), ещё не собранные в заявку
+        self.album_timer = None
+        self.lock = threading.Lock()
+        self.list_of_claims = []   # список заявок для кнопок, если он уже целиком в памяти (подписки)
+        # Постраничный список заявок из Jira: клиент и загруженные страницы (смещение -> страница или её загрузка).
+        # Смещение показанной страницы хранится в callback_data кнопок
+        self.claims_client = None
+        self.claims_pages = {}
+        self.touched_at = time.monotonic()
+
+    def reset_claims_list(self, claims_client=None, list_of_claims=None):
+        # незавершённые предзагрузки старого списка больше не нужны: Future в main.py, asyncio.Task в main_async.py
+        for page in self.claims_pages.values():
+            if hasattr(page, 'cancel'):
+                page.cancel()
+        self.claims_client = claims_client
+        self.claims_pages = {}
+        self.list_of_claims = list_of_claims or []
+
+    def clear_claim(self):
+        # вложения - временные файлы (file_spool), закрытие освобождает память или удаляет файл с диска
+        for attachment in self.attachments:
+            attachment['file'].close()
+        self.claim_data = {}
+        self.attachments = []
+
+    def close(self):
+        # Сессия удаляется из хранилища: ждущий альбом отменяется, временные файлы вложений закрываются
+        if self.album_timer:
+            self.album_timer.cancel()
+            self.album_timer = None
+        self.album = []
+        self.clear_claim()
+        self.reset_claims_list()
+
+
+class SessionStore:
+    # Потокобезопасное хранилище сессий по ключу (chat_id, user_id) с удалением неактивных по ttl.
+    # Общее для main.py (обработчики в пуле потоков pyTelegramBotAPI) и main_async.py
+    def __init__(self, ttl=None, sweep_interval=60):
+        load_dotenv()
+        self.ttl = ttl if ttl is not None else int(os.environ.get("SESSION_TTL", 3600))
+        self.sweep_interval = sweep_interval
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+    def get(self, chat_id, user_id):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            if now - self.last_sweep > self.sweep_interval:
+                expired = self.sweep(now)
+            session = self.sessions.get((chat_id, user_id))
+            if session is None:
+                session = UserSession(chat_id, user_id)
+                self.sessions[(chat_id, user_id)] = session
+            session.touched_at = now
+        # файлы закрываются уже без общей блокировки
+        for expired_session in expired:
+            expired_session.close()
+        return session
+
+    def drop(self, chat_id, user_id):
+        with self.lock:
+            session = self.sessions.pop((chat_id, user_id), None)
+        if session is not None:
+            session.close()
+
+    def sweep(self, now):
+        # вызывается под self.lock; возвращает удалённые сессии, их нужно закрыть после снятия блокировки
+        expired = [key for key, session in self.sessions.items() if now - session.touched_at > self.ttl]
+        self.last_sweep = now
+        return [self.sessions.pop(key) for key in expired]
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,411 @@
+from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+import html
+import math
+import os
+import threading
+import time
+import requests
+from jira.exceptions import JIRAError
+from supabase_client import get_supabase_client
+from jira_client import get_jira_client, jira_metadata
+from issue_cache import issue_snapshots
+from poll_schedule import AdaptiveSchedule
+
+
+class SubscriptionPoller:
+    # Опрос подписок: за цикл строится индекс заявка -> подписчики, каждая заявка запрашивается в Jira
+    # один раз токеном одного из подписчиков, изменения раздаются всем подписчикам, которые являются её авторами.
+    # Сравнение с сохранёнными статусом и id последнего комментария - в памяти.
+    # За вызов poll проверяются только заявки, срок которых наступил по адаптивному расписанию: часто меняющиеся
+    # заявки - раз в min_interval, молчащие - всё реже, до max_interval.
+    def __init__(self, notify, min_interval=None):
+        load_dotenv()
+        self.notify = notify   # notify(chat_id, text, parse_mode=None) - отправка уведомления подписчику
+        self.project_key = os.environ.get("GIRA_PROJECT_KEY")
+        self.field_user_id = os.environ.get("FIELD_SUBSCRIBE_USER_ID")
+        self.field_claim_number = os.environ.get("FIELD_SUBSCRIBE_CLAIM_NUMBER")
+        self.field_claim_status = os.environ.get("FIELD_SUBSCRIBE_CLAIM_STATUS")
+        self.field_last_comment_id = os.environ.get("FIELD_SUBSCRIBE_LAST_COMMENT_ID")
+        self.done_status = os.environ.get("GIRA_TODO_DONE")
+        self.closed_status = os.environ.get("GIRA_CLOSED")
+        self.last_poll = {}   # заявка -> время последнего успешного опроса
+        # заявка -> {подписчик: значение updated, с которым заявка уже обработана}. Из-за запаса в минуту
+        # в minutes_since_last_poll заявка попадает в выборку повторно - по совпавшему updated она пропускается
+        # без запросов комментариев и записи в Supabase
+        self.seen_updated = {}
+        # сколько самых новых комментариев одной заявки присылать текстом за цикл; о более ранних новых
+        # комментариях подписчик получает одно сообщение с их числом и ссылкой на заявку
+        self.max_new_comments = int(os.environ.get("POLL_MAX_NEW_COMMENTS", 10))
+        self.jira_keys = {}   # подписчик -> key в Jira, если его нет в Supabase
+        # Экономия от объединения подписок: сколько поисков в Jira понадобилось бы при опросе каждой подписки
+        # отдельно (только по заявкам, которые удалось получить) и сколько ушло на самом деле, с повторами
+        # другими токенами. Пишут потоки групп и вебхук - под блокировкой
+        self.search_stats = {'searches': 0, 'subscriptions': 0}
+        self.search_stats_lock = threading.Lock()
+
+        # Группы заявок опрашиваются параллельно: общий пул потоков и отдельный лимит одновременных запросов
+        # на каждый хост Jira. Цикл не ждёт зависшую группу дольше cycle_timeout - она дорабатывает
+        # в фоне, а её владелец пропускается в следующих циклах, пока она не закончит
+        self.workers = int(os.environ.get("POLL_WORKERS", 8))
+        self.host_concurrency = int(os.environ.get("POLL_JIRA_HOST_CONCURRENCY", 4))
+        self.cycle_timeout = float(os.environ.get("POLL_CYCLE_TIMEOUT", 60))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="poll-user")
+        self.host_limits = {}
+        self.host_limits_lock = threading.Lock()
+        self.in_progress = set()
+        self.in_progress_lock = threading.Lock()
+        self.last_cycle_stats = None
+        # Заявка обрабатывается одним потоком за раз: одно и то же изменение могут одновременно увидеть
+        # обход подписок и вебхук Jira
+        self.claim_locks = {}
+        self.claim_locks_lock = threading.Lock()
+        # Индекс заявка -> подписчики последнего обхода; вебхуки Jira пользуются им, пока он не старше index_ttl
+        self.index = None
+        self.index_built_at = 0
+        self.index_ttl = float(os.environ.get("POLL_INDEX_TTL", 60))
+        self.webhook_events = 0
+        self.last_updated = {}   # заявка -> updated при последней проверке; изменился - заявка активна
+        # min_interval задаёт бот: с вебхуком Jira опрос - только редкая сверка
+        self.schedule = AdaptiveSchedule(min_interval or float(os.environ.get("POLL_MIN_INTERVAL", 60)),
+                                         float(os.environ.get("POLL_MAX_INTERVAL", 3600)),
+                                         float(os.environ.get("POLL_BACKOFF", 2)),
+                                         float(os.environ.get("POLL_JITTER", 0.1)))
+
+    def poll(self):
+        started = time.monotonic()
+        try:
+            supabase_client = get_supabase_client()
+            # пользователи и все подписки - двумя запросами не чаще раза в index_ttl
+            index = self.subscribers_index(supabase_client)
+        except Exception as e:
+            print(f"Ошибка подключения к Supabase: {e}")
+            return
+        if index is None:
+            return
+        self.forget_unsubscribed(index)
+        self.schedule.sync(index)
+        due_index = {claim_number: index[claim_number] for claim_number in self.schedule.pop_due()}
+        if not due_index:
+            return
+        stats_before = self.searches_snapshot()
+        futures = []
+        for fetcher, claim_numbers in self.assign_fetchers(due_index):
+            with self.in_progress_lock:
+                if fetcher['username'] in self.in_progress:
+                    print(f"Опрос заявок пользователя {fetcher['username']} ещё не закончился с прошлого цикла, пропускаем")
+                    self.schedule.restore(claim_numbers, self.schedule.min_interval)
+                    continue
+                self.in_progress.add(fetcher['username'])
+            futures.append(self.executor.submit(self.poll_claims_safe, supabase_client, fetcher, claim_numbers,
+                                                due_index))
+        done, not_done = wait(futures, timeout=self.cycle_timeout)
+        checked = sum(future.result() for future in done)
+        subscriptions_count = sum(len(subscribers) for subscribers in due_index.values())
+        # группы, не уложившиеся в цикл, досчитаются в следующем
+        stats_after = self.searches_snapshot()
+        searches = stats_after['searches'] - stats_before['searches']
+        saved = stats_after['subscriptions'] - stats_before['subscriptions'] - searches
+        self.last_cycle_stats = {
+            'duration': time.monotonic() - started,
+            'fetchers': len(futures),
+            'claims': len(due_index),
+            'checked_claims': checked,
+            'subscriptions': subscriptions_count,
+            'searches': searches,
+            'fetches_saved': saved,
+            'fetches_saved_total': self.fetches_saved,
+            'unfinished_fetchers': len(not_done),
+            **self.schedule.stats()
+        }
+        print(f"Цикл опроса: {self.last_cycle_stats['duration']:.2f} c, подписок {subscriptions_count}, "
+              f"заявок {len(due_index)} из {len(index)} (поисков в Jira {searches}, сэкономлено {saved}, всего {self.fetches_saved}), "
+              f"групп {len(futures)}, не уложились в цикл {len(not_done)}, потоков {self.workers}, "
+              f"средний интервал {self.last_cycle_stats['avg_interval']} c")
+
+    def searches_snapshot(self):
+        with self.search_stats_lock:
+            return dict(self.search_stats)
+
+    @property
+    def fetches_saved(self):
+        stats = self.searches_snapshot()
+        return stats['subscriptions'] - stats['searches']
+
+    def count_searches(self, searches, subscriptions):
+        with self.search_stats_lock:
+            self.search_stats['searches'] += searches
+            self.search_stats['subscriptions'] += subscriptions
+
+    def next_delay(self):
+        # Пауза до следующего вызова poll: до ближайшего срока, но не дольше index_ttl, чтобы новые подписки
+        # попадали в расписание без задержки
+        delay = self.schedule.next_delay()
+        return self.index_ttl if delay is None else min(max(delay, 1), self.index_ttl)
+
+    def build_index(self, users, subscriptions):
+        # заявка -> [(пользователь, подписка)]; подписки пользователей без токена не опрашиваются
+        users_by_id = {user['id']: user for user in users if user['has_token']}
+        index = {}
+        for sub in subscriptions:
+            user = users_by_id.get(sub.get(self.field_user_id))
+            if user is None:
+                continue
+            claim_number = self.project_key + '-' + str(sub[self.field_claim_number])
+            index.setdefault(claim_number, []).append((user, sub))
+        return index
+
+    def subscribers_index(self, supabase_client):
+        if self.index is None or time.monotonic() - self.index_built_at > self.index_ttl:
+            users = supabase_client.get_users()
+            subscriptions = supabase_client.get_all_subscriptions()
+            if users is not None and subscriptions is not None:
+                self.index, self.index_built_at = self.build_index(users, subscriptions), time.monotonic()
+        return self.index
+
+    def handle_jira_event(self, event):
+        # Событие вебхука Jira (изменение заявки или новый комментарий). Заявка с подписчиками сразу проверяется
+        # тем же путём, что и при обходе: права, дедупликация и запрос только новых комментариев - общие
+        if event.get('webhookEvent') not in ('jira:issue_updated', 'comment_created'):
+            return
+        claim_number = (event.get('issue') or {}).get('key')
+        if not claim_number:
+            return
+        issue_snapshots.invalidate(claim_number)
+        supabase_client = get_supabase_client()
+        subscribers = (self.subscribers_index(supabase_client) or {}).get(claim_number)
+        if not subscribers:
+            return
+        self.webhook_events += 1
+        fetcher = min((user for user, _ in subscribers), key=lambda user: user['id'])
+        self.poll_claims(supabase_client, fetcher, [claim_number], {claim_number: subscribers})
+
+    def claim_lock(self, claim_number):
+        with self.claim_locks_lock:
+            if claim_number not in self.claim_locks:
+                self.claim_locks[claim_number] = threading.Lock()
+            return self.claim_locks[claim_number]
+
+    def assign_fetchers(self, index):
+        # Каждая заявка запрашивается токеном одного подписчика - с наименьшим id, чтобы выбор не менялся
+        # между циклами; заявки одного владельца токена опрашиваются вместе пакетными запросами
+        groups = {}
+        for claim_number, subscribers in index.items():
+            fetcher = min((user for user, _ in subscribers), key=lambda user: user['id'])
+            groups.setdefault(fetcher['id'], (fetcher, []))[1].append(claim_number)
+        return list(groups.values())
+
+    def forget_unsubscribed(self, index):
+        # Заявки без подписчиков больше не отслеживаем. В эти словари параллельно пишут группы прошлого цикла,
+        # не уложившиеся в cycle_timeout, и вебхук Jira - обходим копии ключей (list() снимается под GIL целиком)
+        for claim_number in [key for key in list(self.last_poll) if key not in index]:
+            self.last_poll.pop(claim_number, None)
+        for claim_number in [key for key in list(self.seen_updated) if key not in index]:
+            self.seen_updated.pop(claim_number, None)
+        for claim_number in [key for key in list(self.last_updated) if key not in index]:
+            self.last_updated.pop(claim_number, None)
+        with self.claim_locks_lock:
+            for claim_number in [key for key in self.claim_locks if key not in index]:
+                self.claim_locks.pop(claim_number, None)
+
+    def poll_claims_safe(self, supabase_client, fetcher, claim_numbers, index):
+        # Возвращает количество проверенных заявок; ошибки одной группы не влияют на остальные
+        try:
+            return self.poll_claims(supabase_client, fetcher, claim_numbers, index)
+        except Exception as e:
+            print(f"Ошибка опроса заявок токеном пользователя {fetcher['username']}: {e}")
+            return 0
+        finally:
+            # заявки, которые не дошли до проверки, возвращаются в расписание
+            self.schedule.restore(claim_numbers)
+            with self.in_progress_lock:
+                self.in_progress.discard(fetcher['username'])
+
+    def host_limit(self, jira_client):
+        host = urlparse(jira_client.domain).netloc
+        with self.host_limits_lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.host_concurrency)
+            return self.host_limits[host]
+
+    def warm_up(self):
+        # Прогрев кэша метаданных Jira (serviceDeskId, типы запросов) токеном первого подходящего пользователя,
+        # чтобы первая заявка и первый опрос не ходили за ними
+        try:
+            supabase_client = get_supabase_client()
+            for user in supabase_client.get_users():
+                if not user['has_token']:
+                    continue
+                jira_token = supabase_client.get_token_from_supabase(user['username'])
+                if not jira_token:
+                    continue
+                jira_client = get_jira_client(jira_token)
+                del jira_token
+                try:
+                    if jira_metadata.load(jira_client)['service_desk_id']:
+                        print('Метаданные Jira загружены')
+                        return
+                except Exception as e:
+                    print(f"Не удалось загрузить метаданные Jira токеном пользователя {user['username']}: {e}")
+        except Exception as e:
+            print(f"Ошибка прогрева метаданных Jira: {e}")
+
+    def poll_claims(self, supabase_client, fetcher, claim_numbers, index, tried=()):
+        # tried - подписчики, чьими токенами эти заявки уже не удалось проверить
+        tried = set(tried) | {fetcher['id']}
+        unavailable = set()   # заявки, недоступные токену fetcher (нет токена, отозван, нет прав)
+        failed = set()
+        updates = {}
+        jira_client = self.user_jira_client(supabase_client, fetcher)
+        if jira_client is None:
+            unavailable.update(claim_numbers)
+        else:
+            started = time.time()
+            search_stats = {'searches': 0}
+            try:
+                with self.host_limit(jira_client):
+                    # без reporter = currentUser(): заявка общая для всех подписчиков, авторство проверяется ниже для каждого
+                    updates = jira_client.get_claims_updates(claim_numbers, self.minutes_since_last_poll(claim_numbers),
+                                                             own_only=False, errors=unavailable, stats=search_stats)
+            except Exception:
+                self.count_searches(search_stats['searches'], 0)
+                raise
+            # при опросе каждой подписки отдельно полученные заявки стоили бы по поиску на подписчика
+            self.count_searches(search_stats['searches'],
+                                sum(len(index.get(claim_number, [])) for claim_number in claim_numbers
+                                    if claim_number not in unavailable))
+            for claim_number, claim_status in updates.items():
+                try:
+                    # комментарии и ссылка на заявку - тоже запросы к Jira, под тем же лимитом хоста
+                    with self.claim_lock(claim_number), self.host_limit(jira_client):
+                        if not self.process_claim(supabase_client, jira_client, fetcher, claim_number, claim_status,
+                                                  index.get(claim_number, [])):
+                            failed.add(claim_number)
+                except Exception as e:
+                    failed.add(claim_number)
+                    print(f"Ошибка опроса заявки {claim_number}: {e}")
+            for claim_number in claim_numbers:
+                # Заявка с ошибкой остаётся на прежнем окне updated: иначе следующий поиск начнётся уже после
+                # необработанного изменения и оно потеряется. В расписание её вернёт poll_claims_safe
+                if claim_number in failed or claim_number in unavailable:
+                    continue
+                self.claim_checked(claim_number, started, updates.get(claim_number))
+        return len(claim_numbers) - len(failed) - len(unavailable) + \
+            self.poll_with_other_tokens(supabase_client, unavailable, index, tried)
+
+    def poll_with_other_tokens(self, supabase_client, claim_numbers, index, tried):
+        # Недоступные заявки проверяются токеном следующего подписчика. Если пробовать больше некем, заявку
+        # не видит ни один подписчик - её окно сдвигается, чтобы она не расширяла поиск остальных заявок группы
+        retry_index = {}
+        for claim_number in claim_numbers:
+            subscribers = [(user, sub) for user, sub in index.get(claim_number, []) if user['id'] not in tried]
+            if subscribers:
+                retry_index[claim_number] = subscribers
+            else:
+                print(f"Заявку {claim_number} не удалось проверить токеном ни одного подписчика")
+                self.claim_checked(claim_number, time.time(), None)
+        checked = 0
+        for next_fetcher, retry_claims in self.assign_fetchers(retry_index):
+            checked += self.poll_claims(supabase_client, next_fetcher, retry_claims, index, tried)
+        return checked
+
+    def claim_checked(self, claim_number, started, update):
+        self.last_poll[claim_number] = started
+        # заявка активна, если с прошлой проверки у неё сменился updated
+        active = update is not None and update['last_update'] != self.last_updated.get(claim_number)
+        if update is not None:
+            self.last_updated[claim_number] = update['last_update']
+        self.schedule.done(claim_number, active)
+
+    def user_jira_client(self, supabase_client, user):
+        jira_token = supabase_client.get_token_from_supabase(user['username'])
+        if not jira_token:
+            return None
+        try:
+            # JIRA() при создании запрашивает server_info: отозванный токен или сбой сети всплывают здесь,
+            # такие заявки уходят на проверку токеном другого подписчика
+            return get_jira_client(jira_token, user['jira_user_id'])
+        except (JIRAError, requests.RequestException) as e:
+            print(f"Не удалось подключиться к Jira токеном пользователя {user['username']}: {e}")
+            return None
+        finally:
+            del jira_token
+
+    def minutes_since_last_poll(self, claim_numbers):
+        # Заявка, которую ещё не опрашивали, - без фильтра по updated; дальше с запасом в минуту,
+        # повторно попавшие заявки безопасны: сравнение идёт с тем, что уже сохранено в базе
+        last_polls = [self.last_poll.get(claim_number) for claim_number in claim_numbers]
+        if not last_polls or None in last_polls:
+            return None
+        return math.ceil((time.time() - min(last_polls)) / 60) + 1
+
+    def subscriber_jira_key(self, supabase_client, fetcher, fetcher_client, user):
+        if user['jira_user_id']:
+            return str(user['jira_user_id'])
+        if user['username'] not in self.jira_keys:
+            # key в Jira не сохранён в Supabase - узнаём его один раз собственным токеном подписчика
+            jira_client = fetcher_client if user['id'] == fetcher['id'] else self.user_jira_client(supabase_client, user)
+            if jira_client is None:
+                return None
+            self.jira_keys[user['username']] = jira_client.get_myself_key()
+        return self.jira_keys[user['username']]
+
+    def process_claim(self, supabase_client, jira_client, fetcher, claim_number, claim_status, subscribers):
+        # False - не все подписчики получили изменения, заявку нужно проверить повторно с прежним окном
+        seen = self.seen_updated.setdefault(claim_number, {})
+        pending = []
+        for user, sub in subscribers:
+            if seen.get(user['username']) == claim_status['last_update']:
+                continue
+            # подписка действует, только пока подписчик - автор заявки, как и при проверке своим токеном
+            if self.subscriber_jira_key(supabase_client, fetcher, jira_client, user) != claim_status['reporter']:
+                continue
+            pending.append((user, sub))
+        if not pending:
+            return True
+        # Новые комментарии запрашиваются один раз на заявку - от самого раннего сохранённого id среди подписчиков
+        since_id = min(int(sub.get(self.field_last_comment_id) or 0) for _, sub in pending)
+        new_comments = jira_client.get_new_comments(claim_number, since_id)
+        claim_link = jira_client.get_claim_link_by_number(claim_number.split('-')[-1])
+        processed = True
+        for user, sub in pending:
+            try:
+                self.process_update(supabase_client, user, claim_number, sub, claim_status, new_comments, claim_link)
+                seen[user['username']] = claim_status['last_update']
+            except Exception as e:
+                processed = False
+                print(f"Ошибка уведомления пользователя {user['username']} по заявке {claim_number}: {e}")
+        return processed
+
+    def process_update(self, supabase_client, user, claim_number, sub, claim_status, new_comments, claim_link):
+        # Сюда попадают только заявки, изменённые с прошлого опроса; из комментариев заявки подписчику
+        # достаются только новее сохранённого у него id
+        last_status = sub.get(self.field_claim_status, "")
+        last_comment_id = int(sub.get(self.field_last_comment_id) or 0)
+        current_status = claim_status['status']
+        new_comments = [comment for comment in new_comments if comment['id'] > last_comment_id]
+        if current_status == last_status and not new_comments:
+            return
+        # у заявки без service desk ссылки нет - тогда сообщение без строки со ссылкой
+        link_line = f"\n{claim_link}" if claim_link else ""
+        # Каждый шаг сохраняется сразу после себя (в Supabase и в подписке из индекса, которую переиспользуют
+        # вебхуки): ошибка на следующем шаге не приводит к повторной отправке уже доставленного
+        if current_status != last_status:
+            print('Статусы отличаются, cur = ', current_status, ' last = ', last_status)
+            supabase_client.update_subscription_status(user['id'], claim_number, current_status)
+            sub[self.field_claim_status] = current_status
+            self.notify(user['username'], f"Статус заявки {claim_number} изменился с {last_status} на: {current_status}.{link_line}")
+            if current_status in [self.done_status, self.closed_status]:
+                supabase_client.delete_subscription(user['id'], sub[self.field_claim_number])
+                self.notify(user['username'], f"Подписка на обновление статуса заявки удалена")
+        if new_comments:
+            print('Новых комментариев: ', len(new_comments), 'last = ', last_comment_id)
+            skipped = len(new_comments) - self.max_new_comments
+            if skipped > 0:
+                self.notify(user['username'], f"У заявки {claim_number} ещё {skipped} новых комментариев, которые не поместились в уведомления, - они есть в заявке.{link_line}")
+            for comment in new_comments[-self.max_new_comments:]:
+                # текст и автор комментария приходят из Jira как есть - в HTML-сообщении их нужно экранировать
+                self.notify(user['username'], f"У заявки {claim_number} появился новый комментарий от <b>{html.escape(comment['author'])}</b>:\n{html.escape(comment['text'])}.{html.escape(link_line)}", parse_mode='HTML')
+            supabase_client.update_subscription_id(user['id'], claim_number, new_comments[-1]['id'])
+            sub[self.field_last_comment_id] = new_comments[-1]['id']
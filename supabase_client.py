@@ -1,8 +1,45 @@
 from dotenv import load_dotenv
 import os
+import threading
+import time
+from collections import OrderedDict
 from supabase import create_client, Client
 
 
+class TokenCache:
+    # Расшифрованные токены Jira только в памяти процесса: ограниченный размер (LRU) и время жизни записи
+    def __init__(self, max_size=1000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tokens = OrderedDict()   # username -> (токен, время истечения)
+        self.lock = threading.Lock()
+
+    def get(self, username):
+        username = str(username)   # id Telegram приходит то числом, то строкой
+        with self.lock:
+            item = self.tokens.get(username)
+            if item is None:
+                return None
+            token, expires_at = item
+            if expires_at < time.monotonic():
+                del self.tokens[username]
+                return None
+            self.tokens.move_to_end(username)
+            return token
+
+    def set(self, username, token):
+        username = str(username)
+        with self.lock:
+            self.tokens[username] = (token, time.monotonic() + self.ttl)
+            self.tokens.move_to_end(username)
+            while len(self.tokens) > self.max_size:
+                self.tokens.popitem(last=False)
+
+    def invalidate(self, username):
+        with self.lock:
+            self.tokens.pop(str(username), None)
+
+
 class SupabaseClient:
     def __init__(self):
         load_dotenv()   # Загрузить переменные окружения из .env
@@ -32,6 +69,8 @@ class SupabaseClient:
         self.field_claim_number = os.environ.get("FIELD_SUBSCRIBE_CLAIM_NUMBER")
         self.field_claim_status = os.environ.get("FIELD_SUBSCRIBE_CLAIM_STATUS")
         self.field_last_comment_id = os.environ.get("FIELD_SUBSCRIBE_LAST_COMMENT_ID")
+        self.token_cache = TokenCache(int(os.environ.get("TOKEN_CACHE_SIZE", 1000)),
+                                      int(os.environ.get("TOKEN_CACHE_TTL", 300)))
         # Создать клиента Supabase с использованием анонимного ключа
         self.client: Client = create_client(self.url, self.anon_key)
         self.user = None # для будущей аутентификации
@@ -44,6 +83,17 @@ class SupabaseClient:
         self.user = auth_response
         return auth_response
 
+    def ensure_session(self):
+        # get_session() сам обновляет истёкший access token по refresh token,
+        # повторный вход по паролю - только если сессию восстановить не удалось
+        try:
+            session = self.client.auth.get_session()
+        except Exception as e:
+            print(f"Не удалось обновить сессию Supabase: {e}")
+            session = None
+        if session is None:
+            self.sign_in()
+
     def get_data(self, table_name: str):
         response = self.client.table(self.table_users).select("*").execute()
         return response
@@ -72,6 +122,7 @@ class SupabaseClient:
             return False
 
     def add_user(self, username: int, token: str, email: str, jira_user_id: int): # registration_data: dict):
+        self.token_cache.invalidate(username)
         if not self.check_user_token(username):
             data = {
                 self.field_username: username,
@@ -105,6 +156,7 @@ class SupabaseClient:
                     return None
 
     def add_user_without_email(self, username: int, token: str): # registration_data: dict):
+        self.token_cache.invalidate(username)
         if not self.check_user_token(username):
             data = {
                 self.field_username: username,
@@ -125,16 +177,50 @@ class SupabaseClient:
                 return {'error': str(e)}
             return None
 
+    def get_user(self, username: int):
+        # Один запрос вместо цепочки check_user -> get_user_id_by_username -> check_user_token:
+        # возвращает описание пользователя; его 'id' передаётся в методы подписок как user_id
+        try:
+            response = self.client.table(self.table_users).select(self.user_fields()).eq(self.field_username, username).execute()
+            data = response.data
+            if data and len(data) > 0:
+                return self.user_from_row(data[0])
+        except Exception as e:
+            print(f"Error searching user '{username}': {str(e)}")
+        return None
+
+    def get_users(self):
+        try:
+            response = self.client.table(self.table_users).select(self.user_fields()).execute()
+            return [self.user_from_row(row) for row in response.data]
+        except Exception as e:
+            print(f"Ошибка получения пользователей: {e}")
+            return None
+
+    def user_fields(self):
+        return f"id,{self.field_username},{self.field_email},{self.field_jira_user_id},{self.field_token}"
+
+    def user_from_row(self, row):
+        token = row.get(self.field_token)
+        user = {
+            'id': row.get("id"),
+            'username': row.get(self.field_username),
+            'email': row.get(self.field_email),
+            'jira_user_id': row.get(self.field_jira_user_id),
+            'has_token': token is not None and token != ""
+        }
+        del token
+        return user
+
     def get_user_id_by_username(self, username: int):
-        if self.check_user(username):
-            try:
-                response = self.client.table(self.table_users).select("id").eq(self.field_username, username).execute()
-                data = response.data
-                if data and len(data) > 0:
-                    return data[0].get("id")
-            except Exception as e:
-                print(f"Error searching user '{username}': {str(e)}")
-                return None
+        try:
+            response = self.client.table(self.table_users).select("id").eq(self.field_username, username).execute()
+            data = response.data
+            if data and len(data) > 0:
+                return data[0].get("id")
+        except Exception as e:
+            print(f"Error searching user '{username}': {str(e)}")
+            return None
         return None
 
     def get_username_by_user_id(self, user_id: int):
@@ -149,38 +235,41 @@ class SupabaseClient:
         return None
 
     def get_user_email(self, username: int):
-        if self.check_user(username):
-            try:
-                response = self.client.table(self.table_users).select(self.field_email).eq(self.field_username, username).execute()
-                data = response.data
-                if data and len(data) > 0:
-                    return data[0][self.field_email]
-            except Exception as e:
-                print(f"Error searching user email '{username}': {str(e)}")
-                return None
+        try:
+            response = self.client.table(self.table_users).select(self.field_email).eq(self.field_username, username).execute()
+            data = response.data
+            if data and len(data) > 0:
+                return data[0][self.field_email]
+        except Exception as e:
+            print(f"Error searching user email '{username}': {str(e)}")
+            return None
         return None
 
     def get_token_from_supabase(self, username: int):
-        if self.check_user(username):
-            try:
-                response = self.client.rpc(self.supabase_func_of_read, {
-                    "p_name": username,
-                    "p_key": self.secret_code_for_token
-                }).execute()
+        # Сначала кэш в памяти; RPC расшифровки - только при промахе. Отдельный check_user не нужен:
+        # для неизвестного пользователя RPC ничего не вернёт
+        token = self.token_cache.get(username)
+        if token:
+            return token
+        try:
+            response = self.client.rpc(self.supabase_func_of_read, {
+                "p_name": username,
+                "p_key": self.secret_code_for_token
+            }).execute()
 
-                if response.data:
-                    token = response.data
-                    return token
-                else:
-                    print("Токен не найден или произошла ошибка:", response.error)
-                    return None
-            except Exception as e:
-                print(f"Не удалось получить токен для пользователя {username}: {str(e)}")
+            if response.data:
+                token = response.data
+                self.token_cache.set(username, token)
+                return token
+            else:
+                print(f"Токен пользователя {username} не найден")
                 return None
-        else:
-            print(f"Нет пользователя с именем {username}")
+        except Exception as e:
+            print(f"Не удалось получить токен для пользователя {username}: {str(e)}")
+            return None
 
     def delete_user_token(self, username: int):
+        self.token_cache.invalidate(username)
         try:
             response = self.client.rpc(self.supabase_func_of_delete, {
                 "p_name": username,
@@ -193,6 +282,7 @@ class SupabaseClient:
             return None
 
     def delete_user(self, username: int):
+        self.token_cache.invalidate(username)
         try:
             response = self.client.table(self.table_users) \
                 .delete(returning="representation") \
@@ -203,9 +293,8 @@ class SupabaseClient:
             print(f"Ошибка удаления пользователя {username}: {e}")
             return None
 
-    def save_subscription(self, username, claim_number, status, last_comment_id=0):
+    def save_subscription(self, user_id, claim_number, status, last_comment_id=0):
         try:
-            user_id = self.get_user_id_by_username(username)
             response = self.client.table(self.table_subscriptions).insert({
                 self.field_user_id: user_id,
                 self.field_claim_number: claim_number.split('-')[1],
@@ -217,9 +306,8 @@ class SupabaseClient:
             print(f"Ошибка сохранения подписки: {e}")
             return None
 
-    def delete_subscription(self, username, claim_number):
+    def delete_subscription(self, user_id, claim_number):
         try:
-            user_id = self.get_user_id_by_username(username)
             response = self.client.table(self.table_subscriptions) \
                 .delete(returning="representation") \
                 .eq(self.field_user_id, user_id) \
@@ -230,8 +318,7 @@ class SupabaseClient:
             print(f"Ошибка удаления подписки: {e}")
             return None
 
-    def get_subscriptions(self, username, fields="*"):
-        user_id = self.get_user_id_by_username(username)
+    def get_subscriptions(self, user_id, fields="*"):
         try:
             response = self.client.table(self.table_subscriptions) \
                 .select(fields) \
@@ -239,14 +326,30 @@ class SupabaseClient:
                 .execute()
             return response.data
         except Exception as e:
-            print(f"Ошибка получения подписок для пользователя {username}: {e}")
+            print(f"Ошибка получения подписок для пользователя {user_id}: {e}")
+            return None
+
+    def get_all_subscriptions(self, fields="*", page_size=1000):
+        # Подписки всех пользователей постранично (PostgREST отдаёт не больше page_size строк за запрос)
+        subscriptions = []
+        try:
+            while True:
+                response = self.client.table(self.table_subscriptions) \
+                    .select(fields) \
+                    .order("id") \
+                    .range(len(subscriptions), len(subscriptions) + page_size - 1) \
+                    .execute()
+                subscriptions.extend(response.data)
+                if len(response.data) < page_size:
+                    return subscriptions
+        except Exception as e:
+            print(f"Ошибка получения всех подписок: {e}")
             return None
 
-    def is_subscription(self, username, number):
+    def is_subscription(self, user_id, number):
         try:
-            user_id = self.get_user_id_by_username(username)
             if not user_id:
-                print(f"Пользователя {username} нет в базе")
+                print("Пользователя нет в базе")
                 return None
             response = self.client.table(self.table_subscriptions).select("*").eq(self.field_user_id, user_id).eq(self.field_claim_number, number.split('-')[1]).execute()
             data = response.data
@@ -255,24 +358,27 @@ class SupabaseClient:
             print(f"Ошибка проверки подписки: {e}")
             return None
 
-    def can_subscription(self, username, number, status, comment_id=0):
+    def get_subscribed_claims(self, user_id):
+        # Номера заявок пользователя и их количество одним запросом: по ним проверяются
+        # и наличие подписки, и лимит подписок перед can_subscription
         try:
-            user_id = self.get_user_id_by_username(username)
-            if not user_id:
-                print(f"Пользователя {username} нет в базе")
-                return None
             response = self.client.table(self.table_subscriptions) \
-                .select("id", count="exact") \
+                .select(self.field_claim_number, count="exact") \
                 .eq(self.field_user_id, user_id) \
                 .execute()
-            subscribe_count = str(response.count) #data
-            if response.count < self.max_subscribe:
-                return self.save_subscription(username, number, status, comment_id)
-            else:
-                return {"error": True, "code": "LIMIT_EXCEEDED"}
+            return [str(row[self.field_claim_number]) for row in response.data], response.count
         except Exception as e:
-            print(f"Ошибка проверки подписки: {e}")
+            print(f"Ошибка получения подписок для пользователя {user_id}: {e}")
+            return None, None
+
+    def can_subscription(self, user_id, subscribe_count, number, status, comment_id=0):
+        # subscribe_count - количество подписок из get_subscribed_claims
+        if subscribe_count >= self.max_subscribe:
+            return {"error": True, "code": "LIMIT_EXCEEDED"}
+        response = self.save_subscription(user_id, number, status, comment_id)
+        if response is None:
             return {"error": True, "code": "SUPABASE_ERROR"}
+        return response
 
     def get_user_list(self):
         try:
@@ -282,9 +388,8 @@ class SupabaseClient:
             print(f"Ошибка получения подписок: {e}")
             return None
 
-    def update_subscription_status(self, username, claim_number, new_status):
+    def update_subscription_status(self, user_id, claim_number, new_status):
         try:
-                user_id = self.get_user_id_by_username(username)
                 response = self.client.table(self.table_subscriptions).update({self.field_claim_status: new_status})\
                     .eq(self.field_user_id, user_id)\
                     .eq(self.field_claim_number, int(claim_number.split('-')[1]))\
@@ -293,9 +398,8 @@ class SupabaseClient:
         except Exception as e:
                 print(f"Ошибка обновления статуса подписки: {e}")
 
-    def update_subscription_id(self, username, claim_number, new_id):
+    def update_subscription_id(self, user_id, claim_number, new_id):
         try:
-                user_id = self.get_user_id_by_username(username)
                 response = self.client.table(self.table_subscriptions).update({self.field_last_comment_id: new_id})\
                     .eq(self.field_user_id, user_id)\
                     .eq(self.field_claim_number, int(claim_number.split('-')[1]))\
@@ -314,6 +418,24 @@ class SupabaseClient:
             return None
 
 
+# Один клиент на процесс: HTTP-соединения к PostgREST переиспользуются (пул httpx внутри supabase-py),
+# вход по паролю выполняется один раз, дальше токен сессии обновляется автоматически
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def get_supabase_client():
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            client = SupabaseClient()
+            client.sign_in()
+            _shared_client = client
+        else:
+            _shared_client.ensure_session()
+        return _shared_client
+
+
 if __name__ == "__main__":
     supabase_client = SupabaseClient()
     supabase_client.sign_in()
@@ -0,0 +1,102 @@
+from jira.exceptions import JIRAError
+
+import subscription_poller
+from subscription_poller import SubscriptionPoller
+
+ALICE = {'id': 1, 'username': 100, 'email': None, 'jira_user_id': 'alice', 'has_token': True}
+BOB = {'id': 2, 'username': 200, 'email': None, 'jira_user_id': 'bob', 'has_token': True}
+
+SUBSCRIPTION_ENV = {"GIRA_PROJECT_KEY": "SD", "FIELD_SUBSCRIBE_USER_ID": "user_id",
+                    "FIELD_SUBSCRIBE_CLAIM_NUMBER": "claim_number",
+                    "FIELD_SUBSCRIBE_CLAIM_STATUS": "claim_status",
+                    "FIELD_SUBSCRIBE_LAST_COMMENT_ID": "last_comment_id",
+                    "GIRA_TODO_DONE": "Done", "GIRA_CLOSED": "Closed"}
+
+
+class FakeSupabase:
+    def __init__(self, subscriptions, users=(ALICE, BOB)):
+        self.subscriptions = subscriptions
+        self.users = list(users)
+        self.calls = []
+
+    def get_users(self):
+        return self.users
+
+    def get_all_subscriptions(self, fields="*", page_size=1000):
+        return [dict(sub) for sub in self.subscriptions]
+
+    def get_token_from_supabase(self, username):
+        return f"token-{username}"
+
+    def username(self, user_id):
+        return next(user['username'] for user in self.users if user['id'] == user_id)
+
+    def update_subscription_status(self, user_id, claim_number, new_status):
+        self.calls.append(('status', self.username(user_id), claim_number, new_status))
+
+    def update_subscription_id(self, user_id, claim_number, new_id):
+        self.calls.append(('comment', self.username(user_id), claim_number, new_id))
+
+    def delete_subscription(self, user_id, claim_number):
+        self.calls.append(('delete', self.username(user_id), claim_number))
+
+
+class FakeJira:
+    # Заявки в Jira, общие для всех токенов; у каждого токена свой клиент (FakeJiraClient)
+    def __init__(self):
+        self.domain = "https://jira.example.com"
+        self.issues = {}
+        self.comments = {}
+        self.link = True
+        self.searches = []   # (токен, заявки) каждого поиска
+        self.comment_requests = []   # (заявка, since_id) каждого запроса комментариев
+        self.unreadable = {}   # токен -> заявки, к которым у него нет доступа
+        self.broken_tokens = set()   # токены, с которыми клиент не создаётся (отозван)
+
+    def client(self, token, jira_user_id=None):
+        if token in self.broken_tokens:
+            raise JIRAError(status_code=401, text="Unauthorized")
+        return FakeJiraClient(self, token)
+
+
+class FakeJiraClient:
+    def __init__(self, jira, token):
+        self.jira = jira
+        self.token = token
+        self.domain = jira.domain
+
+    def get_claims_updates(self, claim_numbers, updated_minutes_ago=None, own_only=True, errors=None, stats=None):
+        self.jira.searches.append((self.token, list(claim_numbers)))
+        if stats is not None:
+            stats['searches'] += 1
+        unreadable = self.jira.unreadable.get(self.token, set())
+        if errors is not None:
+            errors.update(key for key in claim_numbers if key in unreadable)
+        return {key: dict(self.jira.issues[key]) for key in claim_numbers
+                if key in self.jira.issues and key not in unreadable}
+
+    def get_new_comments(self, issue_key, since_id=0):
+        self.jira.comment_requests.append((issue_key, since_id))
+        return [comment for comment in self.jira.comments.get(issue_key, []) if comment['id'] > since_id]
+
+    def get_claim_link_by_number(self, number):
+        return f"{self.domain}/browse/SD-{number}" if self.jira.link else None
+
+    def get_myself_key(self):
+        raise AssertionError("key подписчика должен браться из Supabase")
+
+
+class PollerEnv:
+    def __init__(self, monkeypatch, subscriptions, users=(ALICE, BOB)):
+        for name, value in SUBSCRIPTION_ENV.items():
+            monkeypatch.setenv(name, value)
+        self.jira = FakeJira()
+        self.supabase = FakeSupabase(subscriptions, users)
+        monkeypatch.setattr(subscription_poller, "get_supabase_client", lambda: self.supabase)
+        monkeypatch.setattr(subscription_poller, "get_jira_client", self.jira.client)
+        self.notifications = []
+        self.poller = SubscriptionPoller(
+            lambda chat_id, text, parse_mode=None: self.notifications.append((chat_id, text, parse_mode)))
+
+    def close(self):
+        self.poller.executor.shutdown(wait=True)
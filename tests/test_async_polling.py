@@ -0,0 +1,109 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("aiogram")
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web
+
+import main_async
+from notification_dispatcher import NotificationDispatcher
+
+POLL_BLOCKS = 0.2   # столько блокирующей работы (Supabase, Jira) в каждом цикле опроса
+NOTIFICATIONS_PER_POLL = 25
+
+
+class FakeBot:
+    # Отправка через одну aiohttp-сессию, как у aiogram Bot: сессия работает только в своём цикле
+    def __init__(self, session, url):
+        self.session = session
+        self.url = url
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        async with self.session.post(self.url, json={'chat_id': chat_id, 'text': text}) as response:
+            response.raise_for_status()
+
+
+class BlockingPoller:
+    def __init__(self, notify):
+        self.notify = notify
+        self.cycles = 0
+
+    def poll(self):
+        time.sleep(POLL_BLOCKS)
+        for chat_id in range(NOTIFICATIONS_PER_POLL):
+            self.notify(chat_id, f"цикл {self.cycles}")
+        self.cycles += 1
+
+    def next_delay(self):
+        return 0.01
+
+
+async def start_telegram_api(received):
+    async def send_message(request):
+        received.append(await request.json())
+        return web.json_response({'ok': True})
+
+    app = web.Application()
+    app.router.add_post('/sendMessage', send_message)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}/sendMessage"
+
+
+def delivered(received):
+    # сообщения одному чату могут склеиться в одно - считаем уведомления, а не запросы
+    return sum(message['text'].count("цикл") for message in received)
+
+
+def test_polling_does_not_stall_the_loop_or_the_bot_session(tmp_path, monkeypatch):
+    monkeypatch.setenv("NOTIFY_SPOOL_PATH", str(tmp_path / "spool.json"))
+    monkeypatch.setenv("NOTIFY_GLOBAL_RATE", "10000")
+    monkeypatch.setenv("NOTIFY_CHAT_RATE", "10000")
+
+    async def scenario():
+        received = []
+        runner, url = await start_telegram_api(received)
+        session = aiohttp.ClientSession()
+        bot = object.__new__(main_async.TelegramBot)   # без токена Telegram и без регистрации обработчиков
+        bot.loop = asyncio.get_running_loop()
+        bot.executor = ThreadPoolExecutor(max_workers=2)
+        bot.bot = FakeBot(session, url)
+        bot.notifications = NotificationDispatcher(bot.send_notification)
+        bot.subscription_poller = BlockingPoller(bot.notifications.enqueue)
+        bot.notifications.start()
+        polling_task = asyncio.create_task(bot.poll_loop())
+
+        # пока идут опросы, цикл должен откликаться - как на обновления Telegram
+        lag = 0
+        started = time.monotonic()
+        while time.monotonic() - started < 1.5:
+            tick = time.monotonic()
+            await asyncio.sleep(0.01)
+            lag = max(lag, time.monotonic() - tick - 0.01)
+
+        polling_task.cancel()
+        expected = bot.subscription_poller.cycles * NOTIFICATIONS_PER_POLL
+        deadline = time.monotonic() + 5
+        while delivered(received) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await bot.loop.run_in_executor(None, bot.notifications.stop)
+        bot.executor.shutdown(wait=True)
+        await session.close()
+        await runner.cleanup()
+        return bot, lag, received, expected
+
+    bot, lag, received, expected = asyncio.run(scenario())
+    print(f"\nЦиклов опроса: {bot.subscription_poller.cycles}, уведомлений: {delivered(received)}, "
+          f"наибольшая задержка цикла: {lag * 1000:.1f} мс")
+    assert bot.subscription_poller.cycles >= 3
+    # блокирующий опрос в цикле событий задержал бы его на POLL_BLOCKS
+    assert lag < POLL_BLOCKS / 2
+    # все уведомления ушли через общую сессию без ошибок и без потерь
+    assert delivered(received) >= expected
+    assert bot.notifications.metrics()['delivered'] == delivered(received)
+    assert bot.notifications.metrics()['retried'] == 0
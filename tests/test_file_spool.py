@@ -0,0 +1,108 @@
+import asyncio
+import io
+import tracemalloc
+
+import pytest
+
+pytest.importorskip("dotenv")
+
+import file_spool
+from file_spool import SpoolReader, copy_chunks, read_chunks, spooled_file
+
+
+def test_small_file_stays_in_memory_and_large_file_spills_to_disk(monkeypatch):
+    monkeypatch.setattr(file_spool, "SPOOL_THRESHOLD", 1024)
+    small = copy_chunks([b"a" * 100, b"b" * 100], spooled_file())
+    large = copy_chunks([b"c" * 1000, b"d" * 1000], spooled_file())
+    assert not small._rolled
+    assert large._rolled
+    assert small.read() == b"a" * 100 + b"b" * 100
+
+
+def test_read_chunks_yields_whole_file():
+    file = copy_chunks([b"x" * (file_spool.CHUNK_SIZE + 10)], spooled_file())
+
+    async def collect():
+        return [chunk async for chunk in read_chunks(file)]
+
+    chunks = asyncio.run(collect())
+    assert [len(chunk) for chunk in chunks] == [file_spool.CHUNK_SIZE, 10]
+
+
+def test_multipart_encoder_does_not_roll_spooled_file_to_disk():
+    toolbelt = pytest.importorskip("requests_toolbelt")
+    file = copy_chunks([b"payload" * 100], spooled_file())
+    reader = SpoolReader(file)
+    assert reader.len == 700
+
+    encoder = toolbelt.MultipartEncoder(fields=[("file", ("a.txt", reader, "text/plain"))])
+    body = encoder.to_string()
+
+    assert not file._rolled
+    assert b"payload" * 100 in body
+    assert len(body) == encoder.len
+    assert reader.len == 0
+
+
+def peak_memory(upload):
+    tracemalloc.start()
+    try:
+        upload()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_streamed_upload_peak_memory_does_not_grow_with_file_size():
+    requests = pytest.importorskip("requests")
+    toolbelt = pytest.importorskip("requests_toolbelt")
+    size = 8 * 1024 * 1024
+
+    def telegram_chunks():
+        # файл из Telegram приходит кусками по CHUNK_SIZE
+        for _ in range(size // file_spool.CHUNK_SIZE):
+            yield b"x" * file_spool.CHUNK_SIZE
+
+    def buffered_upload():
+        # как было: файл скачан целиком, скопирован в BytesIO и отправлен через files= (тело собирается в памяти)
+        downloaded = b"".join(telegram_chunks())
+        attachment = io.BytesIO(downloaded)
+        request = requests.Request("POST", "https://jira.example.com/attachments",
+                                   files=[("file", ("a.bin", attachment, "application/octet-stream"))]).prepare()
+        assert len(request.body) > size
+
+    def streamed_upload():
+        with copy_chunks(telegram_chunks(), spooled_file()) as file:
+            encoder = toolbelt.MultipartEncoder(fields=[("file", ("a.bin", SpoolReader(file), "application/octet-stream"))])
+            sent = 0
+            while True:   # так тело читает requests при отправке
+                chunk = encoder.read(file_spool.CHUNK_SIZE)
+                if not chunk:
+                    break
+                sent += len(chunk)
+            assert sent == encoder.len
+
+    buffered, streamed = peak_memory(buffered_upload), peak_memory(streamed_upload)
+    print(f"\nПиковая память при отправке 8 МиБ: целиком {buffered / 2 ** 20:.1f} МиБ, потоком {streamed / 2 ** 20:.1f} МиБ")
+    assert buffered > size
+    # в памяти не больше порога SpooledTemporaryFile (плюс рост буфера до переноса на диск), а не весь файл
+    assert streamed < 2 * file_spool.SPOOL_THRESHOLD
+
+
+def test_concurrent_readers_keep_their_own_positions():
+    file = copy_chunks([bytes(range(256)) * 1000], spooled_file())
+    first, second = SpoolReader(file), SpoolReader(file)
+    parts = {id(first): [], id(second): []}
+    while first.len or second.len:
+        for reader in (first, second):
+            parts[id(reader)].append(reader.read(1000))
+
+    expected = bytes(range(256)) * 1000
+    assert b"".join(parts[id(first)]) == expected
+    assert b"".join(parts[id(second)]) == expected
+
+    async def collect():
+        return [chunk async for chunk in read_chunks(file)]
+
+    file.seek(100)   # позиция файла не влияет на чтение
+    assert b"".join(asyncio.run(collect())) == expected
@@ -0,0 +1,131 @@
+import asyncio
+import sqlite3
+import sys
+
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("dotenv")
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import fsm_storage
+from fsm_storage import SQLiteStorage, create_fsm_storage
+
+KEY = StorageKey(bot_id=1, chat_id=100, user_id=100)
+
+
+def stored_rows(path):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute("SELECT key, state, data FROM fsm").fetchall()
+    finally:
+        connection.close()
+
+
+def test_writes_are_batched_and_visible_before_flush(tmp_path):
+    path = str(tmp_path / "fsm.sqlite3")
+
+    async def scenario():
+        storage = SQLiteStorage(path, flush_interval=60, batch_size=2)
+        await storage.set_state(KEY, "Claim:photo")
+        await storage.set_data(KEY, {'claim_text': 'Не работает принтер'})
+        # в базе ещё ничего нет, но чтение видит несброшенные изменения
+        assert stored_rows(path) == []
+        assert await storage.get_state(KEY) == "Claim:photo"
+        assert await storage.get_data(KEY) == {'claim_text': 'Не работает принтер'}
+
+        other = StorageKey(bot_id=1, chat_id=200, user_id=200)
+        await storage.set_state(other, "Claim:text")   # вторая изменённая запись - сброс одной транзакцией
+        assert len(stored_rows(path)) == 2
+        assert storage.pending == {}
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_delayed_flush_writes_after_interval(tmp_path):
+    path = str(tmp_path / "fsm.sqlite3")
+
+    async def scenario():
+        storage = SQLiteStorage(path, flush_interval=0.01, batch_size=100)
+        await storage.set_state(KEY, "Claim:photo")
+        await storage.flush_task
+        assert [state for _, state, _ in stored_rows(path)] == ["Claim:photo"]
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_close_flushes_and_state_survives_restart(tmp_path):
+    path = str(tmp_path / "fsm.sqlite3")
+
+    async def scenario():
+        storage = SQLiteStorage(path, flush_interval=60)
+        await storage.set_state(KEY, "Claim:photo")
+        await storage.set_data(KEY, {'files': ['a.png']})
+        await storage.close()
+
+        restored = SQLiteStorage(path)
+        state, data = await restored.get_state(KEY), await restored.get_data(KEY)
+        await restored.close()
+        return state, data
+
+    assert asyncio.run(scenario()) == ("Claim:photo", {'files': ['a.png']})
+
+
+def test_finished_and_expired_states_are_deleted(tmp_path, monkeypatch):
+    path = str(tmp_path / "fsm.sqlite3")
+    now = [1000.0]
+    monkeypatch.setattr(fsm_storage.time, "time", lambda: now[0])
+
+    async def scenario():
+        storage = SQLiteStorage(path, flush_interval=60, ttl=100)
+        finished = StorageKey(bot_id=1, chat_id=200, user_id=200)
+        await storage.set_state(KEY, "Claim:photo")
+        await storage.set_state(finished, "Claim:text")
+        storage.flush()
+        await storage.set_state(finished, None)   # заявка отправлена, состояние сброшено
+        storage.flush()
+        assert [key for key, _, _ in stored_rows(path)] == ["1:100:100:None:None:default"]
+
+        now[0] += 101
+        assert await storage.get_state(KEY) is None   # просрочено, хотя ещё лежит в базе
+        await storage.set_state(finished, "Claim:text")
+        storage.flush()   # очередной сброс заодно удаляет просроченные записи
+        assert [key for key, _, _ in stored_rows(path)] == ["1:200:200:None:None:default"]
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_create_fsm_storage_selects_backend(tmp_path, monkeypatch):
+    monkeypatch.delenv("FSM_STORAGE", raising=False)
+    assert isinstance(create_fsm_storage(), MemoryStorage)
+
+    monkeypatch.setenv("FSM_STORAGE", "sqlite")
+    monkeypatch.setenv("FSM_SQLITE_PATH", str(tmp_path / "fsm.sqlite3"))
+    monkeypatch.setenv("FSM_STATE_TTL", "600")
+    storage = create_fsm_storage()
+    assert isinstance(storage, SQLiteStorage)
+    assert storage.ttl == 600
+    asyncio.run(storage.close())
+
+
+def test_create_fsm_storage_selects_redis(monkeypatch):
+    redis_storage = pytest.importorskip("aiogram.fsm.storage.redis")
+    monkeypatch.setenv("FSM_STORAGE", "redis")
+    monkeypatch.setenv("FSM_REDIS_URL", "redis://redis.example:6379/2")
+    monkeypatch.setenv("FSM_STATE_TTL", "600")
+    storage = create_fsm_storage()   # from_url не подключается к серверу до первого запроса
+    assert isinstance(storage, redis_storage.RedisStorage)
+    assert storage.state_ttl == 600
+    assert storage.redis.connection_pool.connection_kwargs['host'] == "redis.example"
+
+
+def test_create_fsm_storage_requires_redis_package(monkeypatch):
+    monkeypatch.setenv("FSM_STORAGE", "redis")
+    monkeypatch.setitem(sys.modules, "aiogram.fsm.storage.redis", None)
+    with pytest.raises(RuntimeError):
+        create_fsm_storage()
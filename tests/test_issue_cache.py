@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip("dotenv")
+
+from issue_cache import IssueSnapshot, SnapshotCache
+
+
+def snapshot(last_comment, updated='2024-10-18T10:00:00.000+0000'):
+    return IssueSnapshot('SD-42', 'Open', 'Не работает принтер', None, updated, 'alice', last_comment)
+
+
+def test_snapshot_of_another_viewer_is_not_shared():
+    cache = SnapshotCache(ttl=300)
+    internal = {'id': 2, 'author': 'Agent', 'text': 'внутренний комментарий', 'created': ''}
+    cache.put(snapshot(internal), 'agent')   # загружен токеном сотрудника - видит внутренние комментарии
+
+    assert cache.get('SD-42', 'alice') is None
+    cache.put(snapshot(None), 'alice')
+    assert cache.get('SD-42', 'alice').last_comment is None
+    assert cache.get('SD-42', 'agent').last_comment == internal
+
+
+def test_changes_drop_snapshots_of_all_viewers():
+    cache = SnapshotCache(ttl=300)
+    cache.put(snapshot(None), 'alice')
+    cache.put(snapshot(None), 'agent')
+
+    cache.observe_updated('SD-42', '2024-10-18T10:00:00.000+0000')
+    assert cache.get('SD-42', 'alice') is not None
+
+    cache.observe_updated('SD-42', '2024-10-18T11:00:00.000+0000')
+    assert cache.get('SD-42', 'alice') is None and cache.get('SD-42', 'agent') is None
+
+
+def test_lru_limit_counts_issues():
+    cache = SnapshotCache(max_size=1, ttl=300)
+    cache.put(snapshot(None), 'alice')
+    cache.put(IssueSnapshot('SD-7', 'Open', 'Монитор', None, '', 'bob', None), 'bob')
+    assert cache.get('SD-42', 'alice') is None
+    assert cache.get('SD-7', 'bob') is not None
@@ -0,0 +1,69 @@
+import pytest
+
+pytest.importorskip("jira")
+pytest.importorskip("requests_toolbelt")
+
+import jira_client
+from jira_client import JiraMetadataCache, forget_jira_client
+
+
+class FakeMetadataClient:
+    def __init__(self, name):
+        self.name = name
+        self.domain = "https://jira.example.com"
+        self.project_key = "SD"
+        self.requests = 0
+        self.logged_out = False
+
+    def fetch_servicedesk_number(self):
+        assert not self.logged_out, "запрос токеном сброшенной регистрации"
+        self.requests += 1
+        return 7
+
+    def fetch_request_types(self, service_desk_id):
+        return {'Инцидент': 10}
+
+    def logout(self):
+        self.logged_out = True
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    clients = jira_client.OrderedDict()
+    monkeypatch.setattr(jira_client, "_clients", clients)
+    monkeypatch.setattr(jira_client, "_client_key", lambda token: token)
+    return clients
+
+
+def make_cache(monkeypatch):
+    cache = JiraMetadataCache(ttl=3600)
+    monkeypatch.setattr(cache, "start_background_refresh", lambda: None)
+    return cache
+
+
+def test_refresh_uses_a_current_client_not_the_one_that_loaded_the_entry(clients, monkeypatch):
+    cache = make_cache(monkeypatch)
+    alice, bob = FakeMetadataClient("alice"), FakeMetadataClient("bob")
+    clients["alice"], clients["bob"] = alice, bob
+    cache.load(alice)
+
+    forget_jira_client("alice")   # alice сбросила регистрацию
+    cache.refresh()
+
+    assert alice.logged_out
+    assert alice.requests == 1
+    assert bob.requests == 1
+    assert 'client' not in cache.entries[(bob.domain, bob.project_key)]
+
+
+def test_refresh_is_skipped_without_clients(clients, monkeypatch):
+    cache = make_cache(monkeypatch)
+    alice = FakeMetadataClient("alice")
+    clients["alice"] = alice
+    cache.load(alice)
+    forget_jira_client("alice")
+
+    cache.refresh()
+
+    assert alice.requests == 1
+    assert cache.entries[(alice.domain, alice.project_key)]['service_desk_id'] == 7
@@ -0,0 +1,146 @@
+import asyncio
+import re
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("jira")
+pytest.importorskip("requests_toolbelt")
+pytest.importorskip("aiohttp")
+import requests
+
+from file_spool import copy_chunks, read_chunks, spooled_file
+from jira_client import JiraClient, make_attachment
+from jira_client_async import AsyncJiraClient
+
+CONTENTS = {'a.txt': b"a" * 50000, 'b.txt': b"b" * 50000, 'c.txt': b"c" * 50000}
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeUploadSession:
+    # Временное хранилище Service Desk: тело читается кусками с паузами, чтобы загрузки шли вперемешку.
+    # Файлы из fail_once падают один раз, прочитав только первый кусок
+    def __init__(self, fail_once=()):
+        self.fail_once = set(fail_once)
+        self.events = []   # ('start' | 'end' | 'fail', файл)
+        self.bodies = []
+        self.attached = None
+        self.lock = threading.Lock()
+
+    def post(self, url, headers=None, data=None, json=None, timeout=None):
+        if url.endswith("/attachTemporaryFile"):
+            first = data.read(1024)
+            filename = re.search(rb'filename="([^"]+)"', first).group(1).decode()
+            with self.lock:
+                self.events.append(('start', filename))
+                failing = filename in self.fail_once
+                self.fail_once.discard(filename)
+            if failing:
+                with self.lock:
+                    self.events.append(('fail', filename))
+                raise requests.ConnectionError("обрыв соединения")
+            body = first
+            while True:
+                time.sleep(0.001)
+                chunk = data.read(4096)
+                if not chunk:
+                    break
+                body += chunk
+            with self.lock:
+                self.events.append(('end', filename))
+                self.bodies.append((filename, body))
+            return FakeResponse({'temporaryAttachments': [{'temporaryAttachmentId': f"tmp-{filename}"}]})
+        if url.endswith("/attachment"):
+            self.attached = json
+            return FakeResponse({'ok': True})
+        raise AssertionError(f"неожиданный запрос {url}")
+
+
+def attachments():
+    return [make_attachment(copy_chunks([content], spooled_file()), filename) for filename, content in CONTENTS.items()]
+
+
+def make_client(session):
+    client = object.__new__(JiraClient)
+    client.domain = "https://jira.example.com/"
+    client.project_key = "SD"
+    client.headers = {}
+    client.timeout = 30
+    client.session = session
+    client.get_servicedesk_number = lambda: 7
+    client.create_claim = lambda username, claim_data: {'issueKey': 'SD-42'}
+    return client
+
+
+def test_failed_temporary_upload_is_retried_alone_after_the_others_finish():
+    session = FakeUploadSession(fail_once={'b.txt'})
+    client = make_client(session)
+
+    new_issue, result = client.create_claim_with_attachments(100, {}, attachments())
+
+    assert result == {'ok': True}
+    assert session.attached['temporaryAttachmentIds'] == ['tmp-a.txt', 'tmp-b.txt', 'tmp-c.txt']
+    # повтор - только упавший файл и только после того, как остальные загрузки закончились
+    starts = [filename for event, filename in session.events if event == 'start']
+    assert sorted(starts) == ['a.txt', 'b.txt', 'b.txt', 'c.txt']
+    retry = max(index for index, event in enumerate(session.events) if event == ('start', 'b.txt'))
+    assert session.events.index(('end', 'a.txt')) < retry
+    assert session.events.index(('end', 'c.txt')) < retry
+    # каждая загрузка прочитала свой файл целиком
+    for filename, body in session.bodies:
+        assert CONTENTS[filename] in body
+
+
+class FakeAsyncClient(AsyncJiraClient):
+    def __init__(self, fail_once=()):
+        super().__init__("token")
+        self.project_key = "SD"
+        self.fail_once = set(fail_once)
+        self.events = []
+        self.attached = None
+
+    async def get_servicedesk_number(self):
+        return 7
+
+    async def upload_attachments(self, path, attachments, extra_headers=None):
+        filename = attachments[0]['filename']
+        self.events.append(('start', filename))
+        body = b""
+        async for chunk in read_chunks(attachments[0]['file']):
+            if filename in self.fail_once:
+                self.fail_once.discard(filename)
+                raise asyncio.TimeoutError()
+            body += chunk
+            await asyncio.sleep(0)
+        assert body == CONTENTS[filename]
+        self.events.append(('end', filename))
+        return {'temporaryAttachments': [{'temporaryAttachmentId': f"tmp-{filename}"}]}
+
+    async def attach_to_request(self, issue_key, temporary_ids, comment_text):
+        self.attached = temporary_ids
+        return {'ok': True}
+
+
+def test_async_upload_retries_only_failed_files():
+    client = FakeAsyncClient(fail_once={'a.txt'})
+
+    async def scenario():
+        files = attachments()
+        temporary_ids = await client.attach_temporary_files(7, files)
+        assert temporary_ids == [None, ['tmp-b.txt'], ['tmp-c.txt']]
+        return await client.add_attachments_to_claim(42, files, temporary_ids)
+
+    assert asyncio.run(scenario()) == {'ok': True}
+    assert client.attached == ['tmp-a.txt', 'tmp-b.txt', 'tmp-c.txt']
+    assert [filename for event, filename in client.events if event == 'start'] == ['a.txt', 'b.txt', 'c.txt', 'a.txt']
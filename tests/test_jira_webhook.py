@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("jira")
+pytest.importorskip("supabase")
+
+from fakes import PollerEnv
+from jira_webhook import JiraWebhookServer
+
+PAYLOADS = os.path.join(os.path.dirname(__file__), "payloads")
+
+
+def load_payload(name):
+    with open(os.path.join(PAYLOADS, name), encoding="utf-8") as payload:
+        return json.load(payload)
+
+
+@pytest.fixture
+def env(monkeypatch):
+    env = PollerEnv(monkeypatch, [
+        {'user_id': 1, 'claim_number': 42, 'claim_status': 'Open', 'last_comment_id': 500},
+        {'user_id': 2, 'claim_number': 42, 'claim_status': 'Open', 'last_comment_id': 500},
+    ])
+    env.jira.issues['SD-42'] = {'status': 'Open', 'last_update': '2024-10-18T09:00:00.000+0000',
+                                'summary': 'Не работает принтер', 'reporter': 'alice'}
+    yield env.poller, env.jira, env.supabase, env.notifications
+    env.close()
+
+
+def replay(poller, *payloads):
+    server = JiraWebhookServer(poller.handle_jira_event)
+    for payload in payloads:
+        server.accept(payload)
+    server.executor.shutdown(wait=True)
+    return server
+
+
+def test_issue_updated_notifies_reporter_only(env):
+    poller, jira, supabase, notifications = env
+    jira.issues['SD-42'].update(status='In Progress', last_update='2024-10-18T10:00:00.000+0000')
+
+    server = replay(poller, load_payload("jira_issue_updated.json"))
+
+    assert server.stats['processed'] == 1
+    # bob подписан, но заявку создала alice - ему уведомления не положены
+    assert [chat_id for chat_id, _, _ in notifications] == [100]
+    assert "изменился с Open на: In Progress" in notifications[0][1]
+    assert supabase.calls == [('status', 100, 'SD-42', 'In Progress')]
+
+
+def test_comment_created_is_escaped_and_deduplicated(env):
+    poller, jira, supabase, notifications = env
+    payload = load_payload("comment_created.json")
+    jira.issues['SD-42']['last_update'] = '2024-10-18T10:10:00.000+0000'
+    jira.comments['SD-42'] = [{'id': 501, 'author': payload['comment']['author']['displayName'],
+                               'text': payload['comment']['body'], 'created': payload['comment']['created']}]
+
+    replay(poller, payload)
+    # то же событие повторно (Jira повторяет доставку) и очередной обход подписок - без дублей
+    replay(poller, payload)
+    poller.poll()
+
+    assert len(notifications) == 1
+    chat_id, text, parse_mode = notifications[0]
+    assert (chat_id, parse_mode) == (100, 'HTML')
+    assert "<b>Support &lt;Agent&gt;</b>" in text
+    assert "Замените картридж &amp; перезагрузите" in text
+    assert supabase.calls == [('comment', 100, 'SD-42', 501)]
+
+
+def test_events_for_one_issue_are_coalesced(env):
+    poller, jira, supabase, notifications = env
+    jira.issues['SD-42'].update(status='In Progress', last_update='2024-10-18T10:00:00.000+0000')
+    server = JiraWebhookServer(poller.handle_jira_event)
+    server.executor = ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    server.executor.submit(release.wait)   # единственный поток занят, события ждут в очереди
+
+    server.accept(load_payload("jira_issue_updated.json"))
+    server.accept(load_payload("comment_created.json"))
+    release.set()
+    server.executor.shutdown(wait=True)
+
+    assert server.stats == {'accepted': 1, 'coalesced': 1, 'ignored': 0, 'processed': 1, 'failed': 0}
+    assert len(jira.searches) == 1
+    assert len(notifications) == 1
+
+
+def test_unrelated_events_are_ignored(env):
+    poller, jira, supabase, notifications = env
+    other_issue = load_payload("jira_issue_updated.json")
+    other_issue['issue']['key'] = 'SD-7'
+    deleted = dict(load_payload("jira_issue_updated.json"), webhookEvent='jira:issue_deleted')
+
+    server = replay(poller, other_issue, deleted)
+
+    assert server.stats['ignored'] == 1
+    assert server.stats['processed'] == 1
+    assert jira.searches == []
+    assert notifications == []
+
+
+def test_claim_without_link_is_notified_once(env):
+    poller, jira, supabase, notifications = env
+    jira.link = False   # у заявки нет service desk
+    jira.issues['SD-42'].update(status='In Progress', last_update='2024-10-18T10:10:00.000+0000')
+    jira.comments['SD-42'] = [{'id': 501, 'author': 'Agent', 'text': 'Готово', 'created': ''}]
+
+    for _ in range(3):
+        replay(poller, load_payload("comment_created.json"))
+        poller.seen_updated.clear()   # как после перезапуска: повтор не должен слать уже доставленное
+
+    assert [text for _, text, _ in notifications] == [
+        "Статус заявки SD-42 изменился с Open на: In Progress.",
+        "У заявки SD-42 появился новый комментарий от <b>Agent</b>:\nГотово.",
+    ]
+    assert supabase.calls == [('status', 100, 'SD-42', 'In Progress'), ('comment', 100, 'SD-42', 501)]
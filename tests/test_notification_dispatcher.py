@@ -0,0 +1,149 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("dotenv")
+
+from notification_dispatcher import NotificationDispatcher, TokenBucket, retry_after, is_permanent
+
+
+class TelegramError(Exception):
+    # как ApiTelegramException pyTelegramBotAPI: код ошибки и ответ Telegram
+    def __init__(self, error_code, retry_after=None):
+        super().__init__(f"error {error_code}")
+        self.error_code = error_code
+        self.result_json = {'parameters': {'retry_after': retry_after}} if retry_after else {}
+
+
+class FakeSender:
+    def __init__(self, errors=None):
+        self.sent = []
+        self.errors = list(errors or [])
+        self.lock = threading.Lock()
+
+    def __call__(self, chat_id, text, parse_mode=None):
+        with self.lock:
+            if self.errors:
+                raise self.errors.pop(0)
+            self.sent.append((chat_id, text, parse_mode))
+
+
+@pytest.fixture
+def make_dispatcher(tmp_path, monkeypatch):
+    monkeypatch.setenv("NOTIFY_SPOOL_PATH", str(tmp_path / "spool.json"))
+    monkeypatch.setenv("NOTIFY_CHAT_RATE", "1000")
+    monkeypatch.setenv("NOTIFY_GLOBAL_RATE", "1000")
+
+    def make(send):
+        return NotificationDispatcher(send)
+    return make
+
+
+def deliver_all(dispatcher):
+    while True:
+        with dispatcher.condition:
+            message, _ = dispatcher.next_message(time.monotonic())
+        if message is None:
+            return
+        dispatcher.deliver(message)
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=2, capacity=1)
+    now = bucket.updated
+    assert bucket.wait_time(now) == 0
+    bucket.consume(now)
+    assert bucket.wait_time(now) == pytest.approx(0.5)
+    assert bucket.wait_time(now + 0.5) == 0
+
+
+def test_error_classification():
+    assert retry_after(TelegramError(429, retry_after=7)) == 7
+    assert retry_after(TelegramError(500)) is None
+    assert is_permanent(TelegramError(403))
+    assert not is_permanent(TelegramError(500))
+
+
+def test_messages_to_one_chat_are_coalesced(make_dispatcher):
+    sender = FakeSender()
+    dispatcher = make_dispatcher(sender)
+    dispatcher.enqueue(1, "первое")
+    dispatcher.enqueue(1, "второе")
+    dispatcher.enqueue(2, "другой чат")
+
+    deliver_all(dispatcher)
+
+    assert sender.sent == [(1, "первое\n\nвторое", None), (2, "другой чат", None)]
+    assert dispatcher.metrics()['delivered'] == 3
+    assert dispatcher.metrics()['coalesced'] == 1
+
+
+def test_plain_text_is_escaped_when_joined_with_html(make_dispatcher):
+    sender = FakeSender()
+    dispatcher = make_dispatcher(sender)
+    dispatcher.enqueue(1, "Статус <новый> & готов")
+    dispatcher.enqueue(1, "<b>Иван</b>: комментарий", parse_mode='HTML')
+
+    deliver_all(dispatcher)
+
+    assert sender.sent == [(1, "Статус &lt;новый&gt; &amp; готов\n\n<b>Иван</b>: комментарий", 'HTML')]
+
+
+def test_retry_after_pauses_all_sending(make_dispatcher):
+    sender = FakeSender(errors=[TelegramError(429, retry_after=30)])
+    dispatcher = make_dispatcher(sender)
+    dispatcher.enqueue(1, "текст")
+
+    deliver_all(dispatcher)
+
+    assert sender.sent == []
+    assert dispatcher.paused_until > time.monotonic() + 25
+    assert dispatcher.metrics()['queued'] == 1
+    dispatcher.paused_until = 0
+    deliver_all(dispatcher)
+    assert sender.sent == [(1, "текст", None)]
+
+
+def test_permanent_error_drops_and_transient_error_retries(make_dispatcher):
+    sender = FakeSender(errors=[TelegramError(403), TelegramError(500)])
+    dispatcher = make_dispatcher(sender)
+    dispatcher.enqueue(1, "заблокирован")
+    deliver_all(dispatcher)
+    assert dispatcher.metrics()['dropped'] == 1
+
+    dispatcher.enqueue(2, "повтор")
+    deliver_all(dispatcher)
+    assert dispatcher.metrics()['retried'] == 1
+    assert dispatcher.chat_blocked_until[2] > time.monotonic()
+    dispatcher.chat_blocked_until[2] = 0
+    deliver_all(dispatcher)
+    assert sender.sent == [(2, "повтор", None)]
+
+
+def test_queue_survives_restart(make_dispatcher):
+    dispatcher = make_dispatcher(FakeSender())
+    dispatcher.enqueue(1, "не успели отправить")
+    with dispatcher.condition:
+        dispatcher.save_spool()
+
+    sender = FakeSender()
+    restored = make_dispatcher(sender)
+    deliver_all(restored)
+
+    assert sender.sent == [(1, "не успели отправить", None)]
+
+
+def test_worker_thread_delivers_messages(make_dispatcher):
+    sender = FakeSender()
+    dispatcher = make_dispatcher(sender)
+    dispatcher.start()
+    try:
+        for chat_id in range(20):
+            dispatcher.enqueue(chat_id, f"сообщение {chat_id}")
+        deadline = time.monotonic() + 5
+        while len(sender.sent) < 20 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        dispatcher.stop()
+    assert sorted(chat_id for chat_id, _, _ in sender.sent) == list(range(20))
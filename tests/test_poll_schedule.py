@@ -0,0 +1,90 @@
+import pytest
+
+import poll_schedule
+from poll_schedule import AdaptiveSchedule
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(poll_schedule.time, "monotonic", clock)
+    return clock
+
+
+def test_new_claims_are_due_immediately(clock):
+    schedule = AdaptiveSchedule(60, 3600, jitter=0)
+    schedule.sync({'SD-1': [], 'SD-2': []})
+    assert sorted(schedule.pop_due()) == ['SD-1', 'SD-2']
+    assert schedule.pop_due() == []
+    assert schedule.next_delay() is None
+
+
+def test_quiet_claim_backs_off_up_to_max_and_activity_resets(clock):
+    schedule = AdaptiveSchedule(60, 300, backoff=2, jitter=0)
+    schedule.sync({'SD-1': []})
+    schedule.pop_due()
+    intervals = []
+    for _ in range(5):
+        schedule.done('SD-1', active=False)
+        intervals.append(schedule.next_delay())
+        clock.now += schedule.next_delay()
+        assert schedule.pop_due() == ['SD-1']
+    assert intervals == [120, 240, 300, 300, 300]
+
+    schedule.done('SD-1', active=True)
+    assert schedule.next_delay() == 60
+
+
+def test_jitter_stays_within_bounds(clock):
+    schedule = AdaptiveSchedule(100, 100, jitter=0.1)
+    claims = {f'SD-{number}': [] for number in range(200)}
+    schedule.sync(claims)
+    schedule.pop_due()
+    for claim_number in claims:
+        schedule.done(claim_number, active=True)
+    due_times = [at - clock.now for at in schedule.due_at.values()]
+    assert all(90 <= delay <= 110 for delay in due_times)
+    assert len(set(due_times)) > 1
+
+
+def test_restore_returns_unchecked_claims(clock):
+    schedule = AdaptiveSchedule(60, 3600, jitter=0)
+    schedule.sync({'SD-1': [], 'SD-2': []})
+    schedule.pop_due()
+    schedule.done('SD-1', active=False)
+    schedule.restore(['SD-1', 'SD-2'], delay=5)
+
+    # SD-1 уже в расписании, restore его не трогает
+    assert schedule.due_at['SD-1'] == clock.now + 120
+    assert schedule.due_at['SD-2'] == clock.now + 5
+
+
+def test_unsubscribed_claims_are_forgotten(clock):
+    schedule = AdaptiveSchedule(60, 3600, jitter=0)
+    schedule.sync({'SD-1': [], 'SD-2': []})
+    schedule.sync({'SD-2': []})
+    assert schedule.pop_due() == ['SD-2']
+    schedule.done('SD-1', active=True)
+    assert 'SD-1' not in schedule.due_at
+    assert schedule.stats()['tracked'] == 1
+
+
+def test_rescheduling_a_queued_claim_replaces_its_due_time(clock):
+    # вебхук проверил заявку раньше срока - старая запись в куче становится устаревшей
+    schedule = AdaptiveSchedule(60, 3600, jitter=0)
+    schedule.sync({'SD-1': []})
+    schedule.pop_due()
+    schedule.done('SD-1', active=False)
+    schedule.done('SD-1', active=True)
+    clock.now += 60
+    assert schedule.pop_due() == ['SD-1']
+    clock.now += 120
+    assert schedule.pop_due() == []
@@ -0,0 +1,107 @@
+import threading
+
+from session_store import SessionStore
+
+
+class FakeFile:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTimer:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def test_sessions_are_isolated_across_concurrent_users():
+    store = SessionStore(ttl=3600)
+    users = 300
+    rounds = 50
+    barrier = threading.Barrier(users)
+    errors = []
+
+    def dialog(user_id):
+        barrier.wait()
+        for step in range(rounds):
+            session = store.get(user_id, user_id)
+            with session.lock:
+                session.claim_data['theme'] = f"{user_id}-{step}"
+                session.attachments.append({'file': FakeFile(), 'owner': user_id})
+            session = store.get(user_id, user_id)
+            if session.claim_data['theme'] != f"{user_id}-{step}":
+                errors.append((user_id, step, session.claim_data['theme']))
+
+    threads = [threading.Thread(target=dialog, args=(user_id,)) for user_id in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(store) == users
+    for user_id in range(users):
+        session = store.get(user_id, user_id)
+        assert session.chat_id == user_id and session.user_id == user_id
+        assert len(session.attachments) == rounds
+        assert {attachment['owner'] for attachment in session.attachments} == {user_id}
+
+
+def test_same_chat_different_users_get_separate_sessions():
+    store = SessionStore(ttl=3600)
+    first = store.get(1, 10)
+    second = store.get(1, 20)
+    first.claim_data['theme'] = 'first'
+    assert second.claim_data == {}
+    assert store.get(1, 10) is first
+
+
+def test_sweep_closes_expired_sessions():
+    store = SessionStore(ttl=0, sweep_interval=0)
+    session = store.get(1, 1)
+    attachment = FakeFile()
+    timer = FakeTimer()
+    session.attachments.append({'file': attachment})
+    session.album = ['part']
+    session.album_timer = timer
+    session.touched_at -= 1
+
+    fresh = store.get(2, 2)   # обход по sweep_interval=0 удаляет просроченную сессию
+
+    assert fresh is not session
+    assert (1, 1) not in store.sessions
+    assert attachment.closed
+    assert timer.cancelled
+    assert session.album == [] and session.album_timer is None
+    assert session.attachments == [] and session.claim_data == {}
+
+
+def test_drop_closes_session():
+    store = SessionStore(ttl=3600)
+    session = store.get(1, 1)
+    attachment = FakeFile()
+    session.attachments.append({'file': attachment})
+
+    store.drop(1, 1)
+
+    assert attachment.closed
+    assert len(store) == 0
+
+
+def test_reset_claims_list_cancels_pending_prefetch():
+    store = SessionStore(ttl=3600)
+    session = store.get(1, 1)
+    prefetch = FakeTimer()   # Future/Task предзагрузки - то же cancel()
+    loaded = ([{'number': 'SD-1', 'theme': 'Принтер'}], 60)
+    session.reset_claims_list(claims_client=object())
+    session.claims_pages = {0: loaded, 50: prefetch}
+
+    session.reset_claims_list(list_of_claims=[{'number': 'SD-2', 'theme': 'Монитор'}])
+
+    assert prefetch.cancelled
+    assert session.claims_pages == {} and session.claims_client is None
@@ -0,0 +1,164 @@
+import pytest
+
+pytest.importorskip("jira")
+pytest.importorskip("supabase")
+
+from fakes import ALICE, BOB, PollerEnv
+from jira_client import JiraClient
+
+CAROL = {'id': 3, 'username': 300, 'email': None, 'jira_user_id': 'carol', 'has_token': True}
+
+
+def subscription(user, claim_number, status='Open', last_comment_id=0):
+    return {'user_id': user['id'], 'claim_number': claim_number, 'claim_status': status,
+            'last_comment_id': last_comment_id}
+
+
+def issue(status='Open', updated='2024-10-18T10:00:00.000+0000', reporter='bob'):
+    return {'status': status, 'last_update': updated, 'summary': 'Тема', 'reporter': reporter}
+
+
+@pytest.fixture
+def make_env(monkeypatch):
+    envs = []
+
+    def make(subscriptions, users=(ALICE, BOB)):
+        env = PollerEnv(monkeypatch, subscriptions, users)
+        envs.append(env)
+        return env
+    yield make
+    for env in envs:
+        env.close()
+
+
+def test_claim_unreadable_by_fetcher_is_retried_with_next_subscriber(make_env):
+    env = make_env([subscription(ALICE, 42), subscription(BOB, 42)])
+    env.jira.issues['SD-42'] = issue(status='In Progress')
+    env.jira.unreadable['token-100'] = {'SD-42'}
+
+    env.poller.poll()
+
+    assert [token for token, _ in env.jira.searches] == ['token-100', 'token-200']
+    assert [chat_id for chat_id, _, _ in env.notifications] == [200]
+    assert 'SD-42' in env.poller.last_poll
+
+
+def test_revoked_token_falls_back_to_next_subscriber(make_env):
+    env = make_env([subscription(ALICE, 42), subscription(BOB, 42)])
+    env.jira.issues['SD-42'] = issue(status='In Progress')
+    env.jira.broken_tokens.add('token-100')
+
+    env.poller.poll()
+
+    assert [token for token, _ in env.jira.searches] == ['token-200']
+    assert [chat_id for chat_id, _, _ in env.notifications] == [200]
+
+
+def test_claim_unreadable_by_everyone_moves_its_window(make_env):
+    env = make_env([subscription(ALICE, 42)])
+    env.jira.issues['SD-42'] = issue()
+    env.jira.unreadable['token-100'] = {'SD-42'}
+
+    env.poller.poll()
+
+    assert env.notifications == []
+    assert 'SD-42' in env.poller.last_poll
+
+
+def test_seen_updated_skips_repeated_claim(make_env):
+    env = make_env([subscription(BOB, 42)])
+    env.jira.issues['SD-42'] = issue(status='In Progress')
+    env.jira.comments['SD-42'] = [{'id': 1, 'author': 'Agent', 'text': 'Принято', 'created': ''}]
+    index = env.poller.subscribers_index(env.supabase)
+
+    env.poller.poll_claims(env.supabase, BOB, ['SD-42'], index)
+    # заявка снова попала в окно поиска с тем же updated
+    env.poller.poll_claims(env.supabase, BOB, ['SD-42'], index)
+
+    assert len(env.jira.searches) == 2
+    assert env.jira.comment_requests == [('SD-42', 0)]
+    assert len(env.notifications) == 2   # статус и комментарий - один раз
+    assert env.supabase.calls == [('status', 200, 'SD-42', 'In Progress'), ('comment', 200, 'SD-42', 1)]
+
+
+def test_failed_notification_keeps_the_window(make_env):
+    env = make_env([subscription(BOB, 42)])
+    env.jira.issues['SD-42'] = issue(status='In Progress')
+
+    def broken_update(user_id, claim_number, new_status):
+        raise RuntimeError("Supabase недоступен")
+    env.supabase.update_subscription_status = broken_update
+
+    checked = env.poller.poll_claims(env.supabase, BOB, ['SD-42'], env.poller.subscribers_index(env.supabase))
+
+    assert checked == 0
+    assert 'SD-42' not in env.poller.last_poll
+    assert env.poller.seen_updated['SD-42'] == {}
+
+
+def test_fetches_saved_counts_real_searches(make_env):
+    env = make_env([subscription(ALICE, 1), subscription(BOB, 1), subscription(CAROL, 1),
+                    subscription(BOB, 2)], users=(ALICE, BOB, CAROL))
+    env.jira.issues['SD-1'] = issue()
+    env.jira.issues['SD-2'] = issue()
+
+    env.poller.poll()
+
+    # 4 подписки обошлись двумя поисками: SD-1 токеном alice, SD-2 токеном bob
+    assert len(env.jira.searches) == 2
+    assert env.poller.last_cycle_stats['searches'] == 2
+    assert env.poller.last_cycle_stats['fetches_saved'] == 2
+
+
+def test_fetches_saved_includes_retries_and_skips_unfetched_claims(make_env):
+    env = make_env([subscription(ALICE, 1), subscription(BOB, 1), subscription(ALICE, 3)])
+    env.jira.issues['SD-1'] = issue()
+    env.jira.issues['SD-3'] = issue()
+    env.jira.unreadable['token-100'] = {'SD-1', 'SD-3'}
+    env.jira.unreadable['token-200'] = {'SD-3'}
+
+    env.poller.poll()
+
+    # alice: поиск SD-1 и SD-3, оба недоступны; bob повторяет SD-1; SD-3 не получил никто
+    assert len(env.jira.searches) == 2
+    assert env.poller.last_cycle_stats['searches'] == 2
+    assert env.poller.last_cycle_stats['fetches_saved'] == 0
+
+
+class PagedComments:
+    # Страницы комментариев от новых к старым, как отдаёт Jira с orderBy=-created
+    def __init__(self, ids, page_size):
+        self.ids = sorted(ids, reverse=True)
+        self.page_size = page_size
+        self.requests = []
+
+    def __call__(self, issue_key, start_at=0, max_results=None):
+        self.requests.append(start_at)
+        page = self.ids[start_at:start_at + self.page_size]
+        return {'total': len(self.ids), 'comments': [
+            {'id': str(comment_id), 'body': f"текст {comment_id}", 'created': '',
+             'author': {'displayName': 'Agent'}} for comment_id in page]}
+
+
+def comments_client(pages):
+    client = JiraClient.__new__(JiraClient)   # без подключения к Jira
+    client.fetch_comments_page = pages
+    return client
+
+
+def test_get_new_comments_stops_at_first_known_comment():
+    pages = PagedComments(range(1, 11), page_size=3)
+
+    comments = comments_client(pages).get_new_comments('SD-1', since_id=5)
+
+    assert [comment['id'] for comment in comments] == [6, 7, 8, 9, 10]
+    assert pages.requests == [0, 3]   # третья страница не нужна
+
+
+def test_get_new_comments_reads_all_pages_for_new_subscription():
+    pages = PagedComments(range(1, 8), page_size=3)
+
+    comments = comments_client(pages).get_new_comments('SD-1')
+
+    assert [comment['id'] for comment in comments] == list(range(1, 8))
+    assert pages.requests == [0, 3, 6]
@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("supabase")
+
+import supabase_client
+from supabase_client import SupabaseClient, get_supabase_client
+
+# Задержка одного запроса к Supabase (вход, выход, PostgREST) в замере: порядок задержки до облачного Supabase
+ROUND_TRIP = 0.005
+
+
+class FakeAuth:
+    def __init__(self, api):
+        self.api = api
+        self.session = None
+
+    def sign_in_with_password(self, credentials):
+        self.api.request('sign_in')
+        self.session = {'access_token': 'token'}
+        return self.session
+
+    def sign_out(self):
+        self.api.request('sign_out')
+        self.session = None
+
+    def get_session(self):
+        return self.session   # обновление токена по refresh token в замере не требуется
+
+
+class FakeQuery:
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        self.api.request('query')
+        return type('Response', (), {'data': [{'username': 100}], 'count': 1})()
+
+
+class FakeSupabaseApi:
+    # Вместо create_client: считает запросы по сети и каждый задерживает на ROUND_TRIP
+    def __init__(self):
+        self.requests = []
+        self.clients = 0
+
+    def create_client(self, url, key):
+        self.clients += 1
+        api = self
+        return type('Client', (), {'auth': FakeAuth(api), 'table': lambda client, name: FakeQuery(api)})()
+
+    def request(self, kind):
+        time.sleep(ROUND_TRIP)
+        self.requests.append(kind)
+
+
+@pytest.fixture
+def api(monkeypatch):
+    monkeypatch.setenv("MAX_SUBSCRIBE", "10")
+    api = FakeSupabaseApi()
+    monkeypatch.setattr(supabase_client, "create_client", api.create_client)
+    monkeypatch.setattr(supabase_client, "_shared_client", None)
+    return api
+
+
+def click_with_client_per_call():
+    # как было: новый клиент, вход по паролю, запрос и выход на каждое нажатие кнопки
+    client = SupabaseClient()
+    client.sign_in()
+    client.check_user_token(100)
+    client.logout()
+
+
+def click_with_shared_client():
+    get_supabase_client().check_user_token(100)
+
+
+def measure(click, clicks=20):
+    started = time.perf_counter()
+    for _ in range(clicks):
+        click()
+    return (time.perf_counter() - started) / clicks
+
+
+def test_shared_client_signs_in_once(api):
+    for _ in range(20):
+        click_with_shared_client()
+    assert api.clients == 1
+    assert api.requests.count('sign_in') == 1
+    assert 'sign_out' not in api.requests
+
+
+def test_shared_client_saves_auth_round_trips_per_click(api):
+    per_call = measure(click_with_client_per_call)
+    per_call_requests, api.requests = api.requests, []
+    shared = measure(click_with_shared_client)
+
+    print(f"\nЗадержка нажатия: клиент на вызов {per_call * 1000:.1f} мс, общий клиент {shared * 1000:.1f} мс")
+    # было три запроса на нажатие (вход, запрос, выход), стал один плюс единственный вход
+    assert len(per_call_requests) == 20 * 3
+    assert len(api.requests) == 20 + 1
+    assert shared < per_call / 2
+
+
+def test_expired_session_signs_in_again(api):
+    client = get_supabase_client()
+    client.client.auth.session = None   # refresh token тоже истёк
+    assert get_supabase_client() is client
+    assert api.requests.count('sign_in') == 2
@@ -0,0 +1,102 @@
+import asyncio
+import random
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from webhook_server import WebhookServer, update_chat_id
+
+
+def message_update(update_id, chat_id):
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'chat': {'id': chat_id}, 'text': str(update_id)}}
+
+
+async def start_server(handle_update, **kwargs):
+    server = WebhookServer(handle_update, **kwargs)
+    server.host = '127.0.0.1'
+    server.port = 0
+    server.secret = None
+    await server.start()
+    port = server.runner.addresses[0][1]
+    return server, f"http://127.0.0.1:{port}{server.path}"
+
+
+def test_update_chat_id():
+    assert update_chat_id(message_update(1, 42)) == 42
+    assert update_chat_id({'update_id': 2, 'callback_query': {'from': {'id': 7}, 'message': {'chat': {'id': 8}}}}) == 8
+    assert update_chat_id({'update_id': 3, 'inline_query': {'from': {'id': 9}}}) == 3
+
+
+def test_updates_of_one_chat_are_processed_in_order():
+    # Фальшивый обработчик вместо отправки в Telegram: случайные задержки перемешали бы порядок,
+    # если бы обновления одного чата обрабатывались параллельно
+    processed = {}
+
+    async def handle_update(update):
+        await asyncio.sleep(random.uniform(0, 0.005))
+        chat_id = update['message']['chat']['id']
+        processed.setdefault(chat_id, []).append(update['update_id'])
+
+    async def scenario():
+        server, url = await start_server(handle_update, workers=4, queue_size=1000)
+        try:
+            async with aiohttp.ClientSession() as session:
+                for update_id in range(200):
+                    async with session.post(url, json=message_update(update_id, update_id % 10)) as response:
+                        assert response.status == 200
+        finally:
+            await server.stop()
+        return server
+
+    server = asyncio.run(scenario())
+    assert server.stats['processed'] == 200
+    for chat_id, update_ids in processed.items():
+        assert update_ids == sorted(update_ids)
+        assert update_ids == list(range(chat_id, 200, 10))
+
+
+def test_full_queue_answers_429():
+    release = asyncio.Event()
+
+    async def handle_update(update):
+        await release.wait()
+
+    async def scenario():
+        server, url = await start_server(handle_update, workers=1, queue_size=2)
+        statuses = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                for update_id in range(5):
+                    async with session.post(url, json=message_update(update_id, 1)) as response:
+                        statuses.append((response.status, response.headers.get('Retry-After')))
+                    await asyncio.sleep(0.01)
+        finally:
+            release.set()
+            await server.stop()
+        return server, statuses
+
+    server, statuses = asyncio.run(scenario())
+    # одно обновление у воркера, два в очереди, остальные отклонены
+    assert [status for status, _ in statuses] == [200, 200, 200, 429, 429]
+    assert statuses[-1][1] == '1'
+    assert server.stats['rejected'] == 2
+    assert server.stats['processed'] == 3
+
+
+def test_wrong_secret_is_rejected():
+    async def handle_update(update):
+        pass
+
+    async def scenario():
+        server, url = await start_server(handle_update, workers=1)
+        server.secret = 'secret'
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url, json=message_update(1, 1),
+                                        headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}) as response:
+                    return response.status, server.stats['accepted']
+        finally:
+            await server.stop()
+
+    assert asyncio.run(scenario()) == (401, 0)
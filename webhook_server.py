@@ -0,0 +1,123 @@
+from dotenv import load_dotenv
+import asyncio
+import hmac
+import os
+import time
+from aiohttp import web
+
+
+def update_chat_id(update):
+    # Чат, к которому относится обновление Telegram: по нему обновления раскладываются по обработчикам,
+    # чтобы сообщения одного чата обрабатывались строго по порядку
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'callback_query',
+                 'my_chat_member', 'chat_member', 'chat_join_request'):
+        item = update.get(kind)
+        if not item:
+            continue
+        chat = item.get('chat') or (item.get('message') or {}).get('chat')
+        if chat:
+            return chat.get('id')
+        if item.get('from'):
+            return item['from'].get('id')
+    return update.get('update_id', 0)
+
+
+class WebhookServer:
+    # Приём обновлений Telegram через вебхук: запрос только кладёт обновление в очередь и сразу отвечает,
+    # обработку выполняют воркеры. Очередь у каждого воркера своя, чат всегда попадает к одному воркеру -
+    # так сохраняется порядок внутри чата, а разные чаты обрабатываются параллельно.
+    # При заполненной очереди отвечаем 429, и Telegram повторит доставку позже
+    def __init__(self, handle_update, workers=None, queue_size=None):
+        load_dotenv()
+        self.handle_update = handle_update   # async handle_update(update: dict)
+        self.host = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+        self.port = int(os.environ.get("WEBHOOK_PORT", 8080))
+        self.path = os.environ.get("WEBHOOK_PATH", "/telegram/webhook")
+        self.url = os.environ.get("WEBHOOK_URL")   # внешний адрес, который регистрируется в Telegram
+        self.secret = os.environ.get("WEBHOOK_SECRET")
+        self.workers = workers or int(os.environ.get("WEBHOOK_WORKERS", 8))
+        self.queue_size = queue_size or int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+        self.queues = []
+        self.tasks = []
+        self.runner = None
+        self.stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0}
+
+    def public_url(self):
+        return self.url.rstrip('/') + self.path if self.url else None
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_request)
+        app.router.add_get(self.path + '/health', self.handle_health)
+        return app
+
+    async def start(self):
+        # Очереди создаются внутри работающего цикла событий
+        per_worker = max(1, self.queue_size // self.workers)
+        self.queues = [asyncio.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self.tasks = [asyncio.create_task(self.worker(queue)) for queue in self.queues]
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        print(f"Вебхук слушает {self.host}:{self.port}{self.path}, воркеров {self.workers}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        # дожидаемся уже принятых обновлений, потом останавливаем воркеры
+        for queue in self.queues:
+            await queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    async def handle_request(self, request):
+        if self.secret:
+            received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(received, self.secret):
+                return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not self.enqueue(update):
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        return web.Response(status=200)
+
+    async def handle_health(self, request):
+        return web.json_response({'queued': sum(queue.qsize() for queue in self.queues), **self.stats})
+
+    def enqueue(self, update):
+        queue = self.queues[hash(update_chat_id(update)) % len(self.queues)]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            return False
+        self.stats['accepted'] += 1
+        return True
+
+    async def worker(self, queue):
+        while True:
+            update = await queue.get()
+            started = time.monotonic()
+            try:
+                await self.handle_update(update)
+                self.stats['processed'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                print(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+            finally:
+                queue.task_done()
+            elapsed = time.monotonic() - started
+            if elapsed > 5:
+                print(f"Обновление {update.get('update_id')} обрабатывалось {elapsed:.1f} c")